@@ -0,0 +1,86 @@
+"""Hetzner action completion tracking.
+
+Builds wait on the actions Hetzner returns (create_server, start_server, ...)
+instead of polling their servers. One loop checks every watched action with
+a single GET /actions?id=..&id=.. per tick and resolves the waiters of the
+actions that finished, so N concurrent builds cost one request per tick.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from hetzner import HAction
+
+FINISHED = ("success", "error")
+
+
+class ActionTracker:
+    def __init__(self, fetch: Callable[[List[int]], Awaitable[List[HAction]]], interval: float = 3.0,
+                 batch: int = 50):
+        self._fetch = fetch
+        self.interval = max(0.5, float(interval))
+        self.batch = max(1, int(batch))
+        self._waiters: Dict[int, List[asyncio.Future]] = {}
+        self._progress: Dict[int, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.polls = 0
+        self.errors = 0
+
+    def watch(self, action_id: int) -> "asyncio.Future[HAction]":
+        """Future resolved with the action once it is no longer running."""
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(int(action_id), []).append(fut)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+        return fut
+
+    async def wait(self, action_ids: Iterable[int], timeout: float) -> List[HAction]:
+        """Wait for all actions; raises asyncio.TimeoutError (and stops watching) on timeout."""
+        ids = [int(a) for a in action_ids]
+        if not ids:
+            return []
+        try:
+            return list(await asyncio.wait_for(asyncio.gather(*(self.watch(a) for a in ids)), timeout))
+        finally:
+            self._prune()
+            for a in ids:
+                if a not in self._waiters:
+                    self._progress.pop(a, None)
+
+    def progress(self, action_ids: Iterable[int]) -> int:
+        """Mean progress (0-100) last seen for the actions."""
+        vals = [self._progress.get(int(a), 0) for a in action_ids]
+        return int(sum(vals) / len(vals)) if vals else 0
+
+    def _prune(self) -> List[int]:
+        for aid in list(self._waiters):
+            live = [f for f in self._waiters[aid] if not f.done()]
+            if live:
+                self._waiters[aid] = live
+            else:
+                del self._waiters[aid]
+        return list(self._waiters)
+
+    async def _loop(self) -> None:
+        while self._prune():
+            await asyncio.sleep(self.interval)
+            ids = self._prune()
+            for i in range(0, len(ids), self.batch):
+                chunk = ids[i:i + self.batch]
+                self.polls += 1
+                try:
+                    actions = await self._fetch(chunk)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # transient API trouble: keep watching, callers own the timeout
+                    self.errors += 1
+                    continue
+                for a in actions:
+                    self._progress[a.id] = a.progress
+                    if a.status in FINISHED:
+                        for f in self._waiters.pop(a.id, []):
+                            if not f.done():
+                                f.set_result(a)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"watching": len(self._waiters), "polls": self.polls, "errors": self.errors}
@@ -1,7 +1,7 @@
 \
 import asyncio
 import os
-import shutil
+import secrets
 import time
 import json
 import math
@@ -10,23 +10,29 @@ from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime, timedelta, timezone
 
 import pytz
-import requests
 import aiohttp
 import re
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.filters import CommandStart
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 
-from hcloud import Client
-from hcloud.images import Image
-from hcloud.server_types import ServerType
-from hcloud.locations import Location
+from hetzner import HetznerClient, HImage, RateGovernor
 
+from actions import ActionTracker
+from broadcast import BroadcastRunner
+from catalog import ImageCatalog, ServerTypeCatalog, StockIndex, refresh_loop
 from db import DB
+from outbox import OutboxWorker, Undeliverable
+from provisioning import ProvisioningPool
+from scheduler import Scheduler
+from sender import SendQueue
+from singleflight import SingleFlight
+from warmpool import WarmPool, parse_warm_pool_spec
 
 
 # -------------------------
@@ -57,149 +63,6 @@ def fmt_irt(value: Any) -> str:
     s2 = f"{n:,}".replace(",", "٬")
     return f"{s2} تومان"
 
-def ensure_card_purchase_api(DB_cls):
-    """Make bot resilient if db.py on server is older (missing card purchase methods)."""
-    if hasattr(DB_cls, "create_card_purchase"):
-        return
-
-    import aiosqlite, time, json
-
-    async def _ensure_table(self):
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                """CREATE TABLE IF NOT EXISTS card_purchases (
-                    invoice_id INTEGER PRIMARY KEY,
-                    user_id INTEGER NOT NULL,
-                    payload_json TEXT NOT NULL,
-                    receipt_file_id TEXT,
-                    status TEXT NOT NULL,
-                    created_at INTEGER NOT NULL
-                )"""
-            )
-            await db.commit()
-
-    async def create_card_purchase(self, invoice_id: int, user_id: int, payload_json: str) -> None:
-        await _ensure_table(self)
-        now = int(time.time())
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "INSERT OR REPLACE INTO card_purchases(invoice_id,user_id,payload_json,receipt_file_id,status,created_at) VALUES(?,?,?,?,?,?)",
-                (invoice_id, user_id, payload_json, None, "waiting_receipt", now),
-            )
-            await db.commit()
-
-    async def set_card_purchase_receipt(self, invoice_id: int, receipt_file_id: str) -> None:
-        await _ensure_table(self)
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "UPDATE card_purchases SET receipt_file_id=?, status='sent_to_admin' WHERE invoice_id=?",
-                (receipt_file_id, invoice_id),
-            )
-            await db.commit()
-
-    async def get_card_purchase(self, invoice_id: int):
-        await _ensure_table(self)
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(
-                "SELECT invoice_id,user_id,payload_json,receipt_file_id,status,created_at FROM card_purchases WHERE invoice_id=?",
-                (invoice_id,),
-            )
-            r = await cur.fetchone()
-        if not r:
-            return None
-        return {
-            "invoice_id": r[0],
-            "user_id": r[1],
-            "payload_json": r[2],
-            "receipt_file_id": r[3],
-            "status": r[4],
-            "created_at": r[5],
-        }
-
-    async def set_card_purchase_status(self, invoice_id: int, status: str) -> None:
-        await _ensure_table(self)
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE card_purchases SET status=? WHERE invoice_id=?", (status, invoice_id))
-            await db.commit()
-
-    DB_cls.create_card_purchase = create_card_purchase
-    DB_cls.set_card_purchase_receipt = set_card_purchase_receipt
-    DB_cls.get_card_purchase = get_card_purchase
-    DB_cls.set_card_purchase_status = set_card_purchase_status
-
-
-async def ensure_card_purchase_support(db: DB):
-    """Runtime fallback: some deployments may have an older db.py without card_purchases helpers.
-    This function makes the bot resilient by ensuring the table exists and monkey-patching missing methods.
-    """
-    if hasattr(DB, "create_card_purchase") and hasattr(DB, "get_card_purchase"):
-        return
-
-    import aiosqlite, time as _time
-    # Ensure table exists
-    async with aiosqlite.connect(db.path) as _c:
-        await _c.executescript("""
-        CREATE TABLE IF NOT EXISTS card_purchases (
-          invoice_id INTEGER PRIMARY KEY,
-          user_id INTEGER NOT NULL,
-          payload_json TEXT NOT NULL,
-          receipt_file_id TEXT,
-          status TEXT NOT NULL,
-          created_at INTEGER NOT NULL
-        );
-        """)
-        await _c.commit()
-
-    # Monkey patch missing methods onto DB class
-    if not hasattr(DB, "create_card_purchase"):
-        async def _create_card_purchase(self, invoice_id: int, user_id: int, payload_json: str) -> None:
-            now = int(_time.time())
-            async with aiosqlite.connect(self.path) as _db:
-                await _db.execute(
-                    "INSERT OR REPLACE INTO card_purchases(invoice_id,user_id,payload_json,receipt_file_id,status,created_at) VALUES(?,?,?,?,?,?)",
-                    (invoice_id, user_id, payload_json, None, "waiting_receipt", now),
-                )
-                await _db.commit()
-        DB.create_card_purchase = _create_card_purchase  # type: ignore[attr-defined]
-
-    if not hasattr(DB, "set_card_purchase_receipt"):
-        async def _set_card_purchase_receipt(self, invoice_id: int, receipt_file_id: str) -> None:
-            async with aiosqlite.connect(self.path) as _db:
-                await _db.execute(
-                    "UPDATE card_purchases SET receipt_file_id=?, status='sent_to_admin' WHERE invoice_id=?",
-                    (receipt_file_id, invoice_id),
-                )
-                await _db.commit()
-        DB.set_card_purchase_receipt = _set_card_purchase_receipt  # type: ignore[attr-defined]
-
-    if not hasattr(DB, "get_card_purchase"):
-        async def _get_card_purchase(self, invoice_id: int):
-            async with aiosqlite.connect(self.path) as _db:
-                cur = await _db.execute(
-                    "SELECT invoice_id,user_id,payload_json,receipt_file_id,status,created_at FROM card_purchases WHERE invoice_id=?",
-                    (invoice_id,),
-                )
-                r = await cur.fetchone()
-            if not r:
-                return None
-            return {
-                "invoice_id": r[0],
-                "user_id": r[1],
-                "payload_json": r[2],
-                "receipt_file_id": r[3],
-                "status": r[4],
-                "created_at": r[5],
-            }
-        DB.get_card_purchase = _get_card_purchase  # type: ignore[attr-defined]
-
-    if not hasattr(DB, "set_card_purchase_status"):
-        async def _set_card_purchase_status(self, invoice_id: int, status: str) -> None:
-            async with aiosqlite.connect(self.path) as _db:
-                await _db.execute("UPDATE card_purchases SET status=? WHERE invoice_id=?", (status, invoice_id))
-                await _db.commit()
-        DB.set_card_purchase_status = _set_card_purchase_status  # type: ignore[attr-defined]
-
-
 # -------------------------
 # Button label overrides (Admin -> Settings -> Rename buttons)
 # -------------------------
@@ -340,6 +203,16 @@ async def load_glass_buttons_pref(db: "DB") -> None:
     except Exception:
         GLASS_BUTTONS_ENABLED = True
 
+
+async def on_db_change(db: "DB", name: str, keys: Optional[set]) -> None:
+    """Refresh module-level caches after another process (bot/bridge) changed the DB."""
+    if name != "settings" or not keys:
+        return
+    if "button_labels" in keys:
+        await load_button_labels(db)
+    if "glass_buttons_enabled" in keys:
+        await load_glass_buttons_pref(db)
+
 # -------------------------
 # Config
 # -------------------------
@@ -350,6 +223,54 @@ ADMIN_IDS = {int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.
 HCLOUD_TOKEN = os.getenv("HCLOUD_TOKEN", "")
 
 DB_PATH = os.getenv("DB_PATH", "/opt/vpsbot/vpsbot.sqlite3")
+DB_POOL_READERS = int(os.getenv("DB_POOL_READERS", "4") or 4)
+DB_WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "64") or 64)
+DB_WRITE_BATCH_WINDOW_MS = float(os.getenv("DB_WRITE_BATCH_WINDOW_MS", "2") or 2)
+# how often to look for changes made by the other process (bot <-> bridge)
+DB_CHANGE_POLL_SEC = float(os.getenv("DB_CHANGE_POLL_SEC", "1") or 1)
+
+# Background jobs (due-time scheduler)
+TRAFFIC_POLL_SEC = int(os.getenv("TRAFFIC_POLL_SEC", "300") or 300)
+# metrics for an hour keep arriving after it ends; settle it only after this
+TRAFFIC_SETTLE_GRACE_SEC = int(os.getenv("TRAFFIC_SETTLE_GRACE_SEC", "900") or 900)
+# full re-read of active orders (catches changes made by the other process)
+SCHED_RESEED_SEC = int(os.getenv("SCHED_RESEED_SEC", "600") or 600)
+SCHED_RETRY_SEC = 60
+# Server builds run in background workers (provisioning_jobs); a job untouched
+# for PROVISION_LEASE_SEC may be taken over by the other process
+PROVISION_WORKERS = int(os.getenv("PROVISION_WORKERS", "4") or 4)
+PROVISION_LEASE_SEC = int(os.getenv("PROVISION_LEASE_SEC", "600") or 600)
+# hourly traffic samples older than this are compacted into daily rows
+TRAFFIC_HOURLY_KEEP_DAYS = int(os.getenv("TRAFFIC_HOURLY_KEEP_DAYS", "14") or 14)
+# concurrent background calls per kind (Hetzner metrics, power actions, Telegram sends in flight)
+JOB_CONCURRENCY_METRICS = int(os.getenv("JOB_CONCURRENCY_METRICS", "8") or 8)
+JOB_CONCURRENCY_POWER = int(os.getenv("JOB_CONCURRENCY_POWER", "4") or 4)
+JOB_CONCURRENCY_NOTIFY = int(os.getenv("JOB_CONCURRENCY_NOTIFY", "10") or 10)
+# Outbound Telegram queue: messages/s for the whole bot and per group chat per minute (private chats: 1/s)
+TG_SEND_RATE = float(os.getenv("TG_SEND_RATE", "30") or 30)
+TG_SEND_GROUP_PER_MIN = int(os.getenv("TG_SEND_GROUP_PER_MIN", "20") or 20)
+# Broadcasts: messages/s (keep below TG_SEND_RATE so other notifications still get through) and page size
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20") or 20)
+BROADCAST_PAGE = int(os.getenv("BROADCAST_PAGE", "100") or 100)
+# Notification outbox: poll interval for rows written by the other process, attempts before a row is dead
+OUTBOX_POLL_SEC = float(os.getenv("OUTBOX_POLL_SEC", "2") or 2)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8") or 8)
+
+# Hetzner catalogs (images, server types) are kept in memory and refreshed in the background
+CATALOG_TTL_SEC = int(os.getenv("CATALOG_TTL_SEC", "3600") or 3600)
+# per-location stock (Hetzner /datacenters) moves faster than the catalogs
+STOCK_TTL_SEC = int(os.getenv("STOCK_TTL_SEC", "120") or 120)
+# Hetzner project request budget per hour (synced from RateLimit-* headers once calls are made)
+HCLOUD_RATE_LIMIT = int(os.getenv("HCLOUD_RATE_LIMIT", "3600") or 3600)
+# one GET /actions per tick covers every server being built
+HCLOUD_ACTION_POLL_SEC = float(os.getenv("HCLOUD_ACTION_POLL_SEC", "3") or 3)
+# Warm pool: pre-built servers for top sellers, "type@location@OS=count,..." (empty = off)
+WARM_POOL_SPEC = parse_warm_pool_spec(os.getenv("WARM_POOL", ""))
+WARM_POOL_MAX = int(os.getenv("WARM_POOL_MAX", "10") or 10)
+WARM_POOL_MAX_AGE_HOURS = int(os.getenv("WARM_POOL_MAX_AGE_HOURS", "24") or 24)
+WARM_POOL_REFILL_SEC = int(os.getenv("WARM_POOL_REFILL_SEC", "120") or 120)
+# keep idle pool servers powered off (Hetzner bills them either way; delivery then includes a boot)
+WARM_POOL_POWER_OFF = (os.getenv("WARM_POOL_POWER_OFF", "0") or "0").strip().lower() in ("1", "true", "yes", "on")
 
 # DB backups
 DB_BACKUP_DIR = os.getenv("DB_BACKUP_DIR", os.path.join(os.path.dirname(DB_PATH), "backups"))
@@ -444,8 +365,7 @@ COUNTRIES_ENABLED_SETTINGS_KEY = "countries_enabled"
 async def get_countries_enabled_cfg(db: DB) -> Dict[str, int]:
     """Return cfg[CC]=0/1 (country visibility in buy flow). Defaults to enabled for all in COUNTRY_LOCATIONS."""
     try:
-        raw = await db.get_setting(COUNTRIES_ENABLED_SETTINGS_KEY, "") or ""
-        obj = json.loads(raw) if raw else {}
+        obj = await db.get_setting_json(COUNTRIES_ENABLED_SETTINGS_KEY, {})
         if not isinstance(obj, dict):
             obj = {}
     except Exception:
@@ -475,8 +395,7 @@ async def set_country_enabled_flag(db: DB, cc: str, enabled: bool) -> None:
 async def get_country_location_groups_cfg(db: DB) -> Dict[str, Dict[str, Dict[str, int]]]:
     """Return nested cfg[CC][LOC][GROUP]=0/1"""
     try:
-        raw = await db.get_setting(COUNTRY_LOCATION_GROUPS_SETTINGS_KEY, "") or ""
-        obj = json.loads(raw) if raw else {}
+        obj = await db.get_setting_json(COUNTRY_LOCATION_GROUPS_SETTINGS_KEY, {})
         if not isinstance(obj, dict):
             return {}
         out: Dict[str, Dict[str, Dict[str, int]]] = {}
@@ -704,8 +623,17 @@ def now_ts() -> int:
 
 _ipv4_re = re.compile(r"^(?:\d{1,3}\.){3}\d{1,3}$")
 
+# identical concurrent lookups (provider catalogs, ping checks) share one call
+SINGLE_FLIGHT = SingleFlight()
+
 async def check_host_ping(ip: str, max_nodes: int = 3, wait_seconds: int = 7) -> Dict[str, Any]:
     """Call Check-Host.net ping API and return summary + raw results."""
+    return await SINGLE_FLIGHT.do(
+        ("ping", ip, int(max_nodes), int(wait_seconds)),
+        lambda: _check_host_ping(ip, max_nodes, wait_seconds),
+    )
+
+async def _check_host_ping(ip: str, max_nodes: int, wait_seconds: int) -> Dict[str, Any]:
     headers = {"Accept": "application/json", "User-Agent": f"{APP_TITLE}/1.0"}
     async with aiohttp.ClientSession(headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as session:
         async with session.get("https://check-host.net/check-ping", params={"host": ip, "max_nodes": str(max_nodes)}) as r:
@@ -766,60 +694,58 @@ async def _edit_progress(msg_obj, percent: int, line: str):
     except Exception:
         pass
 
-async def hcloud_wait_running(server_id: int, timeout_sec: int = 180) -> Tuple[Optional[str], str]:
-    """Wait until server is running and IPv4 is assigned."""
-    client = hclient()
-    start = time.time()
-    last_status = ""
-    while time.time() - start < timeout_sec:
-        srv = client.servers.get_by_id(server_id)
-        if srv:
-            last_status = getattr(srv, "status", "") or last_status
-            ip4 = ""
-            try:
-                ip4 = srv.public_net.ipv4.ip or ""
-            except Exception:
-                pass
-            if last_status == "running" and ip4:
-                return ip4, last_status
-        await asyncio.sleep(5)
-    return None, last_status or "unknown"
-
-async def hcloud_wait_running_with_progress(msg_obj, server_id: int, timeout_sec: int = 240,
-                                           start_percent: int = 75, end_percent: int = 99) -> Tuple[Optional[str], str]:
-    """Wait until server is running and IPv4 is assigned; update a progress percent while waiting."""
-    client = hclient()
-    start = time.time()
-    last_status = ""
-    last_percent = -1
+async def _hcloud_build_actions(server_id: int, action_ids: Optional[List[int]]) -> List[int]:
+    """Actions to wait on; a resumed build asks the server for its running actions once."""
+    if action_ids:
+        return [int(a) for a in action_ids]
+    try:
+        return [a.id for a in await hcloud_api().get_server_actions(server_id)]
+    except Exception:
+        return []
 
-    while True:
-        elapsed = time.time() - start
-        if elapsed >= timeout_sec:
-            break
-
-        srv = client.servers.get_by_id(server_id)
-        if srv:
-            last_status = getattr(srv, "status", "") or last_status
-            ip4 = ""
-            try:
-                ip4 = srv.public_net.ipv4.ip or ""
-            except Exception:
-                pass
 
-            # compute percent based on elapsed time (best-effort)
-            percent = start_percent + int((elapsed / float(timeout_sec)) * (end_percent - start_percent))
-            percent = max(start_percent, min(end_percent, percent))
-            if percent != last_percent:
-                await _edit_progress(msg_obj, percent, f"وضعیت: {last_status}…")
-                last_percent = percent
+async def _hcloud_build_result(server_id: int, actions: List[Any]) -> Tuple[Optional[str], str]:
+    failed = [a for a in actions if a.status == "error"]
+    if failed:
+        return None, f"error: {failed[0].command} {failed[0].error or ''}".strip()
+    try:
+        srv = await hcloud_api().get_server(server_id)
+    except Exception:
+        srv = None
+    if not srv:
+        return None, "unknown"
+    return (srv.ipv4 or None) if srv.status == "running" else None, srv.status or "unknown"
 
-            if last_status == "running" and ip4:
-                return ip4, last_status
 
-        await asyncio.sleep(5)
+async def hcloud_wait_running(server_id: int, timeout_sec: int = 180,
+                              action_ids: Optional[List[int]] = None) -> Tuple[Optional[str], str]:
+    """Wait for the build actions to finish, then read the server once for status and IPv4."""
+    ids = await _hcloud_build_actions(server_id, action_ids)
+    try:
+        actions = await ACTION_TRACKER.wait(ids, timeout_sec)
+    except asyncio.TimeoutError:
+        return None, "timeout"
+    return await _hcloud_build_result(server_id, actions)
 
-    return None, last_status or "unknown"
+async def hcloud_wait_running_with_progress(msg_obj, server_id: int, timeout_sec: int = 240,
+                                           start_percent: int = 75, end_percent: int = 99,
+                                           action_ids: Optional[List[int]] = None) -> Tuple[Optional[str], str]:
+    """Like hcloud_wait_running; the progress percent follows the tracked actions (no extra API calls)."""
+    ids = await _hcloud_build_actions(server_id, action_ids)
+    waiter = asyncio.ensure_future(ACTION_TRACKER.wait(ids, timeout_sec))
+    last_percent = -1
+    while not waiter.done():
+        await asyncio.wait({waiter}, timeout=5)
+        percent = start_percent + int(ACTION_TRACKER.progress(ids) / 100.0 * (end_percent - start_percent))
+        percent = max(start_percent, min(end_percent, percent))
+        if percent != last_percent and not waiter.done():
+            await _edit_progress(msg_obj, percent, "وضعیت: initializing…")
+            last_percent = percent
+    try:
+        actions = waiter.result()
+    except asyncio.TimeoutError:
+        return None, "timeout"
+    return await _hcloud_build_result(server_id, actions)
 
 def fmt_dt(ts: int) -> str:
     return datetime.fromtimestamp(ts, TZ).strftime("%Y-%m-%d %H:%M")
@@ -892,7 +818,15 @@ def _pricing_defaults() -> Dict[str, Any]:
         "eur_margin_threshold_eur": 10.0,  # monthly EUR threshold for tiered mode
     }
 
+# (settings_version, cfg) of the last get_pricing_cfg() result
+_PRICING_CFG_CACHE: Tuple[int, Optional[Dict[str, Any]]] = (-1, None)
+
 async def get_pricing_cfg(db: 'DB') -> Dict[str, Any]:
+    global _PRICING_CFG_CACHE
+    ver, cached = _PRICING_CFG_CACHE
+    if cached is not None and ver == db.settings_version:
+        return dict(cached)
+    ver = db.settings_version
     d = _pricing_defaults()
     try:
         d["eur_rate_irt"] = int(await db.get_setting("eur_rate_irt", str(d["eur_rate_irt"])) or d["eur_rate_irt"])
@@ -909,6 +843,7 @@ async def get_pricing_cfg(db: 'DB') -> Dict[str, Any]:
     d["eur_margin_low_pct"] = await _f("eur_margin_low_pct", d["eur_margin_low_pct"])
     d["eur_margin_high_pct"] = await _f("eur_margin_high_pct", d["eur_margin_high_pct"])
     d["eur_margin_threshold_eur"] = await _f("eur_margin_threshold_eur", d["eur_margin_threshold_eur"])
+    _PRICING_CFG_CACHE = (ver, dict(d))
     return d
 
 def _margin_pct(monthly_eur: Optional[float], cfg: Dict[str, Any]) -> float:
@@ -979,212 +914,184 @@ def safe_hostname(name: str) -> Optional[str]:
 # -------------------------
 # Hetzner utilities
 # -------------------------
-@dataclass
-class HImage:
-    id: int
-    name: str
-    description: str
+HCLOUD_API: Optional[HetznerClient] = None
+
+
+def hcloud_api() -> HetznerClient:
+    """Shared async Hetzner client (one keep-alive session per process)."""
+    global HCLOUD_API
+    if not HCLOUD_TOKEN:
+        raise RuntimeError("HCLOUD_TOKEN is not set in .env")
+    if HCLOUD_API is None:
+        HCLOUD_API = HetznerClient(HCLOUD_TOKEN, governor=RateGovernor(HCLOUD_RATE_LIMIT))
+    return HCLOUD_API
 
-# --- Hetzner server-type availability cache (best-effort) ---
-_STOCK_CACHE = {}  # (location, server_type) -> (ts, available_bool)
 
-def hcloud_server_type_available(location: str, server_type_name: str) -> bool:
+async def close_hcloud_api() -> None:
+    if HCLOUD_API is not None:
+        await HCLOUD_API.close()
+
+def list_locations_for_country(country_code: str) -> List[str]:
+    return COUNTRY_LOCATIONS.get(country_code, [])
+
+# OS menu and image resolution read this; best match per REQUESTED_OS label is precomputed
+IMAGE_CATALOG = ImageCatalog(
+    lambda: hcloud_api().list_images("system"), REQUESTED_OS, CATALOG_TTL_SEC, SINGLE_FLIGHT
+)
+# plan screens read specs and per-location offers from here, never per plan from the API
+SERVER_TYPE_CATALOG = ServerTypeCatalog(lambda: hcloud_api().list_server_types(), CATALOG_TTL_SEC, SINGLE_FLIGHT)
+# location -> creatable server types, only for our COUNTRY_LOCATIONS
+STOCK_INDEX = StockIndex(
+    lambda: hcloud_api().list_datacenters(), SERVER_TYPE_CATALOG, LOCATION_TO_COUNTRY.keys(), STOCK_TTL_SEC,
+    SINGLE_FLIGHT,
+)
+HCLOUD_CATALOGS = [IMAGE_CATALOG, SERVER_TYPE_CATALOG, STOCK_INDEX]
+# in-flight builds wait on their create/start actions, checked together once per tick
+ACTION_TRACKER = ActionTracker(lambda ids: hcloud_api().get_actions(ids), HCLOUD_ACTION_POLL_SEC)
+
+
+async def hcloud_server_type_available(location: str, server_type_name: str) -> bool:
     """
-    Best-effort stock check. Hetzner Cloud API provides 'available' per server_type.
-    This does NOT guarantee per-location stock, but usually correlates with "can create".
-    We cache for 120 seconds.
+    Best-effort stock check from the datacenters index (location-accurate).
+    Unknown location/type or no index yet counts as available; creation
+    errors are handled later.
     """
-    key = (location, server_type_name.lower())
-    now = time.time()
-    if key in _STOCK_CACHE and now - _STOCK_CACHE[key][0] < 120:
-        return bool(_STOCK_CACHE[key][1])
-    token = os.getenv("HCLOUD_TOKEN", "").strip()
-    if not token:
-        _STOCK_CACHE[key] = (now, True)
+    if not HCLOUD_TOKEN:
         return True
     try:
-        r = requests.get(
-            "https://api.hetzner.cloud/v1/server_types",
-            headers={"Authorization": f"Bearer {token}"},
-            timeout=10,
-        )
-        r.raise_for_status()
-        data = r.json().get("server_types", [])
-        for st in data:
-            if str(st.get("name","")).lower() == server_type_name.lower():
-                av = bool(st.get("available", True))
-                _STOCK_CACHE[key] = (now, av)
-                return av
+        await SERVER_TYPE_CATALOG.ensure()
+        await STOCK_INDEX.ensure()
     except Exception:
-        pass
-    _STOCK_CACHE[key] = (now, True)
-    return True
+        return True
+    return STOCK_INDEX.available(location, server_type_name) is not False
 
-def hclient() -> Client:
-    if not HCLOUD_TOKEN:
-        raise RuntimeError("HCLOUD_TOKEN is not set in .env")
-    return Client(token=HCLOUD_TOKEN)
 
-def list_locations_for_country(country_code: str) -> List[str]:
-    return COUNTRY_LOCATIONS.get(country_code, [])
+async def find_matching_image(os_label: str) -> Optional[HImage]:
+    return await IMAGE_CATALOG.get(os_label)
 
-def _normalize_os_key(s: str) -> str:
-    return s.lower().replace("_", "-").replace(" ", "").replace(".", "")
-
-def find_matching_image(client: Client, os_label: str) -> Optional[HImage]:
-    key = _normalize_os_key(os_label)
-    imgs = client.images.get_all(type="system")
-    best: Optional[Tuple[int, Any]] = None
-    for im in imgs:
-        hay = _normalize_os_key((im.name or "") + " " + (im.description or "") + " " + (im.os_flavor or "") + " " + (im.os_version or ""))
-        score = 0
-        if "ubuntu" in key and ("ubuntu" in hay):
-            score += 3
-        if "debian" in key and ("debian" in hay):
-            score += 3
-        if "rocky" in key and ("rocky" in hay):
-            score += 3
-        if "alma" in key and ("alma" in hay):
-            score += 3
-        if "cento" in key and ("centos" in hay or "stream" in hay):
-            score += 2
-        if "fed" in key and ("fedora" in hay):
-            score += 3
-        if "opensuse" in key and ("suse" in hay or "opensuse" in hay):
-            score += 3
-
-        digits = "".join(ch for ch in key if ch.isdigit())
-        if digits and digits in hay:
-            score += 2
-
-        if score > 0 and (best is None or score > best[0]):
-            best = (score, im)
-    if not best:
-        return None
-    im = best[1]
-    return HImage(id=int(im.id), name=im.name, description=im.description or "")
 
-def server_type_available_in_location(client: Client, server_type_name: str, location_name: str) -> bool:
-    # Best-effort: if type exists, assume available; creation errors handled later
-    try:
-        st = client.server_types.get_by_name(server_type_name)
-        return st is not None
-    except Exception:
-        return False
+async def get_server_type_specs(server_type_name: str) -> Dict[str, Any]:
+    await SERVER_TYPE_CATALOG.ensure()
+    return SERVER_TYPE_CATALOG.specs(server_type_name)
 
-def get_server_type_specs(client: Client, server_type_name: str) -> Dict[str, Any]:
-    st = client.server_types.get_by_name(server_type_name)
-    if not st:
-        return {}
-    return {"vcpu": getattr(st, "cores", None), "ram_gb": getattr(st, "memory", None), "disk_gb": getattr(st, "disk", None)}
-
-def hcloud_create_server(name: str, server_type: str, image_id: int, location_name: str) -> Tuple[int, str, str]:
-    client = hclient()
-    loc = Location(name=location_name)
-    response = client.servers.create(
-        name=name,
-        server_type=ServerType(name=server_type),
-        image=Image(id=image_id),
-        location=loc,
-    )
-    srv = response.server
-    root_pw = response.root_password or ""
-    ip4 = ""
-    try:
-        ip4 = srv.public_net.ipv4.ip
-    except Exception:
-        pass
-    return int(srv.id), ip4, root_pw
+async def hcloud_create_server(name: str, server_type: str, image_id: int, location_name: str) -> Tuple[int, str, str, List[int]]:
+    """Returns (server id, ipv4, root password, build action ids)."""
+    res = await hcloud_api().create_server(name, server_type, image_id, location_name)
+    return res.server.id, res.server.ipv4, res.root_password, res.action_ids
 
-def hcloud_power_action(server_id: int, action: str) -> None:
-    client = hclient()
-    srv = client.servers.get_by_id(server_id)
-    if not srv:
-        raise RuntimeError("server not found")
+async def hcloud_take_warm_server(server_id: int, name: str) -> Tuple[int, str, str]:
+    """Hand a pool server to a buyer: rename it, boot it if needed, new root password."""
+    api = hcloud_api()
+    srv = await api.rename_server(server_id, name, labels={})
+    if srv.status != "running":
+        act = await api.power_on(server_id)
+        await ACTION_TRACKER.wait([act.id], 120)
+    return srv.id, srv.ipv4, await api.reset_password(server_id)
+
+async def hcloud_power_action(server_id: int, action: str) -> None:
+    api = hcloud_api()
     if action == "poweroff":
-        srv.power_off()
+        await api.power_off(server_id)
     elif action == "poweron":
-
-        srv.power_on()
+        await api.power_on(server_id)
     elif action == "rebuild":
-        im = getattr(srv, "image", None)
-        if not im or not getattr(im, "id", None):
+        srv = await api.get_server(server_id, priority="power")
+        if not srv:
+            raise RuntimeError("server not found")
+        if not srv.image_id:
             raise RuntimeError("cannot detect server image to rebuild")
-        srv.rebuild(Image(id=int(im.id)))
+        await api.rebuild(server_id, srv.image_id)
     else:
         raise ValueError("unknown action")
 
-def hcloud_reset_password(server_id: int) -> str:
+async def hcloud_reset_password(server_id: int) -> str:
     if not HCLOUD_TOKEN:
         raise RuntimeError("HCLOUD_TOKEN missing")
-    url = f"https://api.hetzner.cloud/v1/servers/{server_id}/actions/reset_password"
-    r = requests.post(url, headers={"Authorization": f"Bearer {HCLOUD_TOKEN}"}, timeout=30)
-    r.raise_for_status()
-    data = r.json()
-    return data.get("root_password", "") or ""
+    return await hcloud_api().reset_password(server_id)
 
 
-def hcloud_delete_server(server_id: int) -> bool:
+async def hcloud_delete_server(server_id: int) -> bool:
     """Delete a Hetzner Cloud server by id.
 
-    Returns True if deleted (or not found). Uses two strategies:
-    1) Direct REST DELETE (fast)
-    2) hcloud SDK fallback (helps in some edge cases)
+    Returns True if deleted (or not found).
     """
     if not HCLOUD_TOKEN:
         raise RuntimeError("HCLOUD_TOKEN missing")
-    sid = int(server_id)
-    url = f"https://api.hetzner.cloud/v1/servers/{sid}"
-    try:
-        r = requests.delete(url, headers={"Authorization": f"Bearer {HCLOUD_TOKEN}"}, timeout=30)
-        if r.status_code in (200, 204, 202, 404):
-            return True
-        # Some states may return other codes; fall back to SDK once before failing.
-        last_err = f"{r.status_code} {r.text}"
-    except Exception as e:
-        last_err = str(e)
-
-    # Fallback: hcloud SDK
     try:
-        client = Client(token=HCLOUD_TOKEN)
-        srv = client.servers.get_by_id(sid)
-        if not srv:
-            return True
-        client.servers.delete(srv)
-        return True
+        return await hcloud_api().delete_server(int(server_id))
     except Exception as e:
-        raise RuntimeError(f"Hetzner delete failed: {last_err} / fallback: {e}")
+        raise RuntimeError(f"Hetzner delete failed: {e}")
 
-def hcloud_get_network_bytes(server_id: int, start: datetime, end: datetime) -> Optional[float]:
+async def hcloud_get_network_series(server_id: int, start: datetime, end: datetime) -> Optional[List[Tuple[int, float]]]:
     if not HCLOUD_TOKEN:
         return None
-    url = f"https://api.hetzner.cloud/v1/servers/{server_id}/metrics"
-    params = {
-        "type": "network",
-        "start": start.replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z"),
-        "end": end.replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z"),
-        "step": 3600,
-    }
-    r = requests.get(url, headers={"Authorization": f"Bearer {HCLOUD_TOKEN}"}, params=params, timeout=30)
-    if r.status_code != 200:
-        return None
-    data = r.json()
-    metrics = data.get("metrics", {}).get("time_series", {})
-    out_series = None
-    for k in ("network.out", "network_out"):
-        if k in metrics:
-            out_series = metrics.get(k)
-            break
-    if not out_series and "network" in metrics and isinstance(metrics["network"], dict):
-        out_series = metrics["network"].get("out")
-    if not out_series:
-        return None
-    total = 0.0
-    for _, v in (out_series.get("values") or []):
-        if v is None:
-            continue
-        total += float(v)
-    return total
+    return await hcloud_api().get_network_series(server_id, start, end)
+
+# -------------------------
+# Outbound messages (queued, rate limited; see sender.py)
+# -------------------------
+SENDER: Optional[SendQueue] = None
+
+
+def send_queue(bot: Bot) -> SendQueue:
+    global SENDER
+    if SENDER is None:
+        SENDER = SendQueue(
+            bot,
+            rate=TG_SEND_RATE,
+            group_interval=60.0 / max(1, TG_SEND_GROUP_PER_MIN),
+            concurrency=JOB_CONCURRENCY_NOTIFY,
+        )
+    return SENDER
+
+
+def notify(bot: Bot, chat_id: int, text: str, priority: str = "user", **kwargs: Any) -> "asyncio.Future[Any]":
+    """Queue a message; await the result for the sent Message (None if it could not be delivered)."""
+    return send_queue(bot).send_message(chat_id, text, priority, **kwargs)
+
+
+def notify_admins(bot: Bot, text: str, priority: str = "admin", **kwargs: Any) -> None:
+    q = send_queue(bot)
+    for aid in ADMIN_IDS:
+        q.send_message(aid, text, priority, **kwargs)
+
+
+# -------------------------
+# Notification outbox (written with the state change; see outbox.py)
+# -------------------------
+OUTBOX: Optional[OutboxWorker] = None
+
+
+def notice(chat_id: int, text: str, key: Optional[str] = None, priority: str = "user", **kwargs: Any) -> Dict[str, Any]:
+    """Outbox row for the notices= argument of DB methods; key makes it idempotent."""
+    markup = kwargs.pop("reply_markup", None)
+    if markup is not None:
+        kwargs["reply_markup"] = markup.model_dump(exclude_none=True)
+    return {"chat_id": int(chat_id), "key": key, "priority": priority, "payload": dict(kwargs, text=text)}
+
+
+def admin_notices(text: str, key: Optional[str] = None, **kwargs: Any) -> List[Dict[str, Any]]:
+    return [
+        notice(aid, text, f"{key}:admin:{aid}" if key else None, "admin", **kwargs)
+        for aid in ADMIN_IDS
+    ]
+
+
+async def _outbox_deliver(bot: Bot, row: Dict[str, Any]) -> None:
+    kwargs = dict(row["payload"])
+    if isinstance(kwargs.get("reply_markup"), dict):
+        kwargs["reply_markup"] = InlineKeyboardMarkup.model_validate(kwargs["reply_markup"])
+    try:
+        await send_queue(bot).submit(row["method"], row["chat_id"], row["priority"], raise_errors=True, **kwargs)
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        raise Undeliverable(str(e))
+
+
+async def _outbox_dead(bot: Bot, row: Dict[str, Any], err: str) -> None:
+    # what the receipt handler used to report inline when the user could not be messaged
+    if row["priority"] == "user" and row["chat_id"] not in ADMIN_IDS:
+        notify_admins(bot, f"⚠️ پیام به کاربر {row['chat_id']} ارسال نشد.\nخطا: {err[:200]}")
+
 
 # -------------------------
 # UI
@@ -1225,17 +1132,12 @@ async def send_admin_purchase_report(
             f"پلن: {plan_name} ({billing})\n"
             f"مبلغ: {money(amount_irt)}"
         )
-        for aid in ADMIN_IDS:
-            try:
-                await bot.send_message(aid, msg)
-            except Exception:
-                pass
+        notify_admins(bot, msg)
     except Exception:
         return
 
 
-async def send_admin_delete_report(
-    bot: Bot,
+async def admin_delete_report(
     db: DB,
     *,
     user_id: int,
@@ -1244,9 +1146,10 @@ async def send_admin_delete_report(
     actor_id: Optional[int] = None,
     actor_name: str = "-",
     extra_cost_irt: int = 0,
-):
-    """Send a standardized deletion report to all admins when a server/order is deleted.
+) -> List[Dict[str, Any]]:
+    """Outbox notices with the standardized deletion report for all admins.
 
+    Pass them as notices= of the call that marks the order deleted.
     reason examples: user_delete, auto_hourly_no_balance, admin_delete, admin_bulk_delete
     """
     try:
@@ -1301,23 +1204,21 @@ async def send_admin_delete_report(
         if extra_cost_irt and int(extra_cost_irt) > 0:
             msg += f"\nمبلغ تسویه/کسر شده: {money(int(extra_cost_irt))}"
 
-        for aid in ADMIN_IDS:
-            try:
-                await bot.send_message(aid, msg)
-            except Exception:
-                pass
+        return admin_notices(msg, f"deleted:{oid}")
     except Exception:
-        return
+        return []
+
+
+async def send_admin_delete_report(bot: Bot, db: DB, **kwargs: Any) -> None:
+    """admin_delete_report() for deletions made without set_order_status (bulk, soft delete)."""
+    await db.enqueue_outbox(await admin_delete_report(db, **kwargs))
 
 
 async def get_invoice_amount_irt(db: DB, invoice_id: int) -> int:
-    """Read invoice amount from DB (fallback when no db.py helper exists)."""
+    """Read invoice amount from DB."""
     try:
-        import aiosqlite
-        async with aiosqlite.connect(db.path) as c:
-            cur = await c.execute("SELECT amount_irt FROM invoices WHERE id=?", (invoice_id,))
-            r = await cur.fetchone()
-        return int(r[0]) if r and r[0] is not None else 0
+        inv = await db.get_invoice(invoice_id)
+        return int(inv["amount_irt"]) if inv else 0
     except Exception:
         return 0
 
@@ -1334,7 +1235,7 @@ async def main_menu(db: DB, user_id: int) -> Tuple[str, InlineKeyboardMarkup]:
 
 
     try:
-        labels = json.loads(await db.get_setting("button_labels", "{}") or "{}")
+        labels = await db.get_setting_json("button_labels", {})
         if not isinstance(labels, dict):
             labels = {}
     except Exception:
@@ -1347,7 +1248,7 @@ async def main_menu(db: DB, user_id: int) -> Tuple[str, InlineKeyboardMarkup]:
     # Note: "custom" refers to manual/custom buttons configured in admin panel.
     default_order = ["buy", "orders", "profile", "ip_status", "custom"]
     try:
-        menu_order = json.loads(await db.get_setting("menu_order", "") or "null")
+        menu_order = await db.get_setting_json("menu_order", None)
         if not isinstance(menu_order, list) or len(menu_order) != 5:
             menu_order = default_order
     except Exception:
@@ -1375,7 +1276,7 @@ async def main_menu(db: DB, user_id: int) -> Tuple[str, InlineKeyboardMarkup]:
 
     # Load custom/manual buttons once
     try:
-        cbtns = json.loads(await db.get_setting("custom_buttons", "[]") or "[]")
+        cbtns = await db.get_setting_json("custom_buttons", [])
         if not isinstance(cbtns, list):
             cbtns = []
     except Exception:
@@ -1412,18 +1313,6 @@ async def main_menu(db: DB, user_id: int) -> Tuple[str, InlineKeyboardMarkup]:
 
     rows.append([(L('back_to_main', 'برگشت'), 'returnToDelta')])
     return start_text, kb(rows)
-def ensure_invoice_api(DB_cls):
-    """Ensure invoice helpers exist even if db.py is older."""
-    if hasattr(DB_cls, "set_invoice_status"):
-        return
-    import aiosqlite
-
-    async def set_invoice_status(self, invoice_id: int, status: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE invoices SET status=? WHERE id=?", (status, invoice_id))
-            await db.commit()
-
-    DB_cls.set_invoice_status = set_invoice_status
 
 
 
@@ -1506,18 +1395,14 @@ async def reg_phone(msg: Message, db: DB, state: FSMContext):
 
     # Notify admins only on first registration
     if not prev_phone:
-        for aid in ADMIN_IDS:
-            try:
-                await msg.bot.send_message(
-                    aid,
-                    f"👤 ثبت‌نام جدید\n"
-                    f"ID عددی: <code>{msg.from_user.id}</code>\n"
-                    f"یوزرنیم: @{msg.from_user.username if msg.from_user.username else '-'}\n"
-                    f"شماره: <code>{phone}</code>",
-                    parse_mode="HTML",
-                )
-            except Exception:
-                pass
+        notify_admins(
+            msg.bot,
+            f"👤 ثبت‌نام جدید\n"
+            f"ID عددی: <code>{msg.from_user.id}</code>\n"
+            f"یوزرنیم: @{msg.from_user.username if msg.from_user.username else '-'}\n"
+            f"شماره: <code>{phone}</code>",
+            parse_mode="HTML",
+        )
 
     text, keyboard = await main_menu(db, msg.from_user.id)
     await msg.answer("✅ ثبت‌نام انجام شد.", reply_markup=ReplyKeyboardRemove())
@@ -1589,7 +1474,7 @@ async def ip_status_get(msg: Message, state: FSMContext):
 async def custom_show(cq: CallbackQuery, db: DB):
     idx = int(cq.data.split(":")[-1])
     try:
-        cbtns = json.loads(await db.get_setting("custom_buttons", "[]") or "[]")
+        cbtns = await db.get_setting_json("custom_buttons", [])
         if not isinstance(cbtns, list):
             cbtns = []
     except Exception:
@@ -1643,7 +1528,7 @@ async def buy_start(cq: CallbackQuery, db: DB, state: FSMContext):
 
     # Button labels (admin editable)
     try:
-        labels = json.loads(await db.get_setting("button_labels", "{}") or "{}")
+        labels = await db.get_setting_json("button_labels", {})
         if not isinstance(labels, dict):
             labels = {}
     except Exception:
@@ -1789,10 +1674,10 @@ async def buy_location(cq: CallbackQuery, state: FSMContext):
     await state.update_data(location=loc)
     await state.set_state(BuyFlow.os)
 
-    client = hclient()
+    await IMAGE_CATALOG.ensure()
     os_rows = []
     for os_name in REQUESTED_OS:
-        im = find_matching_image(client, os_name)
+        im = IMAGE_CATALOG.match(os_name)
         if im:
             os_rows.append([(f"🧊 {os_name} ✅", f"buy:os:{os_name}")])
         else:
@@ -1888,7 +1773,6 @@ async def buy_server_type_group(cq: CallbackQuery, db: DB, state: FSMContext):
     await state.set_state(BuyFlow.plan)
 
     data = await state.get_data()
-    await ensure_card_purchase_support(db)
 
     plans = await db.list_plans(data["provider"], data["country"], data["location"])
 
@@ -1940,22 +1824,35 @@ async def buy_server_type_group(cq: CallbackQuery, db: DB, state: FSMContext):
             return f"{gb_i/1024.0:.1f}TB"
         return f"{gb_i}GB"
 
-    client = hclient()
-
     # Build a readable summary text (instead of long button titles)
     lines = []
     btn_rows = []
 
+    # one catalog read for the whole list; without it fall back to stored specs
+    try:
+        await SERVER_TYPE_CATALOG.ensure()
+        catalog_ok = True
+    except Exception:
+        catalog_ok = False
+    try:
+        await STOCK_INDEX.ensure()
+    except Exception:
+        pass
+
     for idx, p in enumerate(plans, start=1):
         stype = (p.get("server_type") or "").upper()
-        specs = get_server_type_specs(client, p.get("server_type", "")) or {}
+        specs = SERVER_TYPE_CATALOG.specs(p.get("server_type", "")) if catalog_ok else {}
         vcpu = specs.get("vcpu") or p.get("vcpu") or "?"
         ram = specs.get("ram_gb") or p.get("ram_gb") or "?"
         disk = specs.get("disk_gb") or p.get("disk_gb") or "?"
         traffic = _fmt_traffic(int(p.get("traffic_limit_gb") or 0))
 
         # Best-effort "can create" status
-        available = server_type_available_in_location(client, p.get("server_type", ""), data.get("location", ""))
+        available = (
+            catalog_ok
+            and SERVER_TYPE_CATALOG.offered_in(p.get("server_type", ""), data.get("location", ""))
+            and STOCK_INDEX.available(data.get("location", ""), p.get("server_type", "")) is not False
+        )
         eff = await plan_effective_prices(db, p)
         pm = eff['monthly_irt']
         ph = eff['hourly_irt']
@@ -2060,7 +1957,6 @@ async def buy_billing(cq: CallbackQuery, db: DB, state: FSMContext):
 async def _finalize_purchase(cq: CallbackQuery, db: DB, state: FSMContext, pay_method: str):
     data = await state.get_data()
     user_id = cq.from_user.id
-    await ensure_card_purchase_support(db)
 
     # guard: state expired
     if "plan_id" not in data:
@@ -2092,12 +1988,33 @@ async def _finalize_purchase(cq: CallbackQuery, db: DB, state: FSMContext, pay_m
     provider = (data.get("provider") or plan.get("provider") or "hetzner").strip().lower()
     loc = data.get("location", "")
     if provider == "hetzner":
-        if loc and not hcloud_server_type_available(loc, plan["server_type"]):
+        if loc and not await hcloud_server_type_available(loc, plan["server_type"]):
             return await cq.answer("⛔️ این پلن فعلاً قابل ساخت نیست (استوک/محدودیت).", show_alert=True)
 
+    payload = {
+        "type": "manual" if provider == "manual" else "vps",
+        "provider": data.get("provider", ""),
+        "country": data.get("country", ""),
+        "location": data.get("location", ""),
+        "os": data.get("os", ""),
+        "server_name": data.get("server_name", ""),
+        "plan_id": int(data["plan_id"]),
+        "billing": billing,
+    }
+
     # ----- payment -----
     if pay_method == "wallet":
-        if u["balance_irt"] < amount:
+        desc = f"Purchase {plan['server_type']} ({billing})"
+        if provider == "manual":
+            debit = await db.debit_wallet(user_id, amount, desc)
+        else:
+            # the build job is written in the debit's transaction, so check the image first
+            if not await find_matching_image(data["os"]):
+                await cq.message.edit_text("❌ این سیستم‌عامل برای هتزنر موجود نیست.", reply_markup=kb([[("برگشت","buy:start")]]))
+                await state.clear()
+                return
+            debit = await db.debit_wallet_for_provisioning(user_id, amount, desc, payload)
+        if debit is None:
             await cq.message.edit_text(
                 f"{glass_header('عدم موجودی')}\n"
                 f"{GLASS_DOT} موجودی شما کافی نیست.\n"
@@ -2107,21 +2024,9 @@ async def _finalize_purchase(cq: CallbackQuery, db: DB, state: FSMContext, pay_m
             )
             await state.clear()
             return
-        await db.add_balance(user_id, -amount)
-        inv_id = await db.create_invoice(user_id, amount, "wallet", f"Purchase {plan['server_type']} ({billing})", "paid")
+        inv_id = debit[1]
     else:
         inv_id = await db.create_invoice(user_id, amount, "card", f"Purchase {plan['server_type']} ({billing})", "pending")
-
-        payload = {
-            "type": "manual" if provider == "manual" else "vps",
-            "provider": data.get("provider", ""),
-            "country": data.get("country", ""),
-            "location": data.get("location", ""),
-            "os": data.get("os", ""),
-            "server_name": data.get("server_name", ""),
-            "plan_id": int(data["plan_id"]),
-            "billing": billing,
-        }
         await db.create_card_purchase(inv_id, user_id, json.dumps(payload, ensure_ascii=False))
 
         await state.set_state(AwaitReceipt.invoice_id)
@@ -2143,22 +2048,18 @@ async def _finalize_purchase(cq: CallbackQuery, db: DB, state: FSMContext, pay_m
             parse_mode="HTML"
         )
 
-        for aid in ADMIN_IDS:
-            try:
-                await cq.bot.send_message(
-                    aid,
-                    f"📥 فاکتور کارت‌به‌کارت ({'فروش دستی' if provider=='manual' else 'خرید VPS'}) ایجاد شد\n"
-                    f"کاربر: {user_id}\n"
-                    f"مبلغ: {money(amount)}\n"
-                    f"فاکتور: #{inv_id}\n"
-                    f"IP: (بعد از تایید ساخته می‌شود)",
-                    reply_markup=kb([
-                        [("✅ تایید", f"admin:pay:approve:{inv_id}")],
-                        [("❌ رد", f"admin:pay:reject:{inv_id}")]
-                    ])
-                )
-            except Exception:
-                pass
+        notify_admins(
+            cq.bot,
+            f"📥 فاکتور کارت‌به‌کارت ({'فروش دستی' if provider=='manual' else 'خرید VPS'}) ایجاد شد\n"
+            f"کاربر: {user_id}\n"
+            f"مبلغ: {money(amount)}\n"
+            f"فاکتور: #{inv_id}\n"
+            f"IP: (بعد از تایید ساخته می‌شود)",
+            reply_markup=kb([
+                [("✅ تایید", f"admin:pay:approve:{inv_id}")],
+                [("❌ رد", f"admin:pay:reject:{inv_id}")]
+            ])
+        )
 
         return
 
@@ -2186,15 +2087,11 @@ async def _finalize_purchase(cq: CallbackQuery, db: DB, state: FSMContext, pay_m
         await db.attach_invoice_to_order(inv_id, oid)
 
         # notify admins to deliver
-        for aid in ADMIN_IDS:
-            try:
-                await cq.bot.send_message(
-                    aid,
-                    f"🧾 سفارش دستی جدید\nکاربر: {user_id}\nسرویس: #{oid}\nپلن: {plan.get('server_type')}\nلوکیشن: {data.get('location')}\nOS: {data.get('os')}\nپرداخت: {pay_method}",
-                    reply_markup=kb([[('✅ تحویل و ارسال', f'admin:manual:deliver:{oid}')],[('⬅️ پنل مدیریت','admin:home')]]),
-                )
-            except Exception:
-                pass
+        notify_admins(
+            cq.bot,
+            f"🧾 سفارش دستی جدید\nکاربر: {user_id}\nسرویس: #{oid}\nپلن: {plan.get('server_type')}\nلوکیشن: {data.get('location')}\nOS: {data.get('os')}\nپرداخت: {pay_method}",
+            reply_markup=kb([[('✅ تحویل و ارسال', f'admin:manual:deliver:{oid}')],[('⬅️ پنل مدیریت','admin:home')]]),
+        )
 
         await cq.message.edit_text(
             f"{glass_header('ثبت شد')}\n{GLASS_DOT} سفارش دستی شما ثبت شد و پس از ساخت توسط ربات برای شما ارسال می‌شود.\n{GLASS_DOT} شماره سرویس: <code>#{oid}</code>",
@@ -2204,102 +2101,9 @@ async def _finalize_purchase(cq: CallbackQuery, db: DB, state: FSMContext, pay_m
         await state.clear()
         return
 
-    # ----- create hetzner server -----
-    client = hclient()
-    img = find_matching_image(client, data["os"])
-    if not img:
-        if pay_method == "wallet":
-            await db.add_balance(user_id, amount)
-        await cq.message.edit_text("❌ این سیستم‌عامل برای هتزنر موجود نیست.", reply_markup=kb([[("برگشت","buy:start")]]))
-        await state.clear()
-        return
-
+    # ----- create hetzner server (background worker; the job was queued with the debit) -----
     await _edit_progress(cq.message, 10, 'در حال آماده‌سازی سفارش…')
-
-    await _edit_progress(cq.message, 30, 'انتخاب ایمیج سیستم‌عامل…')
-
-    try:
-        await _edit_progress(cq.message, 70, 'در حال ساخت سرور روی Hetzner…')
-        server_id, ip4, root_pw = hcloud_create_server(
-            name=data["server_name"],
-            server_type=plan["server_type"],
-            image_id=img.id,
-            location_name=data["location"],
-        )
-        # While Hetzner is provisioning, we show a progress percent that moves with real time/status.
-        ip_ready, st = await hcloud_wait_running_with_progress(cq.message, server_id, timeout_sec=240, start_percent=75, end_percent=99)
-        if ip_ready:
-            ip4 = ip_ready
-        await _edit_progress(cq.message, 100, 'سرور آماده شد ✅')
-    except Exception as e:
-        if pay_method == "wallet":
-            await db.add_balance(user_id, amount)
-        await cq.message.edit_text(
-            f"{glass_header('خطا در ساخت')}\n{GLASS_DOT} ساخت سرور ناموفق بود.\n{GLASS_DOT} خطا: {e}",
-            reply_markup=kb([[("🏠 منوی اصلی","home")]])
-        )
-        await state.clear()
-        return
-
-    now = int(time.time())
-    expires_at = int((datetime.fromtimestamp(now, TZ) + timedelta(days=duration_days)).timestamp())
-
-    traffic_gb = int(plan.get("traffic_limit_gb") or 0)
-    eff = await plan_effective_prices(db, plan)
-
-    oid = await db.create_order(
-        user_id=user_id,
-        plan_id=int(plan["id"]),
-        provider=data.get("provider",""),
-        country=data.get("country",""),
-        location=data.get("location",""),
-        os_name=data.get("os",""),
-        server_type=plan["server_type"],
-        hcloud_server_id=str(server_id),
-        ip4=str(ip4),
-        root_password=str(root_pw),
-        billing_mode=billing,
-        traffic_limit_gb=traffic_gb,
-        expires_at=expires_at,
-        status="active",
-        price_monthly_irt=int(eff['monthly_irt'] or 0),
-        price_hourly_irt=int(eff['hourly_irt'] or 0),
-    )
-    await db.attach_invoice_to_order(inv_id, oid)
-
-    # Initialize hourly counters to prevent huge retroactive charges on old deployments.
-    if (billing or "").lower() == "hourly" and int(plan.get("price_hourly_irt") or 0) > 0:
-        try:
-            current_hour = int(now // 3600)
-            await db.set_last_billed_hour(oid, current_hour)
-            # last_warn_at=0 (no warning yet)
-            await db.update_order_hourly_tick(oid, now, 0)
-        except Exception:
-            pass
-
-    await cq.message.edit_text(
-        f"{glass_header('تحویل سرویس')}\n"
-        f"{GLASS_DOT} IP: <code>{ip4}</code>\n"
-        f"{GLASS_DOT} USER: <code>root</code>\n"
-        f"{GLASS_DOT} PASS: <code>{root_pw}</code>\n"
-        f"{GLASS_DOT} انقضا: {fmt_dt(expires_at)}\n",
-        parse_mode="HTML",
-        reply_markup=kb([[("📦 سفارش‌های من","me:orders")],[("🏠 منوی اصلی","home")]])
-    )
-
-    # Send purchase report to admins (for both wallet and card purchases)
-    await send_admin_purchase_report(
-        cq.bot,
-        db,
-        user_id=user_id,
-        order_id=oid,
-        ip4=str(ip4),
-        pay_method=pay_method,
-        amount_irt=amount,
-        plan_name=str(plan['server_type']),
-        billing=str(billing),
-    )
-
+    await start_provisioning(db, debit[2], cq.message)
     await state.clear()
 
 @router.callback_query(F.data == "buy:pay:wallet")
@@ -2394,16 +2198,13 @@ async def renew_pay(cq: CallbackQuery, db: DB):
     if not o:
         return await cq.answer("یافت نشد.", show_alert=True)
     amount = int(o["price_monthly_irt"])
-    u = await db.get_user(cq.from_user.id)
-    if not u or u["balance_irt"] < amount:
+    if amount > 0 and await db.debit_wallet(cq.from_user.id, amount, f"Renew order#{oid}", order_id=oid, reason="renew") is None:
         return await cq.answer("موجودی کافی نیست.", show_alert=True)
-    await db.add_balance(cq.from_user.id, -amount)
-    await db.create_invoice(cq.from_user.id, amount, "wallet", f"Renew order#{oid}", "paid")
     new_exp = int((datetime.fromtimestamp(o["expires_at"], TZ) + timedelta(days=30)).timestamp())
     await db.update_order_status_and_expiry(oid, "active", new_exp)
     try:
         if o["hcloud_server_id"]:
-            hcloud_power_action(int(o["hcloud_server_id"]), "poweron")
+            await hcloud_power_action(int(o["hcloud_server_id"]), "poweron")
     except Exception:
         pass
     await cq.message.edit_text(f"{glass_header('تمدید شد')}\n{GLASS_DOT} تا {fmt_dt(new_exp)} تمدید شد.", reply_markup=kb([[("🏠 منوی اصلی","home")],[("📦 سفارش‌های من","me:orders")]]))
@@ -2484,17 +2285,21 @@ async def traffic_pay_wallet(cq: CallbackQuery, db: DB):
     if not pkg or not pkg.get('is_active'):
         return await cq.answer("پکیج نامعتبر است.", show_alert=True)
     amount = int(pkg['price_irt'] or 0)
-    u = await db.get_user(cq.from_user.id)
-    bal = int(u['balance_irt']) if u else 0
-    if bal < amount:
+    if amount > 0:
+        debit = await db.debit_wallet(cq.from_user.id, amount, f"Extra traffic order#{oid}", order_id=oid, reason="traffic")
+    else:
+        inv_id = await db.create_invoice(cq.from_user.id, 0, 'wallet', f"Extra traffic order#{oid}", 'paid')
+        await db.attach_invoice_to_order(inv_id, oid)
+        debit = (0, inv_id)
+    if debit is None:
+        u = await db.get_user(cq.from_user.id)
+        bal = int(u['balance_irt']) if u else 0
         await cq.message.edit_text(
             f"{glass_header('عدم موجودی')}\n{GLASS_DOT} موجودی کافی نیست.\n{GLASS_DOT} مبلغ: {money(amount)}\n{GLASS_DOT} موجودی: {money(bal)}",
             reply_markup=kb([[('برگشت', f'traffic:pkg:{oid}:{pid}')],[('➕ افزایش موجودی','me:topup')]]),
         )
         return await cq.answer()
-    await db.add_balance(cq.from_user.id, -amount)
-    inv_id = await db.create_invoice(cq.from_user.id, amount, 'wallet', f"Extra traffic order#{oid}", 'paid')
-    await db.attach_invoice_to_order(inv_id, oid)
+    inv_id = debit[1]
     await db.add_order_traffic_limit(oid, int(pkg['volume_gb']))
     await db.create_traffic_purchase(user_id=cq.from_user.id, order_id=oid, package_id=pid, volume_gb=int(pkg['volume_gb']), price_irt=amount, invoice_id=inv_id, status='paid')
     await cq.message.edit_text(
@@ -2509,7 +2314,6 @@ async def traffic_pay_card(cq: CallbackQuery, db: DB, state: FSMContext):
     _p = cq.data.split(":")
     oid = int(_p[3])
     pid = int(_p[4])
-    await ensure_card_purchase_support(db)
     o = await db.get_order(oid, user_id=cq.from_user.id)
     if not o:
         return await cq.answer("یافت نشد.", show_alert=True)
@@ -2539,19 +2343,15 @@ async def traffic_pay_card(cq: CallbackQuery, db: DB, state: FSMContext):
         reply_markup=kb([[('برگشت', f'order:view:{oid}')]]),
     )
 
-    for aid in ADMIN_IDS:
-        try:
-            await cq.bot.send_message(
-                aid,
-                f"📥 فاکتور کارت‌به‌کارت (حجم اضافه)\n"
-                f"کاربر: {cq.from_user.id}\n"
-                f"سرویس: #{oid}\n"
-                f"مبلغ: {money(amount)}\n"
-                f"فاکتور: #{inv_id}",
-                reply_markup=kb([[('✅ تایید', f'admin:pay:approve:{inv_id}')],[('❌ رد', f'admin:pay:reject:{inv_id}')]]),
-            )
-        except Exception:
-            pass
+    notify_admins(
+        cq.bot,
+        f"📥 فاکتور کارت‌به‌کارت (حجم اضافه)\n"
+        f"کاربر: {cq.from_user.id}\n"
+        f"سرویس: #{oid}\n"
+        f"مبلغ: {money(amount)}\n"
+        f"فاکتور: #{inv_id}",
+        reply_markup=kb([[('✅ تایید', f'admin:pay:approve:{inv_id}')],[('❌ رد', f'admin:pay:reject:{inv_id}')]]),
+    )
     await cq.answer()
 
 # -------------------------
@@ -2685,14 +2485,9 @@ async def order_delete_confirm(cq: CallbackQuery, db: DB):
         cost_minutes = int(math.ceil((minutes * rate) / 60.0)) if minutes > 0 else 0
         extra_cost = int(cost_full + cost_minutes)
 
-        u = await db.get_user(int(o["user_id"]))
-        bal = int(u["balance_irt"]) if u else 0
-        if extra_cost > 0 and bal < extra_cost:
-            return await cq.answer("موجودی کافی برای تسویه دقایق استفاده نیست. لطفاً ابتدا شارژ کنید.", show_alert=True)
-
         if extra_cost > 0:
-            await db.add_balance(int(o["user_id"]), -extra_cost)
-            await db.create_invoice(int(o["user_id"]), -extra_cost, "wallet", f"Hourly settle on delete order#{oid}", "paid")
+            if await db.debit_wallet(int(o["user_id"]), extra_cost, f"Hourly settle on delete order#{oid}", order_id=oid, reason="settle") is None:
+                return await cq.answer("موجودی کافی برای تسویه دقایق استفاده نیست. لطفاً ابتدا شارژ کنید.", show_alert=True)
         # mark billed up to now to avoid later double-charge
         try:
             await db.update_order_hourly_tick(oid, now, int(o.get("last_warn_at") or 0))
@@ -2703,29 +2498,24 @@ async def order_delete_confirm(cq: CallbackQuery, db: DB):
     # delete server at provider
     if sid:
         try:
-            hcloud_delete_server(int(sid))
+            await hcloud_delete_server(int(sid))
         except Exception:
             # still continue to mark deleted in DB
             pass
 
-    await db.set_order_status(oid, "deleted")
-
-    # report to admins
-    try:
-        uname = (cq.from_user.username or "")
-        actor_name = f"{cq.from_user.full_name}" + (f" (@{uname})" if uname else "")
-        await send_admin_delete_report(
-            cq.bot,
-            db,
-            user_id=int(o["user_id"]),
-            order=o,
-            reason="user_delete",
-            actor_id=int(cq.from_user.id),
-            actor_name=actor_name,
-            extra_cost_irt=int(extra_cost or 0),
-        )
-    except Exception:
-        pass
+    # report to admins, queued with the status change
+    uname = (cq.from_user.username or "")
+    actor_name = f"{cq.from_user.full_name}" + (f" (@{uname})" if uname else "")
+    report = await admin_delete_report(
+        db,
+        user_id=int(o["user_id"]),
+        order=o,
+        reason="user_delete",
+        actor_id=int(cq.from_user.id),
+        actor_name=actor_name,
+        extra_cost_irt=int(extra_cost or 0),
+    )
+    await db.set_order_status(oid, "deleted", notices=report)
 
     msg = "✅ سرور حذف شد."
     if billing == "hourly" and extra_cost > 0:
@@ -2762,7 +2552,7 @@ async def order_off(cq: CallbackQuery, db: DB):
     if not o or not o["hcloud_server_id"]:
         return await cq.answer("یافت نشد.", show_alert=True)
     try:
-        hcloud_power_action(int(o["hcloud_server_id"]), "poweroff")
+        await hcloud_power_action(int(o["hcloud_server_id"]), "poweroff")
         await cq.answer("خاموش شد.")
     except Exception as e:
         await cq.answer(f"خطا: {e}", show_alert=True)
@@ -2784,7 +2574,7 @@ async def order_on(cq: CallbackQuery, db: DB):
     if not o or not o["hcloud_server_id"]:
         return await cq.answer("یافت نشد.", show_alert=True)
     try:
-        hcloud_power_action(int(o["hcloud_server_id"]), "poweron")
+        await hcloud_power_action(int(o["hcloud_server_id"]), "poweron")
         await cq.answer("روشن شد.")
     except Exception as e:
         await cq.answer(f"خطا: {e}", show_alert=True)
@@ -2796,7 +2586,7 @@ async def order_rebuild(cq: CallbackQuery, db: DB):
     if not o or not o["hcloud_server_id"]:
         return await cq.answer("یافت نشد.", show_alert=True)
     try:
-        hcloud_power_action(int(o["hcloud_server_id"]), "rebuild")
+        await hcloud_power_action(int(o["hcloud_server_id"]), "rebuild")
         await cq.answer("ریبلد شروع شد.")
         await cq.bot.send_message(cq.from_user.id, "🔁 ریبلد شروع شد. بعدش برای پسورد جدید از گزینه «بازیابی پسوورد» استفاده کن.")
     except Exception as e:
@@ -2809,7 +2599,7 @@ async def order_resetpw(cq: CallbackQuery, db: DB):
     if not o or not o["hcloud_server_id"]:
         return await cq.answer("یافت نشد.", show_alert=True)
     try:
-        newpw = hcloud_reset_password(int(o["hcloud_server_id"]))
+        newpw = await hcloud_reset_password(int(o["hcloud_server_id"]))
         await cq.bot.send_message(cq.from_user.id, f"🔐 پسورد جدید روت:\n`{newpw}`", parse_mode="Markdown")
         await cq.answer("ارسال شد.")
     except Exception as e:
@@ -2823,7 +2613,15 @@ async def order_traffic(cq: CallbackQuery, db: DB):
         return await cq.answer("یافت نشد.", show_alert=True)
     if o["traffic_limit_gb"] <= 0:
         return await cq.answer("برای این سرویس سقف ترافیک تعریف نشده.", show_alert=True)
-    await cq.answer(f"{o['traffic_used_gb']:.1f}/{o['traffic_limit_gb']} GB")
+    now = now_ts()
+    last_day = await db.order_traffic_since(oid, now - 86400)
+    last_week = sum(b for _, b in await db.order_traffic_daily(oid, now - 6 * 86400))
+    await cq.answer(
+        f"{o['traffic_used_gb']:.1f}/{o['traffic_limit_gb']} GB\n"
+        f"۲۴ ساعت اخیر: {last_day / 1024**3:.1f} GB\n"
+        f"۷ روز اخیر: {last_week / 1024**3:.1f} GB",
+        show_alert=True,
+    )
 
 @router.message(TopUpFlow.amount)
 async def topup_amount(msg: Message, db: DB, state: FSMContext):
@@ -2857,21 +2655,17 @@ async def topup_amount(msg: Message, db: DB, state: FSMContext):
         reply_markup=kb([[("برگشت","home")]])
     )
 
-    for aid in ADMIN_IDS:
-        try:
-            await msg.bot.send_message(
-                aid,
-                f"📥 فاکتور کارت‌به‌کارت (شارژ کیف پول) ایجاد شد\n"
-                f"کاربر: {user_id}\n"
-                f"مبلغ: {money(amount)}\n"
-                f"فاکتور: #{inv_id}",
-                reply_markup=kb([
-                    [("✅ تایید شارژ", f"admin:pay:approve:{inv_id}")],
-                    [("❌ رد", f"admin:pay:reject:{inv_id}")]
-                ])
-            )
-        except Exception:
-            pass
+    notify_admins(
+        msg.bot,
+        f"📥 فاکتور کارت‌به‌کارت (شارژ کیف پول) ایجاد شد\n"
+        f"کاربر: {user_id}\n"
+        f"مبلغ: {money(amount)}\n"
+        f"فاکتور: #{inv_id}",
+        reply_markup=kb([
+            [("✅ تایید شارژ", f"admin:pay:approve:{inv_id}")],
+            [("❌ رد", f"admin:pay:reject:{inv_id}")]
+        ])
+    )
 
 @router.message(AwaitReceipt.invoice_id)
 async def receive_receipt(msg: Message, db: DB, state: FSMContext):
@@ -2938,14 +2732,12 @@ async def receive_receipt(msg: Message, db: DB, state: FSMContext):
         [("❌ رد رسید", f"admin:pay:reject:{inv_id}")],
     ])
 
+    q = send_queue(msg.bot)
     for aid in ADMIN_IDS:
-        try:
-            if msg.photo:
-                await msg.bot.send_photo(aid, file_id, caption=caption, reply_markup=admin_kb)
-            else:
-                await msg.bot.send_document(aid, file_id, caption=caption, reply_markup=admin_kb)
-        except Exception:
-            pass
+        if msg.photo:
+            q.submit("send_photo", aid, "admin", photo=file_id, caption=caption, reply_markup=admin_kb)
+        else:
+            q.submit("send_document", aid, "admin", document=file_id, caption=caption, reply_markup=admin_kb)
 
     await msg.answer("✅ رسید شما ارسال شد. منتظر تایید مدیر باشید.", reply_markup=kb([[("🏠 منوی اصلی","home")]]))
 
@@ -2976,15 +2768,11 @@ async def ticket_new_text(msg: Message, db: DB, state: FSMContext):
     await msg.answer(f"✅ تیکت شما ثبت شد. شماره: #{tid}", reply_markup=kb([[("📄 تیکت‌های من","ticket:mine")],[("🏠 منوی اصلی","home")]]))
 
     admin_kb = kb([[("✉️ پاسخ", f"admin:ticket:reply:{tid}")],[("✅ بستن", f"admin:ticket:close:{tid}")]])
-    for aid in ADMIN_IDS:
-        try:
-            await msg.bot.send_message(
-                aid,
-                f"🎫 تیکت جدید #{tid}\nکاربر: {msg.from_user.id}\nموضوع: {subject}\n\n{text}",
-                reply_markup=admin_kb
-            )
-        except Exception:
-            pass
+    notify_admins(
+        msg.bot,
+        f"🎫 تیکت جدید #{tid}\nکاربر: {msg.from_user.id}\nموضوع: {subject}\n\n{text}",
+        reply_markup=admin_kb
+    )
 
 @router.callback_query(F.data == "ticket:mine")
 async def ticket_mine(cq: CallbackQuery, db: DB):
@@ -3054,16 +2842,9 @@ async def ticket_reply_send(msg: Message, db: DB, state: FSMContext):
 
     admin_kb = kb([[("✉️ پاسخ", f"admin:ticket:reply:{tid}")],[("✅ بستن", f"admin:ticket:close:{tid}")]])
     if role == "user":
-        for aid in ADMIN_IDS:
-            try:
-                await msg.bot.send_message(aid, f"💬 پیام جدید در تیکت #{tid}\nکاربر: {t['user_id']}\n\n{txt}", reply_markup=admin_kb)
-            except Exception:
-                pass
+        notify_admins(msg.bot, f"💬 پیام جدید در تیکت #{tid}\nکاربر: {t['user_id']}\n\n{txt}", reply_markup=admin_kb)
     else:
-        try:
-            await msg.bot.send_message(t["user_id"], f"🛠 پاسخ مدیر (تیکت #{tid}):\n\n{txt}", reply_markup=kb([[("📄 تیکت‌های من","ticket:mine")]]))
-        except Exception:
-            pass
+        notify(msg.bot, t["user_id"], f"🛠 پاسخ مدیر (تیکت #{tid}):\n\n{txt}", reply_markup=kb([[("📄 تیکت‌های من","ticket:mine")]]))
 
 @router.callback_query(F.data.startswith("admin:ticket:reply:"))
 async def admin_ticket_reply_start(cq: CallbackQuery, db: DB, state: FSMContext):
@@ -3089,10 +2870,7 @@ async def admin_ticket_close(cq: CallbackQuery, db: DB):
     if not t:
         return await cq.answer("یافت نشد.", show_alert=True)
     await db.close_ticket(tid)
-    try:
-        await cq.bot.send_message(t["user_id"], f"✅ تیکت #{tid} بسته شد.", reply_markup=kb([[("🎫 پشتیبانی","support:start")],[("🏠 منوی اصلی","home")]]))
-    except Exception:
-        pass
+    notify(cq.bot, t["user_id"], f"✅ تیکت #{tid} بسته شد.", reply_markup=kb([[("🎫 پشتیبانی","support:start")],[("🏠 منوی اصلی","home")]]))
     await cq.answer("بسته شد.")
 
 @router.callback_query(F.data == "support:start")
@@ -3104,11 +2882,7 @@ async def support_text(msg: Message, state: FSMContext):
     txt = (msg.text or "").strip()
     if not txt:
         return await msg.answer("پیام خالی است.")
-    for aid in ADMIN_IDS:
-        try:
-            await msg.bot.send_message(aid, f"🎫 پیام پشتیبانی\nاز: {msg.from_user.id}\n@{msg.from_user.username}\n\n{txt}")
-        except Exception:
-            pass
+    notify_admins(msg.bot, f"🎫 پیام پشتیبانی\nاز: {msg.from_user.id}\n@{msg.from_user.username}\n\n{txt}")
     await msg.answer("✅ ارسال شد. منتظر پاسخ مدیر بمان.", reply_markup=kb([[("🏠 منوی اصلی","home")]]))
     await state.clear()
 
@@ -3170,7 +2944,7 @@ async def admin_user_view_common(bot_: Bot, chat_id: int, db: DB, uid: int):
     await bot_.send_message(chat_id, text, parse_mode="HTML", reply_markup=kb([
         [("✉️ پیام", f"admin:umsg:{uid}")],
         [("➕ افزایش", f"admin:ubal:add:{uid}"), ("➖ کاهش", f"admin:ubal:sub:{uid}")],
-        [("📦 سفارش‌ها", f"admin:uorders:{uid}")],
+        [("📦 سفارش‌ها", f"admin:uorders:{uid}"), ("💳 تراکنش‌ها", f"admin:uledger:{uid}")],
         [("⛔️ بلاک/آن‌بلاک", f"admin:ublock:{uid}")],
         [("🗑 حذف از دیتابیس", f"admin:udel:ask:{uid}")],
         [("برگشت","admin:users")]
@@ -3263,16 +3037,12 @@ async def admin_user_balance_apply(msg: Message, db: DB, state: FSMContext):
     except Exception:
         return await msg.answer("عدد معتبر نیست.")
     delta = amt if mode == "add" else -amt
-    await db.add_balance(uid, delta)
+    await db.add_balance(uid, delta, "admin", notices=[notice(uid, f"💰 تغییر موجودی: {money(delta)}")])
     try:
         await try_resume_suspended_hourly(msg.bot, db, uid)
     except Exception:
         pass
     await state.clear()
-    try:
-        await msg.bot.send_message(uid, f"💰 تغییر موجودی: {money(delta)}")
-    except Exception:
-        pass
     await msg.answer("✅ انجام شد.", reply_markup=kb([[("برگشت","admin:users")]]))
 
 @router.callback_query(F.data.startswith("admin:umsg:"))
@@ -3294,10 +3064,9 @@ async def admin_user_msg_send(msg: Message, state: FSMContext):
     txt = (msg.text or "").strip()
     if not txt:
         return await msg.answer("متن خالی است.")
-    try:
-        await msg.bot.send_message(uid, f"📩 پیام مدیر:\n\n{txt}")
+    if await notify(msg.bot, uid, f"📩 پیام مدیر:\n\n{txt}"):
         await msg.answer("✅ ارسال شد.", reply_markup=kb([[("برگشت","admin:users")]]))
-    except Exception:
+    else:
         await msg.answer("❌ ارسال نشد.")
     await state.clear()
 
@@ -3326,6 +3095,39 @@ async def admin_user_orders(cq: CallbackQuery, db: DB):
     await cq.answer()
 
 
+WALLET_REASON_LABELS = {
+    "opening": "موجودی اولیه",
+    "topup": "شارژ",
+    "refund": "بازگشت وجه",
+    "admin": "ادمین",
+    "purchase": "خرید",
+    "renew": "تمدید",
+    "traffic": "ترافیک",
+    "hourly": "ساعتی",
+    "settle": "تسویه حذف",
+}
+
+
+@router.callback_query(F.data.startswith("admin:uledger:"))
+async def admin_user_ledger(cq: CallbackQuery, db: DB):
+    if not is_admin(cq.from_user.id):
+        return
+    uid = int(cq.data.split(":")[-1])
+    entries = await db.wallet_history(uid, limit=20)
+    lines = [f"{glass_header('تراکنش‌های کیف پول')}", f"{GLASS_DOT} کاربر: {uid}"]
+    if not entries:
+        lines.append(f"{GLASS_DOT} تراکنشی ثبت نشده.")
+    for e in entries:
+        sign = "+" if e["delta_irt"] > 0 else "-"
+        ref = f" #{e['order_id']}" if e.get("order_id") else ""
+        lines.append(
+            f"{fmt_dt(e['created_at'])} | {sign}{money(abs(e['delta_irt']))} | "
+            f"{WALLET_REASON_LABELS.get(e['reason'], e['reason'])}{ref} | {money(e['balance_after'])}"
+        )
+    await cq.message.edit_text("\n".join(lines), reply_markup=kb([[("برگشت", f"admin:user:{uid}")]]))
+    await cq.answer()
+
+
 @router.callback_query(F.data.startswith("admin:uorders:clear:"))
 async def admin_user_orders_clear(cq: CallbackQuery, db: DB):
     if not is_admin(cq.from_user.id):
@@ -4025,7 +3827,7 @@ async def admin_manual_deliver_done(msg: Message, db: DB, state: FSMContext):
                 txt += f"رمز عبور مانیتورینگ: <code>{htmlesc(mon_pass)}</code>\n"
         if details:
             txt += f"\n{GLASS_DOT} توضیحات:\n{htmlesc(details)}"
-        await msg.bot.send_message(int(o['user_id']), txt, parse_mode='HTML', disable_web_page_preview=True)
+        notify(msg.bot, int(o['user_id']), txt, parse_mode='HTML', disable_web_page_preview=True)
     except Exception:
         pass
 
@@ -4640,12 +4442,12 @@ async def admin_addplan_group(cq: CallbackQuery, state: FSMContext):
     await state.update_data(server_type_group=grp)
     await state.set_state(AdminAddPlan.server_type)
 
-    client = hclient()
     types_ = server_types_for_group(grp)
 
+    await SERVER_TYPE_CATALOG.ensure()
     rows = []
     for st in types_:
-        specs = get_server_type_specs(client, st) or {}
+        specs = SERVER_TYPE_CATALOG.specs(st)
         rows.append([(f"{st.upper()} | {specs.get('vcpu','?')}vCPU {specs.get('ram_gb','?')}GB {specs.get('disk_gb','?')}GB", f"admin:addplan:stype:{st}")])
     rows.append([("برگشت","admin:home")])
     await cq.message.edit_text(f"{glass_header('سرور تایپ')}\n{GLASS_DOT} انتخاب کن:", reply_markup=kb(rows))
@@ -4749,8 +4551,7 @@ async def admin_addplan_price_hourly(msg: Message, db: DB, state: FSMContext):
     await state.update_data(price_hourly_eur=float(p), price_hourly_irt=int(hourly_irt))
 
     data = await state.get_data()
-    client = hclient()
-    specs = get_server_type_specs(client, data["server_type"]) or {}
+    specs = await get_server_type_specs(data["server_type"]) or {}
     plan_id = await db.create_plan({
         "provider": data["provider"],
         "country_code": data["country_code"],
@@ -5069,7 +4870,7 @@ async def admin_cbtns(cq: CallbackQuery, db: DB, state: FSMContext):
         return await cq.answer("دسترسی ندارید.", show_alert=True)
     await state.clear()
     try:
-        cbtns = json.loads(await db.get_setting("custom_buttons", "[]") or "[]")
+        cbtns = await db.get_setting_json("custom_buttons", [])
         if not isinstance(cbtns, list):
             cbtns = []
     except Exception:
@@ -5091,7 +4892,7 @@ async def admin_cbtn_view(cq: CallbackQuery, db: DB, state: FSMContext):
         return await cq.answer("دسترسی ندارید.", show_alert=True)
     idx = int(cq.data.split(":")[-1])
     try:
-        cbtns = json.loads(await db.get_setting("custom_buttons", "[]") or "[]")
+        cbtns = await db.get_setting_json("custom_buttons", [])
         if not isinstance(cbtns, list):
             cbtns = []
     except Exception:
@@ -5255,6 +5056,7 @@ async def admin_general(cq: CallbackQuery, db: DB):
             [(f"🧾 فروش دستی: {'روشن ✅' if manual_sale else 'خاموش ❌'}", "admin:toggle:manualsale")],
             [(f"🫧 تغییر نمایش دکمه‌ها: {'شیشه‌ای ✅' if glass_btns else 'عادی'}", "admin:toggle:glassbuttons")],
             [("📈 آمار", "admin:stats")],
+            [("📶 پرمصرف‌ترین‌ها (۷ روز)", "admin:traffictop")],
             [("👥 کاربران", "admin:users")],
             [("🌍 تنظیم کشور", "admin:countrycfg")],
             [("💶 قیمت‌گذاری (یورو)", "admin:pricing")],
@@ -5362,6 +5164,38 @@ async def admin_backup_upload_prompt(cq: CallbackQuery, db: DB, state: FSMContex
     )
     await cq.answer()
 
+
+async def restore_database(db: DB, path: str) -> None:
+    """Restore the backup file at path into the live database.
+
+    Workers that keep rows in memory (provisioning, broadcasts, outbox) are
+    stopped first and started again from the restored rows, and the job
+    scheduler is reseeded. Raises if the restore or its migration failed; the
+    workers are restarted either way.
+    """
+    if PROVISIONING is not None:
+        await PROVISIONING.stop()
+    if BROADCASTS is not None:
+        await BROADCASTS.stop()
+    if OUTBOX is not None:
+        await OUTBOX.stop()
+    try:
+        await db.restore_from(path)
+        await db.init()
+    finally:
+        await load_button_labels(db)
+        await load_glass_buttons_pref(db)
+        _build_label_catalog()
+        if PROVISIONING is not None:
+            PROVISIONING.start(await db.list_unfinished_provisioning_jobs())
+        if BROADCASTS is not None:
+            await BROADCASTS.resume_all()
+        if OUTBOX is not None:
+            OUTBOX.start()
+        if JOB_SCHEDULER is not None:
+            JOB_SCHEDULER.schedule(0, "reseed", 0)
+
+
 @router.message(AdminBackupFlow.upload_db)
 async def admin_backup_upload_apply(msg: Message, db: DB, state: FSMContext):
     if not is_admin(msg.from_user.id):
@@ -5369,35 +5203,37 @@ async def admin_backup_upload_apply(msg: Message, db: DB, state: FSMContext):
     if not msg.document:
         return await msg.answer("❌ لطفاً فایل دیتابیس را به صورت Document ارسال کن.", reply_markup=kb([[("برگشت","admin:backup")]]))
 
+    back = kb([[("برگشت","admin:backup")]])
     await msg.answer("⏳ در حال دانلود و اعمال…")
+    await state.clear()
     try:
         f = await msg.bot.get_file(msg.document.file_id)
         tmp_dir = os.path.join(DB_BACKUP_DIR, "_uploads")
         os.makedirs(tmp_dir, exist_ok=True)
         tmp_path = os.path.join(tmp_dir, f"uploaded_{int(time.time())}.sqlite3")
         await msg.bot.download_file(f.file_path, destination=tmp_path)
+    except Exception as e:
+        return await msg.answer(f"❌ خطا در دریافت فایل: {htmlesc(str(e))}", reply_markup=back)
 
-        # Safety backup of current DB
-        try:
-            await db.create_backup(DB_BACKUP_DIR, prefix=DB_BACKUP_PREFIX, keep_last=DB_BACKUP_KEEP_LAST)
-        except Exception:
-            pass
-
-        # Replace DB file
-        shutil.copyfile(tmp_path, DB_PATH)
-
-        # Ensure schema/migrations exist
-        try:
-            await db.init()
-        except Exception:
-            pass
+    # safety backup of the current DB; never restore without one
+    try:
+        safety = await db.create_backup(DB_BACKUP_DIR, prefix=DB_BACKUP_PREFIX, keep_last=DB_BACKUP_KEEP_LAST)
+    except Exception as e:
+        return await msg.answer(
+            f"❌ بکاپ ایمنی از دیتابیس فعلی ساخته نشد؛ چیزی تغییر نکرد.\nخطا: {htmlesc(str(e))}", reply_markup=back
+        )
 
+    try:
+        await restore_database(db, tmp_path)
     except Exception as e:
-        await state.clear()
-        return await msg.answer(f"❌ خطا: {htmlesc(str(e))}", reply_markup=kb([[("برگشت","admin:backup")]]))
+        return await msg.answer(
+            f"❌ اعمال دیتابیس ناموفق بود: {htmlesc(str(e))}\n"
+            f"بکاپ ایمنی: <code>{htmlesc(os.path.basename(safety))}</code>",
+            parse_mode="HTML",
+            reply_markup=back,
+        )
 
-    await state.clear()
-    await msg.answer("✅ دیتابیس اعمال شد.", reply_markup=kb([[("برگشت","admin:backup")]]))
+    await msg.answer("✅ دیتابیس اعمال شد.", reply_markup=back)
 
 @router.callback_query(F.data.startswith("admin:toggle:"))
 async def admin_toggle(cq: CallbackQuery, db: DB):
@@ -5535,17 +5371,86 @@ async def admin_countrycfg_toggle(cq: CallbackQuery, db: DB):
     await _render_location_groups_screen(cq.message, db, cc, loc)
     await cq.answer("ذخیره شد ✅")
 
+def _scheduler_stats_line() -> str:
+    if JOB_SCHEDULER is None:
+        return ""
+    ss = JOB_SCHEDULER.stats()
+    nxt = "-" if ss["next_in_sec"] is None else f"{int(ss['next_in_sec'])}s"
+    return f"\n{GLASS_DOT} jobs: {ss['pending']} scheduled | next in {nxt} | {ss['items']} run in {ss['runs']} batches"
+
+
+def _hcloud_budget_line() -> str:
+    if HCLOUD_API is None:
+        return ""
+    gs = HCLOUD_API.governor.stats()
+    by_class = " | ".join(
+        f"{p} {c['last_hour']}" + (f" (deferred {c['deferred']})" if c["deferred"] else "")
+        for p, c in gs["classes"].items()
+    )
+    return (
+        f"\n{GLASS_DOT} Hetzner API: {gs['remaining']}/{gs['limit']} left | 429s {gs['throttled']}"
+        f"\n{GLASS_DOT} last hour: {by_class}"
+    )
+
+
+def _catalog_stats_line() -> str:
+    parts = []
+    for c in HCLOUD_CATALOGS:
+        cs = c.stats()
+        age = "-" if cs["age_sec"] is None else f"{cs['age_sec']}s"
+        parts.append(f"{c.name}: age {age} | refreshes {cs['refreshes']} | errors {cs['errors']}")
+    for group, fs in SINGLE_FLIGHT.stats().items():
+        parts.append(f"single-flight {group}: issued {fs['issued']} | coalesced {fs['coalesced']}")
+    return "".join(f"\n{GLASS_DOT} {p}" for p in parts)
+
+
 @router.callback_query(F.data == "admin:stats")
 async def admin_stats(cq: CallbackQuery, db: DB):
     if not is_admin(cq.from_user.id):
         return await cq.answer("دسترسی ندارید.", show_alert=True)
     st = await db.stats()
+    ps = db.pool_stats()
+    pool_lines = "".join(
+        f"\n{GLASS_DOT} {kind}: in_use {p['in_use']}/{p['max_in_use']} | waits {p['waits']}/{p['acquires']} | avg {p['avg_wait_ms']}ms | max {p['max_wait_ms']}ms"
+        for kind, p in ((k, ps[k]) for k in ("reader", "writer"))
+    )
+    wq = ps["write_queue"]
+    warm_line = await _warm_pool_stats_line()
+    outbox_line = await _outbox_stats_line()
     await cq.message.edit_text(
-        f"{glass_header('آمار')}\n{GLASS_DOT} کاربران: {st['users']}\n{GLASS_DOT} کل سفارش‌ها: {st['orders']}\n{GLASS_DOT} فعال: {st['active_orders']}",
+        f"{glass_header('آمار')}\n{GLASS_DOT} کاربران: {st['users']}\n{GLASS_DOT} کل سفارش‌ها: {st['orders']}\n{GLASS_DOT} فعال: {st['active_orders']}"
+        f"\n\n{GLASS_DOT} DB pool ({ps['readers']} readers):{pool_lines}"
+        f"\n{GLASS_DOT} writes: {wq['ops']} ops / {wq['batches']} commits | avg batch {wq['avg_batch']} (max {wq['max_batch']})"
+        f" | commit avg {wq['avg_commit_ms']}ms | pending {wq['pending']} | failed {wq['failed']}"
+        f"{_scheduler_stats_line()}"
+        f"{_catalog_stats_line()}"
+        f"{_hcloud_budget_line()}"
+        f"{_provisioning_stats_line()}"
+        f"{warm_line}"
+        f"{_sender_stats_line()}"
+        f"{outbox_line}",
         reply_markup=kb([[("برگشت","admin:general")]])
     )
     await cq.answer()
 
+@router.callback_query(F.data == "admin:traffictop")
+async def admin_traffic_top(cq: CallbackQuery, db: DB):
+    if not is_admin(cq.from_user.id):
+        return await cq.answer("دسترسی ندارید.", show_alert=True)
+    rows = await db.top_traffic_orders(now_ts() - 7 * 86400, limit=15)
+    lines = [
+        f"{GLASS_DOT} #{r['order_id']} | {r['ip4'] or '-'} | {r['bytes_out'] / 1024**3:.1f} GB"
+        + (f" / {r['traffic_limit_gb']} GB" if r["traffic_limit_gb"] else "")
+        + f" | {r['status'] or '-'} | <code>{r['user_id']}</code>"
+        for r in rows
+    ]
+    await cq.message.edit_text(
+        f"{glass_header('مصرف ترافیک ۷ روز اخیر')}\n" + ("\n".join(lines) or f"{GLASS_DOT} داده‌ای ثبت نشده."),
+        parse_mode="HTML",
+        reply_markup=kb([[("برگشت", "admin:general")]]),
+    )
+    await cq.answer()
+
 @router.callback_query(F.data == "admin:users")
 async def admin_users(cq: CallbackQuery, state: FSMContext):
     if not is_admin(cq.from_user.id):
@@ -5554,7 +5459,7 @@ async def admin_users(cq: CallbackQuery, state: FSMContext):
     await cq.message.edit_text(
         f"{glass_header('کاربران')}\n{GLASS_DOT} انتخاب کن:",
         reply_markup=kb([
-            [("📣 پیام همگانی", "admin:broadcast")],
+            [("📣 پیام همگانی", "admin:broadcast"), ("📊 ارسال‌های همگانی", "admin:bc:list")],
             [("📋 لیست کاربران", "admin:userlist:0")],
             [("🔎 جستجو کاربر", "admin:usersearch")],
             [("برگشت","admin:general")]
@@ -5577,18 +5482,56 @@ async def admin_broadcast_send(msg: Message, db: DB, state: FSMContext):
     text = (msg.text or "").strip()
     if not text:
         return await msg.answer("متن خالی است.")
-    users = await db.list_all_users(limit=5000, offset=0)
-    sent = 0
-    for u in users:
-        if u["is_blocked"]:
-            continue
-        try:
-            await msg.bot.send_message(u["user_id"], text)
-            sent += 1
-        except Exception:
-            pass
     await state.clear()
-    await msg.answer(f"✅ ارسال شد به {sent} کاربر.", reply_markup=kb([[("🛠 پنل مدیریت","admin:home")],[("🏠 منوی اصلی","home")]]))
+    bid = await db.create_broadcast(text, created_by=msg.from_user.id)
+    b = await db.get_broadcast(bid)
+    pm = await msg.answer(broadcast_progress_text(b), parse_mode="HTML", reply_markup=broadcast_kb(b))
+    await db.set_broadcast_message(bid, pm.chat.id, pm.message_id)
+    if BROADCASTS is not None:
+        BROADCASTS.start(bid)
+
+@router.callback_query(F.data == "admin:bc:list")
+async def admin_broadcast_list(cq: CallbackQuery, db: DB):
+    if not is_admin(cq.from_user.id):
+        return await cq.answer("دسترسی ندارید.", show_alert=True)
+    rows = await db.list_broadcasts(10)
+    buttons = [
+        [(f"#{b['id']} | {BROADCAST_STATE_LABELS.get(b['state'], b['state'])} | {b['sent']}/{b['total']}", f"admin:bc:view:{b['id']}")]
+        for b in rows
+    ]
+    buttons.append([("📣 پیام همگانی جدید", "admin:broadcast")])
+    buttons.append([("برگشت", "admin:users")])
+    await cq.message.edit_text(
+        f"{glass_header('پیام‌های همگانی')}\n{GLASS_DOT} " + ("آخرین ارسال‌ها:" if rows else "هنوز ارسالی ثبت نشده."),
+        reply_markup=kb(buttons),
+    )
+    await cq.answer()
+
+@router.callback_query(F.data.regexp(r"^admin:bc:(view|pause|resume|cancel):\d+$"))
+async def admin_broadcast_action(cq: CallbackQuery, db: DB):
+    if not is_admin(cq.from_user.id):
+        return await cq.answer("دسترسی ندارید.", show_alert=True)
+    _, _, action, sbid = cq.data.split(":")
+    bid = int(sbid)
+    if action == "pause":
+        await db.set_broadcast_state(bid, "paused", ("running",))
+    elif action == "resume":
+        await db.set_broadcast_state(bid, "running", ("paused",))
+    elif action == "cancel":
+        await db.set_broadcast_state(bid, "cancelled", ("running", "paused"))
+    b = await db.get_broadcast(bid)
+    if not b:
+        return await cq.answer("یافت نشد.", show_alert=True)
+    if b["state"] == "running" and BROADCASTS is not None:
+        # no-op if a runner (here or in the other process) already has it
+        BROADCASTS.start(bid)
+    # live updates follow the message the admin is looking at
+    await db.set_broadcast_message(bid, cq.message.chat.id, cq.message.message_id)
+    try:
+        await cq.message.edit_text(broadcast_progress_text(b), parse_mode="HTML", reply_markup=broadcast_kb(b))
+    except Exception:
+        pass
+    await cq.answer()
 
 @router.callback_query(F.data == "admin:active")
 async def admin_active(cq: CallbackQuery, db: DB):
@@ -5670,14 +5613,9 @@ async def admin_order_delete_confirm(cq: CallbackQuery, db: DB):
         cost_minutes = int(math.ceil((minutes / 60.0) * rate)) if minutes > 0 else 0
         extra_cost = int(cost_full + cost_minutes)
 
-        u = await db.get_user(int(o["user_id"]))
-        bal = int(u["balance_irt"]) if u else 0
-        if extra_cost > 0 and bal < extra_cost:
-            return await cq.answer("موجودی کاربر برای تسویه دقایق استفاده کافی نیست.", show_alert=True)
-
         if extra_cost > 0:
-            await db.add_balance(int(o["user_id"]), -extra_cost)
-            await db.create_invoice(int(o["user_id"]), -extra_cost, "wallet", f"Hourly settle on admin delete order#{oid}", "paid")
+            if await db.debit_wallet(int(o["user_id"]), extra_cost, f"Hourly settle on admin delete order#{oid}", order_id=oid, reason="settle") is None:
+                return await cq.answer("موجودی کاربر برای تسویه دقایق استفاده کافی نیست.", show_alert=True)
         try:
             await db.update_order_hourly_tick(oid, now, int(o.get("last_warn_at") or 0))
             await db.set_last_billed_hour(oid, int(now // 3600))
@@ -5686,33 +5624,24 @@ async def admin_order_delete_confirm(cq: CallbackQuery, db: DB):
 
     if sid:
         try:
-            hcloud_delete_server(int(sid))
+            await hcloud_delete_server(int(sid))
         except Exception as e:
             # Still mark as deleted in DB (server may already be removed at provider).
-            try:
-                for aid in ADMIN_IDS:
-                    await cq.bot.send_message(aid, f"⚠️ خطا در حذف سرور در Hetzner برای سفارش #{oid}: {e}\nبا این حال در دیتابیس حذف شد.")
-            except Exception:
-                pass
-
-    await db.set_order_status(oid, "deleted")
+            notify_admins(cq.bot, f"⚠️ خطا در حذف سرور در Hetzner برای سفارش #{oid}: {e}\nبا این حال در دیتابیس حذف شد.")
 
-    # report to admins
-    try:
-        uname = (cq.from_user.username or "")
-        actor_name = f"{cq.from_user.full_name}" + (f" (@{uname})" if uname else "")
-        await send_admin_delete_report(
-            cq.bot,
-            db,
-            user_id=int(o["user_id"]),
-            order=o,
-            reason="admin_delete",
-            actor_id=int(cq.from_user.id),
-            actor_name=actor_name,
-            extra_cost_irt=int(extra_cost or 0),
-        )
-    except Exception:
-        pass
+    # report to admins, queued with the status change
+    uname = (cq.from_user.username or "")
+    actor_name = f"{cq.from_user.full_name}" + (f" (@{uname})" if uname else "")
+    report = await admin_delete_report(
+        db,
+        user_id=int(o["user_id"]),
+        order=o,
+        reason="admin_delete",
+        actor_id=int(cq.from_user.id),
+        actor_name=actor_name,
+        extra_cost_irt=int(extra_cost or 0),
+    )
+    await db.set_order_status(oid, "deleted", notices=report)
 
     msg = "✅ سرور حذف شد."
     if billing == "hourly" and extra_cost > 0:
@@ -5764,16 +5693,16 @@ async def admin_order_action(cq: CallbackQuery, db: DB):
     sid = int(o["hcloud_server_id"])
     try:
         if act == "off":
-            hcloud_power_action(sid, "poweroff")
+            await hcloud_power_action(sid, "poweroff")
             await cq.answer("خاموش شد.")
         elif act == "on":
-            hcloud_power_action(sid, "poweron")
+            await hcloud_power_action(sid, "poweron")
             await cq.answer("روشن شد.")
         elif act == "rebuild":
-            hcloud_power_action(sid, "rebuild")
+            await hcloud_power_action(sid, "rebuild")
             await cq.answer("ریبلد شروع شد.")
         elif act == "resetpw":
-            pw = hcloud_reset_password(sid)
+            pw = await hcloud_reset_password(sid)
             await cq.bot.send_message(cq.from_user.id, f"🔐 پسورد جدید:\n`{pw}`", parse_mode="Markdown")
             await cq.answer("ارسال شد.")
         elif act == "traffic":
@@ -5781,7 +5710,9 @@ async def admin_order_action(cq: CallbackQuery, db: DB):
                 await cq.answer("نامحدود است.", show_alert=True)
             else:
                 remain = max(0.0, float(o["traffic_limit_gb"]) - float(o["traffic_used_gb"]))
-                await cq.answer(f"باقی‌مانده: {remain:.1f} GB")
+                days = await db.order_traffic_daily(oid, now_ts() - 6 * 86400)
+                per_day = " ".join(f"{b / 1024**3:.1f}" for _, b in days) or "-"
+                await cq.answer(f"باقی‌مانده: {remain:.1f} GB\n۷ روز (GB/روز): {per_day}", show_alert=True)
         else:
             await cq.answer("نامعتبر.", show_alert=True)
     except Exception as e:
@@ -5799,6 +5730,8 @@ async def admin_pay_approve(cq: CallbackQuery, db: DB):
         return await cq.answer("قبلاً تایید شده.", show_alert=True)
     if cp["status"] == "rejected":
         return await cq.answer("قبلاً رد شده.", show_alert=True)
+    if cp["status"] == "provisioning":
+        return await cq.answer("تایید شده و سرور در حال ساخت است.", show_alert=True)
 
     payload = {}
     try:
@@ -5812,55 +5745,31 @@ async def admin_pay_approve(cq: CallbackQuery, db: DB):
     if payload.get("type") == "topup":
         amount = int(payload.get("amount") or 0)
         if amount <= 0:
-            await db.set_card_purchase_status(inv_id, "rejected")
-            await db.set_invoice_status(inv_id, "rejected")
+            await db.resolve_card_purchase(inv_id, "rejected")
             return await cq.answer("مبلغ نامعتبر.", show_alert=True)
 
-        await db.add_balance(user_id, amount)
-        await db.set_card_purchase_status(inv_id, "approved")
-        await db.set_invoice_status(inv_id, "paid")
-        # notify user + admins
+        # credit, status and messages in one transaction; the outbox sends them
+        # (an undeliverable user message is reported to admins by _outbox_dead)
         user_msg = (
             f"✅ رسید شما تایید شد و کیف پول شارژ شد.\n"
             f"شماره فاکتور: #{inv_id}\n"
             f"مبلغ: {money(amount)}"
         )
-        sent_ok = True
-        try:
-            await cq.bot.send_message(user_id, user_msg)
-        except Exception:
-            sent_ok = False
-
-        # report to admins (including the approver)
-        try:
-            uname = (cq.from_user.username or "")
-            approver = f"{cq.from_user.full_name}" + (f" (@{uname})" if uname else "")
-            rep = (
-                "🧾 گزارش شارژ کیف پول\n"
-                f"کاربر: {user_id}\n"
-                f"مبلغ: {money(amount)}\n"
-                f"فاکتور: #{inv_id}\n"
-                f"تایید توسط: {approver}"
-            )
-            for aid in ADMIN_IDS:
-                try:
-                    await cq.bot.send_message(aid, rep)
-                except Exception:
-                    pass
-        except Exception:
-            pass
-
-        if not sent_ok:
-            try:
-                await cq.bot.send_message(cq.message.chat.id, "⚠️ شارژ انجام شد ولی نتونستم به کاربر پیام بدم (ممکنه ربات رو بلاک کرده باشه).")
-            except Exception:
-                pass
-
-
-        try:
-            await cq.bot.send_message(user_id, f"✅ شارژ انجام شد.\nمبلغ: {money(amount)}")
-        except Exception:
-            pass
+        uname = (cq.from_user.username or "")
+        approver = f"{cq.from_user.full_name}" + (f" (@{uname})" if uname else "")
+        rep = (
+            "🧾 گزارش شارژ کیف پول\n"
+            f"کاربر: {user_id}\n"
+            f"مبلغ: {money(amount)}\n"
+            f"فاکتور: #{inv_id}\n"
+            f"تایید توسط: {approver}"
+        )
+        key = f"receipt:{inv_id}:approved"
+        if not await db.resolve_card_purchase(
+            inv_id, "approved", credit_irt=amount,
+            notices=[notice(user_id, user_msg, key), *admin_notices(rep, key)],
+        ):
+            return await cq.answer("قبلاً بررسی شده.", show_alert=True)
         try:
             await cq.message.edit_text("✅ تایید شد و موجودی شارژ شد.")
         except Exception:
@@ -5877,23 +5786,21 @@ async def admin_pay_approve(cq: CallbackQuery, db: DB):
         pid = int(payload.get("package_id") or 0)
         pkg = await db.get_traffic_package(pid)
         if oid <= 0 or not pkg or not pkg.get('is_active'):
-            await db.set_card_purchase_status(inv_id, "rejected")
-            await db.set_invoice_status(inv_id, "rejected")
+            await db.resolve_card_purchase(inv_id, "rejected")
             return await cq.answer("پکیج/سرویس نامعتبر.", show_alert=True)
 
         amount = int(await get_invoice_amount(db, inv_id) or int(pkg.get('price_irt') or 0))
 
-        await db.set_card_purchase_status(inv_id, "approved")
-        await db.set_invoice_status(inv_id, "paid")
+        if not await db.resolve_card_purchase(inv_id, "approved"):
+            return await cq.answer("قبلاً بررسی شده.", show_alert=True)
 
-        await db.add_order_traffic_limit(oid, int(pkg['volume_gb']))
+        await db.add_order_traffic_limit(oid, int(pkg['volume_gb']), notices=[notice(
+            user_id,
+            f"✅ رسید شما تایید شد و {pkg['volume_gb']}GB به سقف ترافیک سرویس #{oid} اضافه شد.",
+            f"receipt:{inv_id}:approved",
+        )])
         await db.create_traffic_purchase(user_id=user_id, order_id=oid, package_id=pid, volume_gb=int(pkg['volume_gb']), price_irt=amount, invoice_id=inv_id, status='paid')
 
-        try:
-            await cq.bot.send_message(user_id, f"✅ رسید شما تایید شد و {pkg['volume_gb']}GB به سقف ترافیک سرویس #{oid} اضافه شد.")
-        except Exception:
-            pass
-
         try:
             await cq.message.edit_text("✅ تایید شد (حجم اضافه اعمال شد).")
         except Exception:
@@ -5904,12 +5811,9 @@ async def admin_pay_approve(cq: CallbackQuery, db: DB):
     if payload.get("type") == "manual":
         plan = await db.get_plan(int(payload.get("plan_id") or 0))
         if not plan or not plan.get("is_active"):
-            await db.set_card_purchase_status(inv_id, "rejected")
-            await db.set_invoice_status(inv_id, "rejected")
-            try:
-                await cq.bot.send_message(user_id, "❌ پلن نامعتبر شد. لطفاً دوباره خرید را انجام بده.")
-            except Exception:
-                pass
+            await db.resolve_card_purchase(inv_id, "rejected", notices=[
+                notice(user_id, "❌ پلن نامعتبر شد. لطفاً دوباره خرید را انجام بده.", f"receipt:{inv_id}:rejected")
+            ])
             return await cq.answer("پلن نامعتبر.", show_alert=True)
 
         now = int(time.time())
@@ -5930,24 +5834,18 @@ async def admin_pay_approve(cq: CallbackQuery, db: DB):
             status='pending_manual',
             expires_at=exp,
         )
-        await db.attach_invoice_to_order(inv_id, oid)
-        await db.set_card_purchase_status(inv_id, "approved")
-        await db.set_invoice_status(inv_id, "paid")
-
-        try:
-            await cq.bot.send_message(user_id, f"✅ پرداخت تایید شد. سفارش شما ثبت شد و در انتظار ساخت است. زمان تحویل 1 دقیقه الی 1 ساعت🕐\nشماره سرویس: #{oid}")
-        except Exception:
-            pass
-
-        for aid in ADMIN_IDS:
-            try:
-                await cq.bot.send_message(
-                    aid,
-                    f"🧾 سفارش دستی جدید\nکاربر: {user_id}\nسرویس: #{oid}\nپلن: {plan.get('server_type')}\nلوکیشن: {payload.get('location')}\nOS: {payload.get('os')}\nفاکتور: #{inv_id}",
-                    reply_markup=kb([[('✅ تحویل و ارسال', f'admin:manual:deliver:{oid}')],[('⬅️ پنل مدیریت','admin:home')]]),
-                )
-            except Exception:
-                pass
+        key = f"receipt:{inv_id}:approved"
+        if not await db.resolve_card_purchase(inv_id, "approved", order_id=oid, notices=[
+            notice(user_id, f"✅ پرداخت تایید شد. سفارش شما ثبت شد و در انتظار ساخت است. زمان تحویل 1 دقیقه الی 1 ساعت🕐\nشماره سرویس: #{oid}", key),
+            *admin_notices(
+                f"🧾 سفارش دستی جدید\nکاربر: {user_id}\nسرویس: #{oid}\nپلن: {plan.get('server_type')}\nلوکیشن: {payload.get('location')}\nOS: {payload.get('os')}\nفاکتور: #{inv_id}",
+                key,
+                reply_markup=kb([[('✅ تحویل و ارسال', f'admin:manual:deliver:{oid}')],[('⬅️ پنل مدیریت','admin:home')]]),
+            ),
+        ]):
+            # approved by a concurrent click; drop the duplicate order
+            await db.delete_order(oid)
+            return await cq.answer("قبلاً بررسی شده.", show_alert=True)
 
         try:
             await cq.message.edit_text("✅ تایید شد (سفارش دستی ثبت شد).")
@@ -5958,121 +5856,26 @@ async def admin_pay_approve(cq: CallbackQuery, db: DB):
     # ---- VPS approve (build server) ----
     plan = await db.get_plan(int(payload["plan_id"]))
     if not plan or not plan["is_active"]:
-        await db.set_card_purchase_status(inv_id, "rejected")
-        await db.set_invoice_status(inv_id, "rejected")
-        try:
-            await cq.bot.send_message(user_id, "❌ پلن نامعتبر شد. لطفاً دوباره خرید را انجام بده.")
-        except Exception:
-            pass
+        await db.resolve_card_purchase(inv_id, "rejected", notices=[
+            notice(user_id, "❌ پلن نامعتبر شد. لطفاً دوباره خرید را انجام بده.", f"receipt:{inv_id}:rejected")
+        ])
         return await cq.answer("پلن نامعتبر.", show_alert=True)
 
-    # Inform user and show a progress percentage while the server is being built
-    progress_msg = None
-    try:
-        progress_msg = await cq.bot.send_message(user_id, f"{glass_header('در حال ساخت سرور')}\n{GLASS_DOT} پیشرفت: <b>0%</b>\n{GLASS_DOT} شروع…", parse_mode="HTML")
-    except Exception:
-        progress_msg = None
+    # the build runs in a provisioning worker; the job is queued with the status
+    # change, the user's progress message is attached once it is sent
+    job_id = await db.start_card_provisioning(inv_id, await get_invoice_amount_irt(db, inv_id), payload)
+    if job_id is None:
+        return await cq.answer("قبلاً بررسی شده.", show_alert=True)
+    progress_msg = await notify(cq.bot, user_id, f"{glass_header('در حال ساخت سرور')}\n{GLASS_DOT} پیشرفت: <b>0%</b>\n{GLASS_DOT} شروع…", parse_mode="HTML")
+    if progress_msg:
+        await _edit_progress(progress_msg, 10, 'در حال آماده‌سازی سفارش…')
+    await start_provisioning(db, job_id, progress_msg)
 
     try:
-        if progress_msg:
-            await _edit_progress(progress_msg, 10, 'در حال آماده‌سازی سفارش…')
-            await _edit_progress(progress_msg, 30, 'انتخاب ایمیج سیستم‌عامل…')
-            await _edit_progress(progress_msg, 70, 'در حال ساخت سرور روی Hetzner…')
-
-        client = hclient()
-        img = find_matching_image(client, payload["os"])
-        if not img:
-            raise RuntimeError("Image not found")
-        server_id, ip4, root_pw = hcloud_create_server(
-            name=payload.get("server_name", "vps"),
-            server_type=plan["server_type"],
-            image_id=img.id,
-            location_name=payload.get("location", ""),
-        )
-
-        # Wait until running + IPv4 is assigned (with visible progress when possible)
-        if progress_msg:
-            ip_ready, _st = await hcloud_wait_running_with_progress(progress_msg, int(server_id), timeout_sec=240, start_percent=75, end_percent=99)
-            if ip_ready:
-                ip4 = ip_ready
-            await _edit_progress(progress_msg, 100, 'سرور آماده شد ✅')
-    except Exception as e:
-        await db.set_card_purchase_status(inv_id, "rejected")
-        await db.set_invoice_status(inv_id, "rejected")
-        try:
-            await cq.bot.send_message(user_id, f"❌ خطا در ساخت سرور: {e}")
-        except Exception:
-            pass
-        return await cq.answer("خطا در ساخت.", show_alert=True)
-
-    now = int(time.time())
-    expires_at = int((datetime.fromtimestamp(now, TZ) + timedelta(days=30)).timestamp())
-    traffic_gb = int(plan.get("traffic_limit_gb") or 0)
-    billing = payload.get("billing", "monthly")
-
-    eff = await plan_effective_prices(db, plan)
-    oid = await db.create_order(
-        user_id=user_id,
-        plan_id=int(plan["id"]),
-        provider=payload.get("provider",""),
-        country=payload.get("country",""),
-        location=payload.get("location",""),
-        os_name=payload.get("os",""),
-        server_type=plan["server_type"],
-        hcloud_server_id=str(server_id),
-        ip4=str(ip4),
-        root_password=str(root_pw),
-        billing_mode=billing,
-        traffic_limit_gb=traffic_gb,
-        expires_at=expires_at,
-        status="active",
-        price_monthly_irt=int(eff['monthly_irt'] or 0),
-        price_hourly_irt=int(eff['hourly_irt'] or 0),
-    )
-    await db.attach_invoice_to_order(inv_id, oid)
-
-    # Initialize hourly counters to avoid retroactive charges
-    if (billing or "").lower() == "hourly" and int(plan.get("price_hourly_irt") or 0) > 0:
-        try:
-            current_hour = int(now // 3600)
-            await db.set_last_billed_hour(oid, current_hour)
-            await db.update_order_hourly_tick(oid, now, 0)
-        except Exception:
-            pass
-
-    await db.set_card_purchase_status(inv_id, "approved")
-    await db.set_invoice_status(inv_id, "paid")
-
-    # Report to admins after successful build
-    amount_irt = await get_invoice_amount_irt(db, inv_id)
-    await send_admin_purchase_report(
-        cq.bot,
-        db,
-        user_id=user_id,
-        order_id=oid,
-        ip4=str(ip4),
-        pay_method="card",
-        amount_irt=amount_irt,
-        plan_name=str(plan["server_type"]),
-        billing=str(billing),
-    )
-
-    try:
-        await cq.bot.send_message(
-            user_id,
-            f"{glass_header('تحویل سرویس')}\n"
-            f"{GLASS_DOT} IP: <code>{ip4}</code>\n"
-            f"{GLASS_DOT} USER: <code>root</code>\n"
-            f"{GLASS_DOT} PASS: <code>{root_pw}</code>\n"
-            f"{GLASS_DOT} انقضا: {fmt_dt(expires_at)}\n",
-            parse_mode="HTML",
-            reply_markup=kb([[("📦 سفارش‌های من","me:orders")],[("🏠 منوی اصلی","home")]])
-        )
+        await cq.message.edit_text(f"✅ تایید شد. ساخت سرور در صف است (job #{job_id}).")
     except Exception:
         pass
-
-    await cq.message.edit_text("✅ تایید شد و سرور ساخته شد.")
-    await cq.answer("ساخته شد.", show_alert=True)
+    await cq.answer("تایید شد؛ سرور در حال ساخت است.", show_alert=True)
 
 @router.callback_query(F.data.startswith("admin:pay:reject:"))
 async def admin_pay_reject(cq: CallbackQuery, db: DB):
@@ -6084,14 +5887,15 @@ async def admin_pay_reject(cq: CallbackQuery, db: DB):
         return await cq.answer("یافت نشد.", show_alert=True)
     if cp["status"] == "approved":
         return await cq.answer("قبلاً تایید شده.", show_alert=True)
+    if cp["status"] == "provisioning":
+        return await cq.answer("تایید شده و سرور در حال ساخت است.", show_alert=True)
 
-    await db.set_card_purchase_status(inv_id, "rejected")
-    await db.set_invoice_status(inv_id, "rejected")
-
-    try:
-        await cq.bot.send_message(int(cp["user_id"]), f"❌ رسید فاکتور #{inv_id} رد شد. لطفاً دوباره رسید صحیح ارسال کن یا با پشتیبانی هماهنگ کن.")
-    except Exception:
-        pass
+    if not await db.resolve_card_purchase(inv_id, "rejected", notices=[notice(
+        int(cp["user_id"]),
+        f"❌ رسید فاکتور #{inv_id} رد شد. لطفاً دوباره رسید صحیح ارسال کن یا با پشتیبانی هماهنگ کن.",
+        f"receipt:{inv_id}:rejected",
+    )]):
+        return await cq.answer("قبلاً بررسی شده.", show_alert=True)
 
     await cq.answer("رد شد.")
     try:
@@ -6171,11 +5975,9 @@ async def admin_act_extend(cq: CallbackQuery, db: DB):
     if not o:
         return await cq.answer("یافت نشد.", show_alert=True)
     new_exp = int((datetime.fromtimestamp(o["expires_at"], TZ) + timedelta(days=30)).timestamp())
-    await db.update_order_status_and_expiry(oid, "active", new_exp)
-    try:
-        await cq.bot.send_message(o["user_id"], f"♻️ سرویس شما توسط مدیر تمدید شد تا {fmt_dt(new_exp)}")
-    except Exception:
-        pass
+    await db.update_order_status_and_expiry(oid, "active", new_exp, notices=[
+        notice(o["user_id"], f"♻️ سرویس شما توسط مدیر تمدید شد تا {fmt_dt(new_exp)}", f"extended:{oid}:{new_exp}")
+    ])
     await cq.answer("تمدید شد.")
     # refresh view
     await admin_order_view(cq, db)
@@ -6225,125 +6027,16 @@ async def try_resume_suspended_hourly(bot_: Bot, db: DB, user_id: int):
         rate = int(o.get("price_hourly_irt") or 0)
         # Resume only after user has a safe buffer.
         if rate > 0 and bal >= HOURLY_WARN_BALANCE:
-            await db.clear_order_suspension(int(o["id"]))
-            try:
-                if o.get("hcloud_server_id"):
-                    hcloud_power_action(int(o["hcloud_server_id"]), "poweron")
-            except Exception:
-                pass
-            try:
-                await bot_.send_message(user_id, f"✅ موجودی شارژ شد و سرویس ساعتی شما فعال شد.\nIP: {o.get('ip4','-')}")
-            except Exception:
-                pass
-            for aid in ADMIN_IDS:
-                try:
-                    await bot_.send_message(aid, f"✅ فعال‌سازی مجدد سرویس ساعتی بعد از شارژ\nکاربر: {user_id}\nIP: {o.get('ip4','-')}\nOrder: #{o['id']}")
-                except Exception:
-                    pass
-
-async def hourly_billing_job(bot_: Bot, db: DB):
-    now = int(time.time())
-    orders = await db.list_hourly_orders(limit=500)
-    for o in orders:
-        uid = int(o["user_id"])
-        rate = int(o.get("price_hourly_irt") or 0)
-        if rate <= 0:
-            continue
-        user = await db.get_user(uid)
-        bal = int(user["balance_irt"]) if user else 0
-
-        delete_at = int(o.get("delete_at") or 0)
-        if o["status"] == "suspended_balance" and delete_at and now >= delete_at:
+            key = f"resumed:{o['id']}:{o.get('suspended_at') or 0}"
+            await db.clear_order_suspension(int(o["id"]), notices=[
+                notice(user_id, f"✅ موجودی شارژ شد و سرویس ساعتی شما فعال شد.\nIP: {o.get('ip4','-')}", key),
+                *admin_notices(f"✅ فعال‌سازی مجدد سرویس ساعتی بعد از شارژ\nکاربر: {user_id}\nIP: {o.get('ip4','-')}\nOrder: #{o['id']}", key),
+            ])
             try:
                 if o.get("hcloud_server_id"):
-                    hcloud_delete_server(int(o["hcloud_server_id"]))
-            except Exception:
-                pass
-            await db.update_order_status_and_expiry(int(o["id"]), "deleted", now)
-            try:
-                await bot_.send_message(uid, f"🗑 سرویس شما به دلیل عدم شارژ در 24 ساعت گذشته حذف شد.\nIP: {o.get('ip4','-')}")
-            except Exception:
-                pass
-            # report to admins (full details)
-            try:
-                full_o = await db.get_order(int(o["id"]))
-                await send_admin_delete_report(
-                    bot_,
-                    db,
-                    user_id=uid,
-                    order=full_o or o,
-                    reason="auto_hourly_no_balance_24h",
-                    actor_id=None,
-                    actor_name="سیستم (auto)",
-                    extra_cost_irt=0,
-                )
-            except Exception:
-                pass
-            continue
-
-        warn_threshold = rate * 3
-        last_warn = int(o.get("last_warn_at") or 0)
-        if o["status"] == "active" and bal <= warn_threshold and now - last_warn >= 3600:
-            await db.update_order_hourly_tick(int(o["id"]), int(o.get("last_hourly_charge_at") or 0), now)
-            hours_left = max(0, bal // rate)
-            try:
-                await bot_.send_message(uid,
-                    f"⚠️ هشدار کمبود موجودی ساعتی\nIP: {o.get('ip4','-')}\n"
-                    f"نرخ ساعتی: {money(rate)}\nموجودی: {money(bal)}\n"
-                    f"تقریباً {hours_left} ساعت باقی مانده.\n"
-                    f"برای جلوگیری از قطع، موجودی را شارژ کن.",
-                    reply_markup=kb([[('➕ افزایش موجودی','me:topup')]])
-                )
+                    await hcloud_power_action(int(o["hcloud_server_id"]), "poweron")
             except Exception:
                 pass
-            for aid in ADMIN_IDS:
-                try:
-                    await bot_.send_message(aid, f"⚠️ هشدار کمبود موجودی\nکاربر: {uid}\nIP: {o.get('ip4','-')}\nموجودی: {money(bal)}\nنرخ: {money(rate)}")
-                except Exception:
-                    pass
-
-        if o["status"] == "active":
-            last_charge = int(o.get("last_hourly_charge_at") or 0)
-            if last_charge == 0:
-                last_charge = now
-                await db.update_order_hourly_tick(int(o["id"]), last_charge, int(o.get("last_warn_at") or 0))
-            if now - last_charge >= 3600:
-                if bal >= rate:
-                    await db.add_balance(uid, -rate)
-                    await db.update_order_hourly_tick(int(o["id"]), now, int(o.get("last_warn_at") or 0))
-                    for aid in ADMIN_IDS:
-                        try:
-                            await bot_.send_message(aid, f"💸 کسر ساعتی\nکاربر: {uid}\nIP: {o.get('ip4','-')}\nمبلغ: {money(rate)}")
-                        except Exception:
-                            pass
-                else:
-                    try:
-                        if o.get("hcloud_server_id"):
-                            hcloud_power_action(int(o["hcloud_server_id"]), "poweroff")
-                    except Exception:
-                        pass
-                    del_at = now + 24*3600
-                    await db.set_order_suspended_balance(int(o["id"]), now, del_at)
-                    try:
-                        await bot_.send_message(uid,
-                            f"⛔️ سرویس ساعتی شما به علت اتمام موجودی خاموش شد.\n"
-                            f"IP: {o.get('ip4','-')}\n"
-                            f"تا 24 ساعت آینده شارژ نکنی حذف می‌شود.\n"
-                            f"زمان حذف: {fmt_dt(del_at)}",
-                            reply_markup=kb([[('➕ افزایش موجودی','me:topup')],[('📦 سفارش‌های من','me:orders')]])
-                        )
-                    except Exception:
-                        pass
-                    for aid in ADMIN_IDS:
-                        try:
-                            await bot_.send_message(aid,
-                                f"⛔️ قطع به علت اتمام موجودی\n"
-                                f"کاربر: {uid}\nOrder: #{o['id']}\nIP: {o.get('ip4','-')}\n"
-                                f"نرخ ساعتی: {money(rate)}\nموجودی: {money(bal)}\n"
-                                f"حذف در: {fmt_dt(del_at)}"
-                            )
-                        except Exception:
-                            pass
 
 
 # -------------------------
@@ -6375,11 +6068,9 @@ async def daily_db_backup_loop(db: DB, bot: Bot):
                         path = db.get_latest_backup(DB_BACKUP_DIR, prefix=DB_BACKUP_PREFIX)
                     if path and os.path.exists(path):
                         cap = f"🗄 بکاپ دیتابیس (خودکار)\n{GLASS_DOT} فایل: <code>{htmlesc(os.path.basename(path))}</code>"
+                        q = send_queue(bot)
                         for aid in ADMIN_IDS:
-                            try:
-                                await bot.send_document(aid, FSInputFile(path), caption=cap, parse_mode='HTML')
-                            except Exception:
-                                pass
+                            q.submit("send_document", aid, "bulk", document=FSInputFile(path), caption=cap, parse_mode='HTML')
             except Exception:
                 pass
 
@@ -6387,134 +6078,617 @@ async def daily_db_backup_loop(db: DB, bot: Bot):
             # if loop fails, wait a bit and retry
             await asyncio.sleep(60)
 
-async def job_loop(db: DB, bot: Bot):
-    while True:
+JOB_LIMITS: Dict[str, asyncio.Semaphore] = {
+    "metrics": asyncio.Semaphore(max(1, JOB_CONCURRENCY_METRICS)),
+    "power": asyncio.Semaphore(max(1, JOB_CONCURRENCY_POWER)),
+}
+
+
+async def job_power(server_id: int, action: str) -> bool:
+    """hcloud_power_action limited per kind; False on error."""
+    async with JOB_LIMITS["power"]:
         try:
-            bot_enabled = (await db.get_setting("bot_enabled", "1")) == "1"
-            if not bot_enabled:
-                await asyncio.sleep(5)
-                continue
+            await hcloud_power_action(int(server_id), action)
+            return True
+        except Exception:
+            return False
 
-            orders = await db.list_active_orders()
-            for o in orders:
-                order = await db.get_order(o["id"])
-                if not order or not order["hcloud_server_id"]:
-                    continue
-                sid = int(order["hcloud_server_id"])
 
-                # monthly expiry
-                if order["billing_mode"] == "monthly" and now_ts() >= order["expires_at"]:
-                    try:
-                        hcloud_power_action(sid, "poweroff")
-                    except Exception:
-                        pass
-                    await db.set_order_status(order["id"], "suspended")
-                    try:
-                        await bot.send_message(order["user_id"], "⛔️ سرویس شما به دلیل اتمام زمان، متوقف شد. برای تمدید با پشتیبانی تماس بگیر.")
-                    except Exception:
-                        pass
-                    continue
+async def job_network_series(server_id: int, start: datetime, end: datetime) -> Optional[List[Tuple[int, float]]]:
+    async with JOB_LIMITS["metrics"]:
+        try:
+            return await hcloud_get_network_series(int(server_id), start, end)
+        except Exception:
+            return None
+
 
-                # hourly billing (wallet thresholds + accurate elapsed-time billing)
-                if order["billing_mode"] == "hourly" and int(order.get("price_hourly_irt") or 0) > 0:
-                    rate = int(order.get("price_hourly_irt") or 0)
-                    u = await db.get_user(order["user_id"])
-                    bal = int(u["balance_irt"]) if u else 0
-
-                    # 1) low-balance warning at 20k
-                    last_warn_at = int(order.get("last_warn_at") or 0)
-                    if bal <= HOURLY_WARN_BALANCE and (time.time() - last_warn_at) >= 3600:
-                        try:
-                            await db.update_order_hourly_tick(int(order["id"]), int(order.get("last_hourly_charge_at") or 0), int(time.time()))
-                        except Exception:
-                            pass
-                        try:
-                            await bot.send_message(
-                                order["user_id"],
-                                f"⚠️ موجودی شما به {money(bal)} رسید. لطفاً موجودی را افزایش دهید وگرنه سرور قطع می‌شود.\nIP: {order.get('ip4','-')}",
-                                reply_markup=kb([[('➕ افزایش موجودی','me:topup')]]),
-                            )
-                        except Exception:
-                            pass
-
-                    # 2) hard cutoff at 5k (poweroff + lock)
-                    if bal <= HOURLY_CUTOFF_BALANCE:
-                        try:
-                            hcloud_power_action(sid, "poweroff")
-                        except Exception:
-                            pass
-                        try:
-                            await db.set_order_suspended_balance(int(order["id"]), int(time.time()), 0)
-                        except Exception:
-                            await db.set_order_status(int(order["id"]), "suspended_balance")
-                        try:
-                            await bot.send_message(
-                                order["user_id"],
-                                f"⛔️ به دلیل رسیدن موجودی به {money(bal)}، سرویس ساعتی شما قطع شد و تا زمان شارژ دوباره روشن نمی‌شود.\nIP: {order.get('ip4','-')}",
-                                reply_markup=kb([[('➕ افزایش موجودی','me:topup')],[('📦 سفارش‌های من','me:orders')]]),
-                            )
-                        except Exception:
-                            pass
-                        continue
-
-                    # 3) charge passed full hours since last charge timestamp
-                    now = int(time.time())
-                    last_charge_at = int(order.get("last_hourly_charge_at") or 0)
-                    if last_charge_at <= 0:
-                        # fallback for older rows
-                        last_charge_at = int(order.get("purchased_at") or now)
-                        try:
-                            await db.update_order_hourly_tick(int(order["id"]), last_charge_at, last_warn_at)
-                        except Exception:
-                            pass
-
-                    elapsed = max(0, now - last_charge_at)
-                    hours = int(elapsed // 3600)
-                    if hours > 0:
-                        cost = int(hours * rate)
-                        if bal < cost:
-                            try:
-                                hcloud_power_action(sid, "poweroff")
-                            except Exception:
-                                pass
-                            await db.set_order_suspended_balance(int(order["id"]), now, 0)
-                            try:
-                                await bot.send_message(order["user_id"], "⛔️ سرویس ساعتی به دلیل کمبود موجودی متوقف شد.")
-                            except Exception:
-                                pass
-                        else:
-                            await db.add_balance(order["user_id"], -cost)
-                            await db.create_invoice(order["user_id"], cost, "wallet", f"Hourly charge order#{order['id']} ({hours}h)", "paid")
-                            new_last_charge = int(last_charge_at + hours * 3600)
-                            try:
-                                await db.update_order_hourly_tick(int(order["id"]), new_last_charge, last_warn_at)
-                                await db.set_last_billed_hour(int(order["id"]), int(new_last_charge // 3600))
-                            except Exception:
-                                pass
-
-                # traffic check
-                if order["traffic_limit_gb"] and order["traffic_limit_gb"] > 0:
-                    end = datetime.now(timezone.utc)
-                    start = datetime.fromtimestamp(order["purchased_at"], tz=timezone.utc)
-                    bytes_out = hcloud_get_network_bytes(sid, start, end)
-                    if bytes_out is not None:
-                        used_gb = bytes_out / (1024**3)
-                        await db.update_order_traffic(order["id"], float(used_gb), now_ts())
-                        if used_gb >= float(order["traffic_limit_gb"]):
-                            try:
-                                hcloud_power_action(sid, "poweroff")
-                            except Exception:
-                                pass
-                            await db.set_order_status(order["id"], "suspended")
-                            try:
-                                await bot.send_message(order["user_id"], f"⛔️ سرویس شما به دلیل رسیدن به سقف ترافیک ({order['traffic_limit_gb']}GB) متوقف شد.")
-                            except Exception:
-                                pass
+def _billing_notices(ev: Dict[str, Any], now: int) -> List[Dict[str, Any]]:
+    """User notifications for one run_hourly_billing event (queued in the billing transaction)."""
+    uid, oid = ev["user_id"], ev["order_id"]
+    ip = ev.get("ip4") or "-"
+    out = []
+    if ev["warn"]:
+        out.append(notice(
+            uid,
+            f"⚠️ موجودی شما به {money(ev['balance_irt'])} رسید. لطفاً موجودی را افزایش دهید وگرنه سرور قطع می‌شود.\nIP: {ip}",
+            f"billing:warn:{oid}:{now}",
+            reply_markup=kb([[('➕ افزایش موجودی','me:topup')]]),
+        ))
+    if ev["action"] == "cutoff":
+        out.append(notice(
+            uid,
+            f"⛔️ به دلیل رسیدن موجودی به {money(ev['balance_irt'])}، سرویس ساعتی شما قطع شد و تا زمان شارژ دوباره روشن نمی‌شود.\nIP: {ip}",
+            f"billing:cutoff:{oid}:{now}",
+            reply_markup=kb([[('➕ افزایش موجودی','me:topup')],[('📦 سفارش‌های من','me:orders')]]),
+        ))
+    elif ev["action"] == "suspended":
+        out.append(notice(uid, "⛔️ سرویس ساعتی به دلیل کمبود موجودی متوقف شد.", f"billing:suspended:{oid}:{now}"))
+    return out
 
+
+async def apply_hourly_billing(bot: Bot, db: DB) -> set:
+    """Run the set-based hourly billing pass (notifications go to the outbox with it), then power off.
+
+    Returns the ids of orders that were stopped.
+    """
+    now = int(time.time())
+    events = await db.run_hourly_billing(
+        now, HOURLY_WARN_BALANCE, HOURLY_CUTOFF_BALANCE, notices_for=lambda ev: _billing_notices(ev, now)
+    )
+    stopped = [ev for ev in events if ev["action"] in ("cutoff", "suspended")]
+    await asyncio.gather(*(job_power(int(ev["hcloud_server_id"]), "poweroff") for ev in stopped))
+    return {ev["order_id"] for ev in stopped}
+
+
+JOB_SCHEDULER: Optional[Scheduler] = None
+
+
+def order_due_items(o: Dict[str, Any], now: float) -> List[Tuple[str, float]]:
+    """(kind, due_ts) pairs for an active order row from db.list_order_schedule()."""
+    if not o.get("hcloud_server_id"):
+        return []
+    items: List[Tuple[str, float]] = []
+    if o["billing_mode"] == "monthly":
+        items.append(("expiry", o["expires_at"]))
+    elif o["billing_mode"] == "hourly" and o["price_hourly_irt"] > 0:
+        last = o["last_hourly_charge_at"] or o["purchased_at"] or now
+        items.append(("billing", last + 3600))
+        # low-balance reminder cadence, only while a warning is current
+        if o["last_warn_at"] and now - o["last_warn_at"] < 3600:
+            items.append(("warn", o["last_warn_at"] + 3600))
+    if o["traffic_limit_gb"] > 0:
+        items.append(("traffic", o["traffic_last_ts"] + TRAFFIC_POLL_SEC))
+    return items
+
+
+async def reschedule_orders(db: DB, sched: Scheduler, order_ids: Optional[List[int]] = None) -> None:
+    """Re-read timing fields and (re)schedule; order_ids=None reseeds every active order."""
+    rows = await db.list_order_schedule(order_ids)
+    now = time.time()
+    for oid in order_ids or []:
+        sched.cancel(oid)
+    for o in rows:
+        for kind, due in order_due_items(o, now):
+            sched.schedule(int(o["id"]), kind, due)
+
+
+async def reschedule_user_warn(db: DB, sched: Scheduler, user_id: int) -> None:
+    """A balance change may cross the warn/cutoff thresholds: run the billing pass for the user's hourly orders now."""
+    now = time.time()
+    for o in await db.list_order_schedule(user_id=user_id):
+        if any(kind == "billing" for kind, _ in order_due_items(o, now)):
+            sched.schedule(int(o["id"]), "warn", now)
+
+
+async def check_order_expiry(bot: Bot, db: DB, order: Dict[str, Any]) -> None:
+    if now_ts() < int(order["expires_at"] or 0):
+        return
+    await job_power(int(order["hcloud_server_id"]), "poweroff")
+    await db.set_order_status(order["id"], "suspended", notices=[notice(
+        order["user_id"],
+        "⛔️ سرویس شما به دلیل اتمام زمان، متوقف شد. برای تمدید با پشتیبانی تماس بگیر.",
+        f"expired:{order['id']}:{order['expires_at']}",
+    )])
+
+
+async def check_order_traffic(bot: Bot, db: DB, order: Dict[str, Any]) -> None:
+    if not order["traffic_limit_gb"] or order["traffic_limit_gb"] <= 0:
+        return
+    sid = int(order["hcloud_server_id"])
+    # only fetch what is not settled yet: hours that ended more than
+    # TRAFFIC_SETTLE_GRACE_SEC ago are added once to traffic_settled_gb, the
+    # rest (running hour and the late-reporting one before it) are re-read every cycle
+    now = now_ts()
+    hour = now - now % 3600
+    settle = (now - TRAFFIC_SETTLE_GRACE_SEC) - (now - TRAFFIC_SETTLE_GRACE_SEC) % 3600
+    start = order["traffic_settled_until"] or (order["purchased_at"] - order["purchased_at"] % 3600)
+    if start < now:
+        series = await job_network_series(
+            sid, datetime.fromtimestamp(start, tz=timezone.utc), datetime.fromtimestamp(now, tz=timezone.utc)
+        )
+        if series is None:
+            return
+    else:
+        series = []
+    gb = 1024**3
+    settled_gb = sum(v for ts, v in series if ts < settle) / gb
+    partial_gb = sum(v for ts, v in series if ts >= settle) / gb
+    used_gb = await db.add_order_traffic(
+        order["id"], start, max(start, settle), settled_gb, partial_gb, now, samples=[(ts - ts % 3600, v) for ts, v in series]
+    )
+    if used_gb is None:
+        return
+    if used_gb >= float(order["traffic_limit_gb"]):
+        await job_power(sid, "poweroff")
+        await db.set_order_status(order["id"], "suspended", notices=[notice(
+            order["user_id"],
+            f"⛔️ سرویس شما به دلیل رسیدن به سقف ترافیک ({order['traffic_limit_gb']}GB) متوقف شد.",
+            f"traffic:{order['id']}:{order['traffic_limit_gb']}:{hour}",
+        )])
+
+
+async def _run_order_job(bot: Bot, db: DB, oid: int, kind: str) -> None:
+    try:
+        order = await db.get_order(oid)
+        if not order or order["status"] != "active" or not order["hcloud_server_id"]:
+            return
+        if kind == "expiry":
+            await check_order_expiry(bot, db, order)
+        else:
+            await check_order_traffic(bot, db, order)
+    except Exception:
+        pass
+
+
+# periodic scheduler items (order id 0) and their interval in seconds
+PERIODIC_JOBS: Dict[str, int] = {
+    "reseed": SCHED_RESEED_SEC,
+    "rollup": 3600,
+    "provisioning": max(60, PROVISION_LEASE_SEC // 2),
+}
+
+
+async def run_due_jobs(db: DB, bot: Bot, sched: Scheduler, batch: List[Tuple[int, str]]) -> None:
+    now = time.time()
+    periodic = {kind for _, kind in batch if kind in PERIODIC_JOBS}
+    items = [(oid, kind) for oid, kind in batch if kind not in PERIODIC_JOBS]
+    # periodic kinds to try again soon instead of after their interval
+    retry: set = set()
+    try:
+        try:
+            enabled = (await db.get_setting("bot_enabled", "1")) == "1"
         except Exception:
-            pass
+            enabled = False
+        if not enabled:
+            retry = set(periodic)
+            for oid, kind in items:
+                sched.schedule(oid, kind, now + SCHED_RETRY_SEC)
+            return
+
+        if "reseed" in periodic:
+            try:
+                await reschedule_orders(db, sched)
+            except Exception:
+                retry.add("reseed")
+
+        if "rollup" in periodic:
+            try:
+                await db.compact_traffic_samples(int(now) - TRAFFIC_HOURLY_KEEP_DAYS * 86400)
+            except Exception:
+                pass
+
+        if "provisioning" in periodic:
+            try:
+                await sweep_provisioning(db)
+            except Exception:
+                pass
+
+        await _run_order_items(db, bot, sched, items, now)
+    finally:
+        # a failing batch must never drop the periodic items from the heap
+        for kind in periodic:
+            sched.schedule(0, kind, now + (SCHED_RETRY_SEC if kind in retry else PERIODIC_JOBS[kind]))
+
+
+async def _run_order_items(db: DB, bot: Bot, sched: Scheduler, items: List[Tuple[int, str]], now: float) -> None:
+    stopped: set = set()
+    try:
+        # one set-based pass bills every due hourly order, not just this batch
+        if any(kind in ("billing", "warn") for _, kind in items):
+            stopped = await apply_hourly_billing(bot, db)
+
+        # independent per-order tasks; Hetzner/Telegram calls are capped by JOB_LIMITS
+        await asyncio.gather(*(
+            _run_order_job(bot, db, oid, kind)
+            for oid, kind in items
+            if kind in ("expiry", "traffic") and oid not in stopped
+        ))
+    finally:
+        try:
+            await reschedule_orders(db, sched, sorted({oid for oid, _ in items}))
+        except Exception:
+            # could not re-read the orders (DB busy): keep every item for a retry
+            for oid, kind in items:
+                sched.schedule(oid, kind, now + SCHED_RETRY_SEC)
+        # nothing moved forward (e.g. metrics unavailable): try again later
+        for oid, kind in items:
+            due = sched.due_at(oid, kind)
+            if due is not None and due <= now:
+                sched.schedule(oid, kind, now + SCHED_RETRY_SEC)
+
+
+async def job_loop(db: DB, bot: Bot):
+    """Run expiry, hourly billing and traffic checks when they are due."""
+    global JOB_SCHEDULER
+    sched = Scheduler()
+    JOB_SCHEDULER = sched
+    # the event loop keeps only weak references to tasks
+    pending: set = set()
+
+    def spawn(coro) -> None:
+        t = asyncio.create_task(coro)
+        pending.add(t)
+        t.add_done_callback(pending.discard)
+
+    db.add_order_listener(lambda oid: spawn(reschedule_orders(db, sched, [oid])))
+    db.add_balance_listener(lambda uid: spawn(reschedule_user_warn(db, sched, uid)))
+    # first batch seeds the heap from the DB
+    sched.schedule(0, "reseed", 0)
+    sched.schedule(0, "rollup", time.time() + 60)
+    sched.schedule(0, "provisioning", time.time() + PROVISION_LEASE_SEC)
+    await sched.run(lambda batch: run_due_jobs(db, bot, sched, batch))
+
+# -------------------------
+# Provisioning (server builds run by background workers)
+# -------------------------
+PROVISIONING: Optional[ProvisioningPool] = None
+WARM_POOL: Optional[WarmPool] = None
+# stable per host and role (bot / bridge), so a restarted process takes its
+# own claims back at once instead of waiting out the lease
+PROVISION_OWNER = f"{os.uname().nodename}:bot"
+
+
+class _MessageRef:
+    """Message known only by chat/message id, with the edit_text() used by _edit_progress."""
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def edit_text(self, text: str, **kwargs: Any) -> None:
+        await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kwargs)
+
+
+async def start_provisioning(db: DB, job_id: int, progress_msg: Optional[Message] = None) -> None:
+    """Attach the user's progress message to a committed job and hand it to the workers.
+
+    The job row is written with the payment, so if this never runs (crash, send
+    error) the startup resume or the lease sweep still builds it.
+    """
+    if progress_msg is not None:
+        await db.update_provisioning_job(job_id, chat_id=progress_msg.chat.id, message_id=progress_msg.message_id)
+    if PROVISIONING is not None:
+        PROVISIONING.submit(job_id)
+
+
+async def sweep_provisioning(db: DB) -> None:
+    """Resubmit unfinished jobs whose worker stopped touching them (died, or lost the job)."""
+    if PROVISIONING is None:
+        return
+    for job_id in await db.list_unfinished_provisioning_jobs(idle_sec=PROVISION_LEASE_SEC):
+        PROVISIONING.submit(job_id)
+
+
+async def _provision_create(db: DB, job: Dict[str, Any], plan: Dict[str, Any], msg: Optional[_MessageRef]) -> None:
+    p = job["payload"]
+    key = (str(plan["server_type"]).lower(), p.get("location", ""), p.get("os", ""))
+    if job["state"] == "queued" and WARM_POOL is not None and WARM_POOL.wants(key):
+        # recorded on the job with the claim: a resumed job keeps this server instead of building another
+        w = await db.claim_warm_server_for_job(job["id"], *key)
+        if w:
+            job.update(state="creating", hcloud_server_id=w["hcloud_server_id"])
+    if job.get("hcloud_server_id"):
+        if msg:
+            await _edit_progress(msg, 70, 'تحویل از سرورهای آماده…')
+        server_id, ip4, root_pw = await hcloud_take_warm_server(int(job["hcloud_server_id"]), p.get("server_name", "vps"))
+        await db.update_provisioning_job(
+            job["id"], state="waiting", hcloud_server_id=int(server_id), ip4=str(ip4), root_password=str(root_pw)
+        )
+        job.update(state="waiting", ip4=str(ip4), root_password=str(root_pw))
+        return
+    srv = None
+    if job["state"] == "creating":
+        # interrupted around the create call: adopt the server if it was made for this job
+        srv = await hcloud_api().find_server_by_name(p.get("server_name", "vps"))
+        if srv and srv.created_ts < job["created_at"]:
+            srv = None
+    if srv:
+        server_id, ip4, root_pw = srv.id, srv.ipv4, await hcloud_reset_password(srv.id)
+    else:
+        await db.update_provisioning_job(job["id"], state="creating")
+        if msg:
+            await _edit_progress(msg, 30, 'انتخاب ایمیج سیستم‌عامل…')
+        img = await find_matching_image(p.get("os", ""))
+        if not img:
+            raise RuntimeError("Image not found")
+        if msg:
+            await _edit_progress(msg, 70, 'در حال ساخت سرور روی Hetzner…')
+        server_id, ip4, root_pw, job["action_ids"] = await hcloud_create_server(
+            name=p.get("server_name", "vps"),
+            server_type=plan["server_type"],
+            image_id=img.id,
+            location_name=p.get("location", ""),
+        )
+    await db.update_provisioning_job(
+        job["id"], state="waiting", hcloud_server_id=int(server_id), ip4=str(ip4), root_password=str(root_pw)
+    )
+    job.update(state="waiting", hcloud_server_id=int(server_id), ip4=str(ip4), root_password=str(root_pw))
+
+
+async def _provision_deliver(db: DB, bot: Bot, job: Dict[str, Any], plan: Dict[str, Any], msg: Optional[_MessageRef]) -> None:
+    p = job["payload"]
+    billing = p.get("billing", "monthly")
+    user_id = job["user_id"]
+    inv_id = job["invoice_id"]
+    oid = job["order_id"]
+    if not oid:
+        now = int(time.time())
+        expires_at = int((datetime.fromtimestamp(now, TZ) + timedelta(days=30)).timestamp())
+        eff = await plan_effective_prices(db, plan)
+        # start hourly counters now to prevent huge retroactive charges on old deployments
+        hourly = (billing or "").lower() == "hourly" and int(plan.get("price_hourly_irt") or 0) > 0
+        # order, job link, invoice and card status in one transaction: a resumed job reuses the order
+        oid = await db.deliver_provisioning_job(job["id"], dict(
+            user_id=user_id,
+            plan_id=int(plan["id"]),
+            provider=p.get("provider", ""),
+            country=p.get("country", ""),
+            location=p.get("location", ""),
+            os_name=p.get("os", ""),
+            server_type=plan["server_type"],
+            hcloud_server_id=str(job["hcloud_server_id"]),
+            ip4=str(job["ip4"]),
+            root_password=str(job["root_password"]),
+            billing_mode=billing,
+            traffic_limit_gb=int(plan.get("traffic_limit_gb") or 0),
+            expires_at=expires_at,
+            status="active",
+            price_monthly_irt=int(eff['monthly_irt'] or 0),
+            price_hourly_irt=int(eff['hourly_irt'] or 0),
+        ), hourly_from=(now if hourly else None))
+        job["order_id"] = oid
+
+    o = await db.get_order(oid)
+    expires_at = int(o["expires_at"]) if o else 0
+    text = (
+        f"{glass_header('تحویل سرویس')}\n"
+        f"{GLASS_DOT} IP: <code>{job['ip4']}</code>\n"
+        f"{GLASS_DOT} USER: <code>root</code>\n"
+        f"{GLASS_DOT} PASS: <code>{job['root_password']}</code>\n"
+        f"{GLASS_DOT} انقضا: {fmt_dt(expires_at)}\n"
+    )
+    markup = kb([[("📦 سفارش‌های من","me:orders")],[("🏠 منوی اصلی","home")]])
+    try:
+        if not msg:
+            raise RuntimeError("no progress message")
+        await msg.edit_text(text, parse_mode="HTML", reply_markup=markup)
+    except Exception:
+        notify(bot, user_id, text, parse_mode="HTML", reply_markup=markup)
+
+    # done before the report: a resume must not report twice, a report error is not a failed delivery
+    await db.update_provisioning_job(job["id"], state="done", error=None)
+    try:
+        await send_admin_purchase_report(
+            bot,
+            db,
+            user_id=user_id,
+            order_id=oid,
+            ip4=str(job["ip4"]),
+            pay_method=job["source"],
+            amount_irt=int(job["amount_irt"] or 0),
+            plan_name=str(plan["server_type"]),
+            billing=str(billing),
+        )
+    except Exception:
+        pass
+
+
+async def _provision_fail(db: DB, bot: Bot, job: Dict[str, Any], msg: Optional[_MessageRef], err: Exception) -> None:
+    user_id = job["user_id"]
+    inv_id = job["invoice_id"]
+    if job.get("order_id"):
+        # the order was delivered; only a step after it failed
+        await db.update_provisioning_job(job["id"], state="done", error=str(err)[:500])
+        return
+    wallet = job["source"] == "wallet"
+    admin_text = ""
+    if job.get("hcloud_server_id"):
+        # the server exists (and may be billed by Hetzner): an admin deletes or hands it over
+        admin_text = (
+            f"⚠️ تحویل سرور ناموفق ماند (job #{job['id']})\nکاربر: {user_id}\n"
+            f"Hetzner ID: {job['hcloud_server_id']}\nIP: {job.get('ip4') or '-'}\nخطا: {err}"
+        )
+    if not wallet and inv_id:
+        admin_text = (admin_text or f"⚠️ ساخت سرور ناموفق بود (job #{job['id']})\nکاربر: {user_id}\nخطا: {err}") + (
+            f"\nفاکتور کارت #{inv_id} رد شد؛ مبلغ را دستی برگردانید."
+        )
+    # failed state and refund / card rejection commit together (once per job)
+    if not await db.fail_provisioning_job(
+        job["id"],
+        str(err),
+        refund_irt=(int(job["amount_irt"] or 0) if wallet else 0),
+        reject_card=not wallet,
+        notices=(admin_notices(admin_text, f"provision:failed:{job['id']}") if admin_text else ()),
+    ):
+        return
+    text = f"{glass_header('خطا در ساخت')}\n{GLASS_DOT} ساخت سرور ناموفق بود.\n{GLASS_DOT} خطا: {err}"
+    if wallet:
+        text += f"\n{GLASS_DOT} مبلغ به کیف پول شما برگشت."
+    try:
+        if not msg:
+            raise RuntimeError("no progress message")
+        await msg.edit_text(text, reply_markup=kb([[("🏠 منوی اصلی","home")]]))
+    except Exception:
+        notify(bot, user_id, f"❌ خطا در ساخت سرور: {err}")
+
+
+async def run_provisioning_job(db: DB, bot: Bot, job_id: int) -> None:
+    """Drive one job: queued -> creating -> waiting -> delivering -> done (or failed).
+    Every step is persisted first, so a restarted worker continues where this one stopped."""
+    if not await db.claim_provisioning_job(job_id, PROVISION_OWNER, PROVISION_LEASE_SEC):
+        return
+    job = await db.get_provisioning_job(job_id)
+    if not job:
+        return
+    await db.update_provisioning_job(job_id, attempts=job["attempts"] + 1)
+    msg = _MessageRef(bot, int(job["chat_id"]), int(job["message_id"])) if job["chat_id"] and job["message_id"] else None
+    try:
+        plan = await db.get_plan(int(job["payload"].get("plan_id") or 0))
+        if not plan:
+            raise RuntimeError("plan not found")
+        if job["state"] in ("queued", "creating"):
+            await _provision_create(db, job, plan, msg)
+        if job["state"] == "waiting":
+            # While Hetzner is provisioning, show a progress percent that moves with real time/status.
+            sid = int(job["hcloud_server_id"])
+            # action ids are only known in this run; a resumed job looks them up on the server
+            acts = job.get("action_ids")
+            if msg:
+                ip_ready, st = await hcloud_wait_running_with_progress(
+                    msg, sid, timeout_sec=240, start_percent=75, end_percent=99, action_ids=acts
+                )
+            else:
+                ip_ready, st = await hcloud_wait_running(sid, timeout_sec=240, action_ids=acts)
+            if st.startswith("error"):
+                raise RuntimeError(st)
+            ip4 = ip_ready or job["ip4"]
+            await db.update_provisioning_job(job_id, state="delivering", ip4=str(ip4))
+            job.update(state="delivering", ip4=str(ip4))
+            if msg:
+                await _edit_progress(msg, 100, 'سرور آماده شد ✅')
+        if job["state"] == "delivering":
+            await _provision_deliver(db, bot, job, plan, msg)
+    except Exception as e:
+        await _provision_fail(db, bot, job, msg, e)
+
+
+# -------------------------
+# Broadcasts (background sender; see broadcast.py)
+# -------------------------
+BROADCASTS: Optional[BroadcastRunner] = None
+BROADCAST_STATE_LABELS = {"running": "در حال ارسال", "paused": "متوقف", "cancelled": "لغو شد", "done": "تمام شد"}
+
+
+def broadcast_progress_text(b: Dict[str, Any]) -> str:
+    done = b["sent"] + b["failed"] + b["blocked"]
+    pct = min(100, done * 100 // b["total"]) if b["total"] else 100
+    return (
+        f"{glass_header('پیام همگانی')}\n"
+        f"{GLASS_DOT} #{b['id']} | وضعیت: {BROADCAST_STATE_LABELS.get(b['state'], b['state'])}\n"
+        f"{GLASS_DOT} پیشرفت: <b>{pct}%</b> ({done}/{b['total']})\n"
+        f"{GLASS_DOT} ارسال‌شده: {b['sent']} | ناموفق: {b['failed']} | ربات را بلاک کرده: {b['blocked']}"
+    )
+
+
+def broadcast_kb(b: Dict[str, Any]) -> InlineKeyboardMarkup:
+    bid = b["id"]
+    rows = []
+    if b["state"] == "running":
+        rows.append([("⏸ توقف", f"admin:bc:pause:{bid}"), ("✖️ لغو", f"admin:bc:cancel:{bid}")])
+    elif b["state"] == "paused":
+        rows.append([("▶️ ادامه", f"admin:bc:resume:{bid}"), ("✖️ لغو", f"admin:bc:cancel:{bid}")])
+    rows.append([("🔄 بروزرسانی", f"admin:bc:view:{bid}")])
+    rows.append([("برگشت", "admin:bc:list")])
+    return kb(rows)
+
+
+async def _broadcast_send(bot: Bot, user_id: int, text: str) -> str:
+    try:
+        res = await send_queue(bot).send_message(user_id, text, "bulk", raise_errors=True)
+    except TelegramForbiddenError:
+        return "blocked"
+    except Exception:
+        return "failed"
+    return "sent" if res is not None else "failed"
+
+
+async def _broadcast_progress(bot: Bot, b: Dict[str, Any]) -> None:
+    if not (b.get("chat_id") and b.get("message_id")):
+        return
+    await bot.edit_message_text(
+        broadcast_progress_text(b),
+        chat_id=int(b["chat_id"]),
+        message_id=int(b["message_id"]),
+        parse_mode="HTML",
+        reply_markup=broadcast_kb(b),
+    )
+
+
+async def _warm_create(server_type: str, location: str, os_label: str) -> Tuple[int, str, Optional[int], List[int]]:
+    img = await find_matching_image(os_label)
+    if not img:
+        raise RuntimeError(f"no image for {os_label}")
+    name = f"warm-{server_type}-{location}-{secrets.token_hex(3)}"
+    res = await hcloud_api().create_server(name, server_type, img.id, location, labels={"vpsbot": "warm"})
+    return res.server.id, res.server.ipv4, img.id, res.action_ids
+
+
+async def _warm_wait(server_id: int, action_ids: Optional[List[int]]) -> Optional[str]:
+    ip4, st = await hcloud_wait_running(server_id, timeout_sec=600, action_ids=action_ids)
+    if not ip4:
+        if st != "off" or not WARM_POOL_POWER_OFF:
+            return None
+        # resumed after this process had already powered it off
+        srv = await hcloud_api().get_server(server_id)
+        return srv.ipv4 if srv else None
+    if WARM_POOL_POWER_OFF:
+        act = await hcloud_api().power_off(server_id)
+        await ACTION_TRACKER.wait([act.id], 120)
+    return ip4
+
+
+async def _warm_pool_stats_line() -> str:
+    if WARM_POOL is None:
+        return ""
+    ws = await WARM_POOL.stats()
+    return (
+        f"\n{GLASS_DOT} warm pool: ready {ws['ready']}/{ws['target']} | building {ws['building']}"
+        f" | created {ws['created']} | reaped {ws['reaped']} | failed {ws['failed']}"
+    )
+
+
+def _sender_stats_line() -> str:
+    if SENDER is None:
+        return ""
+    ss = SENDER.stats()
+    q = ss["queued"]
+    return (
+        f"\n{GLASS_DOT} telegram: sent {ss['sent']} | queued {q['user']}/{q['admin']}/{q['bulk']}"
+        f" | 429 {ss['rate_limited']} | retried {ss['retried']} | dropped {ss['dropped']}"
+    )
+
+
+async def _outbox_stats_line() -> str:
+    if OUTBOX is None:
+        return ""
+    ob = await OUTBOX.stats()
+    return (
+        f"\n{GLASS_DOT} outbox: pending {ob['pending']} | sent {ob['sent']} | dead {ob['dead']}"
+        f" | retried {ob['retried']}"
+    )
+
+
+def _provisioning_stats_line() -> str:
+    if PROVISIONING is None:
+        return ""
+    ps = PROVISIONING.stats()
+    ac = ACTION_TRACKER.stats()
+    return (
+        f"\n{GLASS_DOT} builds: {ps['running']}/{ps['workers']} running | queued {ps['queued']} | done {ps['done']}"
+        f"\n{GLASS_DOT} build actions: watching {ac['watching']} | polls {ac['polls']} | errors {ac['errors']}"
+    )
 
-        await asyncio.sleep(300)
 
 # -------------------------
 # App
@@ -6550,9 +6724,13 @@ async def init_runtime(start_polling: bool = True) -> Tuple[Bot, Dispatcher, DB]
         raise RuntimeError("BOT_TOKEN is missing in .env")
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
-    db = DB(DB_PATH)
-    ensure_card_purchase_api(DB)
-    ensure_invoice_api(DB)
+    db = DB(
+        DB_PATH,
+        readers=DB_POOL_READERS,
+        write_batch_max=DB_WRITE_BATCH_MAX,
+        write_batch_window_ms=DB_WRITE_BATCH_WINDOW_MS,
+    )
+    await db.open()
     await db.init()
 
     # Load in-memory button label overrides + catalog (used by kb())
@@ -6560,6 +6738,10 @@ async def init_runtime(start_polling: bool = True) -> Tuple[Bot, Dispatcher, DB]
     await load_glass_buttons_pref(db)
     _build_label_catalog()
 
+    # pick up admin edits made through the other process (bot <-> bridge)
+    db.add_change_listener(lambda name, keys: on_db_change(db, name, keys))
+    db.start_change_watcher(DB_CHANGE_POLL_SEC)
+
     # seed card text from env if present (do not override admin-configured value)
     if DEFAULT_CARD_TEXT:
         try:
@@ -6572,10 +6754,68 @@ async def init_runtime(start_polling: bool = True) -> Tuple[Bot, Dispatcher, DB]
     bot = Bot(token=BOT_TOKEN)
     dp = Dispatcher()
     dp.include_router(router)
+    dp.shutdown.register(db.stop_change_watcher)
+
+    global PROVISIONING, PROVISION_OWNER
+    if not start_polling:
+        PROVISION_OWNER = f"{os.uname().nodename}:bridge"
+    PROVISIONING = ProvisioningPool(lambda job_id: run_provisioning_job(db, bot, job_id), PROVISION_WORKERS)
+    PROVISIONING.start(await db.list_unfinished_provisioning_jobs())
+    dp.shutdown.register(PROVISIONING.stop)
+
+    global BROADCASTS
+    BROADCASTS = BroadcastRunner(
+        db,
+        lambda uid, text: _broadcast_send(bot, uid, text),
+        owner=PROVISION_OWNER,
+        rate=BROADCAST_RATE,
+        page_size=BROADCAST_PAGE,
+        on_progress=lambda b: _broadcast_progress(bot, b),
+    )
+    await BROADCASTS.resume_all()
+    dp.shutdown.register(BROADCASTS.stop)
+
+    # both processes drain the outbox; rows are leased so each is sent once
+    global OUTBOX
+    OUTBOX = OutboxWorker(
+        db,
+        lambda row: _outbox_deliver(bot, row),
+        owner=PROVISION_OWNER,
+        interval=OUTBOX_POLL_SEC,
+        max_attempts=OUTBOX_MAX_ATTEMPTS,
+        on_dead=lambda row, err: _outbox_dead(bot, row, err),
+    )
+    db.add_outbox_listener(OUTBOX.kick)
+    OUTBOX.start()
+    dp.shutdown.register(OUTBOX.stop)
+    # flush queued notifications before the session closes
+    dp.shutdown.register(send_queue(bot).stop)
+
+    global WARM_POOL
+    if HCLOUD_TOKEN and WARM_POOL_SPEC:
+        WARM_POOL = WarmPool(
+            db,
+            WARM_POOL_SPEC,
+            create=_warm_create,
+            wait=_warm_wait,
+            delete=hcloud_delete_server,
+            available=hcloud_server_type_available,
+            max_total=WARM_POOL_MAX,
+            max_age_sec=WARM_POOL_MAX_AGE_HOURS * 3600,
+        )
+        dp.shutdown.register(WARM_POOL.stop)
+        if start_polling:
+            # both processes claim from the pool; only the bot process refills and reaps it
+            asyncio.create_task(WARM_POOL.loop(WARM_POOL_REFILL_SEC))
+    dp.shutdown.register(close_hcloud_api)
+    dp.shutdown.register(db.close)
 
     # background jobs
     asyncio.create_task(job_loop(db, bot))
     asyncio.create_task(daily_db_backup_loop(db, bot))
+    if HCLOUD_TOKEN:
+        asyncio.create_task(refresh_loop([IMAGE_CATALOG, SERVER_TYPE_CATALOG], CATALOG_TTL_SEC))
+        asyncio.create_task(refresh_loop([STOCK_INDEX], STOCK_TTL_SEC))
 
     global BOT_OBJ, DP_OBJ, DB_OBJ
     BOT_OBJ, DP_OBJ, DB_OBJ = bot, dp, db
@@ -0,0 +1,101 @@
+"""Background broadcasts.
+
+A broadcast is a row in the broadcasts table plus a cursor over users.user_id.
+The runner sends one page of recipients at a time at a fixed rate, then
+moves the cursor and adds the page's counts in one write. Pause, resume and
+cancel are state changes in the table, checked between pages. A crash or
+restart continues from the cursor; at most one page is sent again.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# (user id, text) -> 'sent' | 'blocked' | 'failed'
+SendFn = Callable[[int, str], Awaitable[str]]
+ProgressFn = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class BroadcastRunner:
+    def __init__(
+        self,
+        db: Any,
+        send: SendFn,
+        *,
+        owner: str,
+        rate: float = 20.0,
+        page_size: int = 100,
+        lease_sec: int = 120,
+        on_progress: Optional[ProgressFn] = None,
+        progress_every_sec: float = 3.0,
+    ):
+        self.db = db
+        self._send = send
+        self.owner = owner
+        self.rate = max(0.1, float(rate))
+        self.page_size = max(1, int(page_size))
+        self.lease_sec = int(lease_sec)
+        self._on_progress = on_progress
+        self.progress_every_sec = float(progress_every_sec)
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def start(self, broadcast_id: int) -> None:
+        """Run the broadcast here unless this process already does."""
+        bid = int(broadcast_id)
+        t = self._tasks.get(bid)
+        if t is not None and not t.done():
+            return
+        self._tasks[bid] = asyncio.create_task(self._run(bid))
+
+    async def resume_all(self) -> None:
+        for bid in await self.db.list_running_broadcasts():
+            self.start(bid)
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks.values())
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _progress(self, b: Dict[str, Any]) -> None:
+        if self._on_progress is None:
+            return
+        try:
+            await self._on_progress(b)
+        except Exception:
+            pass
+
+    async def _run(self, bid: int) -> None:
+        if not await self.db.claim_broadcast(bid, self.owner, self.lease_sec):
+            return
+        last_progress = 0.0
+        try:
+            while True:
+                b = await self.db.get_broadcast(bid)
+                if not b or b["state"] != "running":
+                    break
+                page = await self.db.broadcast_recipients(b["cursor_user_id"], self.page_size)
+                if not page:
+                    await self.db.set_broadcast_state(bid, "done", ("running",))
+                    break
+
+                pending = []
+                for uid in page:
+                    pending.append(asyncio.ensure_future(self._send(uid, b["text"])))
+                    await asyncio.sleep(1.0 / self.rate)
+                results = await asyncio.gather(*pending, return_exceptions=True)
+                sent = sum(1 for r in results if r == "sent")
+                blocked = sum(1 for r in results if r == "blocked")
+                await self.db.advance_broadcast(bid, page[-1], sent, len(results) - sent - blocked, blocked)
+
+                if time.monotonic() - last_progress >= self.progress_every_sec:
+                    last_progress = time.monotonic()
+                    nb = await self.db.get_broadcast(bid)
+                    if nb:
+                        await self._progress(nb)
+        finally:
+            await self.db.release_broadcast(bid, self.owner)
+            self._tasks.pop(bid, None)
+        final = await self.db.get_broadcast(bid)
+        if final:
+            await self._progress(final)
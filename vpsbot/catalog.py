@@ -0,0 +1,245 @@
+"""In-memory Hetzner catalogs.
+
+Each catalog is fetched in one go, kept in memory and refreshed on a TTL
+(by a background loop, or lazily when a stale catalog is read). Lookups
+are plain dict reads; a failed refresh keeps serving the previous data.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from hetzner import HDatacenter, HImage, HServerType
+from singleflight import SingleFlight
+
+
+class Catalog:
+    """Fetch-all + TTL base. Subclasses implement _build(rows)."""
+
+    name = "catalog"
+
+    def __init__(self, fetch: Callable[[], Awaitable[Any]], ttl: float, flight: Optional[SingleFlight] = None):
+        self._fetch = fetch
+        self.ttl = float(ttl)
+        self.loaded_at = 0.0
+        # concurrent refreshes (background loop, lazy reads) share one fetch
+        self._flight = flight or SingleFlight()
+        self._bg: Optional[asyncio.Task] = None
+        self.refreshes = 0
+        self.errors = 0
+        self.last_error = ""
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at > 0
+
+    def stale(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) - self.loaded_at >= self.ttl
+
+    def _build(self, rows: Any) -> None:
+        raise NotImplementedError
+
+    async def refresh(self, force: bool = False) -> bool:
+        """Re-fetch the catalog; False (old data kept) on error."""
+        if not force and self.loaded and not self.stale():
+            return True
+        return await self._flight.do((f"catalog:{self.name}",), self._refresh)
+
+    async def _refresh(self) -> bool:
+        try:
+            rows = await self._fetch()
+            self._build(rows)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            self.last_error = str(e)[:200]
+            return False
+        self.loaded_at = time.time()
+        self.refreshes += 1
+        return True
+
+    async def ensure(self) -> None:
+        """Make sure there is data to read.
+
+        First load is awaited (and raises if it fails); a stale catalog is
+        served as-is while a background refresh runs.
+        """
+        if not self.loaded:
+            if not await self.refresh() and not self.loaded:
+                raise RuntimeError(f"{self.name} unavailable: {self.last_error}")
+            return
+        if self.stale() and (self._bg is None or self._bg.done()):
+            self._bg = asyncio.create_task(self.refresh())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "loaded": self.loaded,
+            "age_sec": (int(time.time() - self.loaded_at) if self.loaded else None),
+            "refreshes": self.refreshes,
+            "errors": self.errors,
+        }
+
+
+async def refresh_loop(catalogs: Iterable[Catalog], interval: float) -> None:
+    """Keep catalogs warm so user-facing reads never wait on the provider."""
+    catalogs = list(catalogs)
+    while True:
+        for c in catalogs:
+            await c.refresh(force=True)
+        await asyncio.sleep(max(30.0, float(interval)))
+
+
+# -------------------------
+# images
+# -------------------------
+def normalize_os_key(s: str) -> str:
+    return s.lower().replace("_", "-").replace(" ", "").replace(".", "")
+
+
+def image_match_score(key: str, hay: str) -> int:
+    """Fuzzy score of a normalized OS label against a normalized image text."""
+    score = 0
+    if "ubuntu" in key and ("ubuntu" in hay):
+        score += 3
+    if "debian" in key and ("debian" in hay):
+        score += 3
+    if "rocky" in key and ("rocky" in hay):
+        score += 3
+    if "alma" in key and ("alma" in hay):
+        score += 3
+    if "cento" in key and ("centos" in hay or "stream" in hay):
+        score += 2
+    if "fed" in key and ("fedora" in hay):
+        score += 3
+    if "opensuse" in key and ("suse" in hay or "opensuse" in hay):
+        score += 3
+
+    digits = "".join(ch for ch in key if ch.isdigit())
+    if digits and digits in hay:
+        score += 2
+    return score
+
+
+class ImageCatalog(Catalog):
+    """System images plus a precomputed best match per OS label."""
+
+    name = "image catalog"
+
+    def __init__(self, fetch: Callable[[], Awaitable[List[HImage]]], labels: Iterable[str], ttl: float,
+                 flight: Optional[SingleFlight] = None):
+        super().__init__(fetch, ttl, flight)
+        self.labels = list(labels)
+        self._images: List[Tuple[str, HImage]] = []
+        self._best: Dict[str, Optional[HImage]] = {}
+
+    def _build(self, rows: List[HImage]) -> None:
+        images = [
+            (normalize_os_key(im.name + " " + im.description + " " + im.os_flavor + " " + im.os_version), im)
+            for im in rows
+        ]
+        best = {label: self._score(images, label) for label in self.labels}
+        self._images, self._best = images, best
+
+    @staticmethod
+    def _score(images: List[Tuple[str, HImage]], label: str) -> Optional[HImage]:
+        key = normalize_os_key(label)
+        best: Optional[Tuple[int, HImage]] = None
+        for hay, im in images:
+            score = image_match_score(key, hay)
+            if score > 0 and (best is None or score > best[0]):
+                best = (score, im)
+        return best[1] if best else None
+
+    def match(self, label: str) -> Optional[HImage]:
+        """Best image for an OS label (no I/O; call ensure() first)."""
+        if label not in self._best:
+            # labels outside the menu (old orders, admin input) are scored once
+            self._best[label] = self._score(self._images, label)
+        return self._best[label]
+
+    async def get(self, label: str) -> Optional[HImage]:
+        await self.ensure()
+        return self.match(label)
+
+    def stats(self) -> Dict[str, Any]:
+        out = super().stats()
+        out["images"] = len(self._images)
+        return out
+
+
+# -------------------------
+# server types
+# -------------------------
+class ServerTypeCatalog(Catalog):
+    """All server types keyed by lower-case name (specs, architecture, prices)."""
+
+    name = "server types"
+
+    def __init__(self, fetch: Callable[[], Awaitable[List[HServerType]]], ttl: float,
+                 flight: Optional[SingleFlight] = None):
+        super().__init__(fetch, ttl, flight)
+        self._by_name: Dict[str, HServerType] = {}
+
+    def _build(self, rows: List[HServerType]) -> None:
+        self._by_name = {st.name.lower(): st for st in rows}
+
+    def get(self, name: str) -> Optional[HServerType]:
+        return self._by_name.get((name or "").lower())
+
+    def specs(self, name: str) -> Dict[str, Any]:
+        st = self.get(name)
+        if not st:
+            return {}
+        return {"vcpu": st.cores, "ram_gb": st.memory, "disk_gb": st.disk}
+
+    def offered_in(self, name: str, location: str) -> bool:
+        """Type exists and is priced for location (Hetzner only prices where it sells)."""
+        st = self.get(name)
+        if st is None:
+            return False
+        return not location or not st.prices or location in st.prices
+
+    def stats(self) -> Dict[str, Any]:
+        out = super().stats()
+        out["types"] = len(self._by_name)
+        return out
+
+
+# -------------------------
+# stock
+# -------------------------
+class StockIndex(Catalog):
+    """Per-location stock from /datacenters: location -> server type ids that can be created.
+
+    A location with several datacenters has stock if any of them does. Type
+    names are resolved through the server-type catalog.
+    """
+
+    name = "stock"
+
+    def __init__(self, fetch: Callable[[], Awaitable[List[HDatacenter]]], types: ServerTypeCatalog,
+                 locations: Iterable[str], ttl: float, flight: Optional[SingleFlight] = None):
+        super().__init__(fetch, ttl, flight)
+        self.types = types
+        self.locations = set(locations)
+        self._available: Dict[str, Set[int]] = {}
+
+    def _build(self, rows: List[HDatacenter]) -> None:
+        available: Dict[str, Set[int]] = {}
+        for dc in rows:
+            if self.locations and dc.location not in self.locations:
+                continue
+            available.setdefault(dc.location, set()).update(dc.available)
+        self._available = available
+
+    def available(self, location: str, server_type: str) -> Optional[bool]:
+        """True/False if known, None when the location or type is not in the index."""
+        st = self.types.get(server_type)
+        if st is None or st.id is None or location not in self._available:
+            return None
+        return st.id in self._available[location]
+
+    def stats(self) -> Dict[str, Any]:
+        out = super().stats()
+        out["locations"] = len(self._available)
+        return out
@@ -5,14 +5,18 @@ import sqlite3
 import asyncio
 import glob
 import shutil
-from typing import Optional, Dict, Any, List, Tuple, Union
+import json
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Tuple, Union, AsyncIterator, Awaitable, Callable, Sequence
 
 # ---------------------------------------------------------------------------
 # SQLite schema
 # ---------------------------------------------------------------------------
-SCHEMA = """
-PRAGMA journal_mode=WAL;
-
+# Schema as of migration 1. Frozen: never edit it. Every later table or
+# column is created by its own step in MIGRATIONS below, so a new install
+# runs exactly the same steps as an upgrade (journal_mode is set on the
+# pooled writer connection).
+BASELINE_SCHEMA = """
 CREATE TABLE IF NOT EXISTS users (
   user_id INTEGER PRIMARY KEY,
   username TEXT,
@@ -53,6 +57,7 @@ CREATE TABLE IF NOT EXISTS orders (
   user_id INTEGER NOT NULL,
   provider TEXT NOT NULL,
   country_code TEXT,
+  plan_id INTEGER,               -- plans.id at purchase time (sales counts)
   hcloud_server_id INTEGER,      -- Hetzner Cloud server id
   ip4 TEXT,
   name TEXT,
@@ -144,6 +149,63 @@ CREATE TABLE IF NOT EXISTS traffic_purchases (
 
 """
 
+# Secondary indexes, one per WHERE/ORDER BY pattern used by DB methods.
+# Applied by migration 2; check with: python db_audit.py
+INDEXES = [
+    # users: admin user list (ORDER BY created_at DESC)
+    "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)",
+    # plans: buy flow (provider/country/location), admin list (country_code)
+    "CREATE INDEX IF NOT EXISTS idx_plans_location ON plans(provider, country_code, location_name)",
+    "CREATE INDEX IF NOT EXISTS idx_plans_country ON plans(country_code, server_type)",
+    "CREATE INDEX IF NOT EXISTS idx_plans_provider_lower ON plans(lower(provider), is_active, country_code)",
+    # orders: per user, by status, hourly engine
+    "CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_billing_status ON orders(billing_mode, status)",
+    # invoices / purchases: per user cascade, pending card payments
+    "CREATE INDEX IF NOT EXISTS idx_invoices_user ON invoices(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_card_purchases_status ON card_purchases(status, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_card_purchases_user ON card_purchases(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_traffic_packages_country ON traffic_packages(country_code, is_active)",
+    "CREATE INDEX IF NOT EXISTS idx_traffic_purchases_user ON traffic_purchases(user_id)",
+    # tickets
+    "CREATE INDEX IF NOT EXISTS idx_tickets_user ON tickets(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets(status)",
+    "CREATE INDEX IF NOT EXISTS idx_ticket_messages_ticket ON ticket_messages(ticket_id)",
+]
+
+# Rows of the revisions table; each is bumped in the same transaction as the
+# change it tracks so other processes can tell what to reload.
+REVISION_NAMES = ("settings", "plans")
+
+# A wallet_snapshots row is written after this many ledger rows of one user.
+WALLET_SNAPSHOT_EVERY = 50
+
+# Columns added after the first releases; older databases get them in migration 1.
+LEGACY_COLUMNS = [
+    # users: phone registration
+    ("users", "phone", "TEXT"),
+    ("users", "registered_at", "INTEGER NOT NULL DEFAULT 0"),
+    # orders: hourly engine
+    ("orders", "last_hourly_charge_at", "INTEGER NOT NULL DEFAULT 0"),
+    ("orders", "last_warn_at", "INTEGER NOT NULL DEFAULT 0"),
+    ("orders", "suspended_at", "INTEGER NOT NULL DEFAULT 0"),
+    ("orders", "delete_at", "INTEGER NOT NULL DEFAULT 0"),
+    # orders: manual delivery
+    ("orders", "login_user", "TEXT"),
+    ("orders", "login_pass", "TEXT"),
+    ("orders", "manual_details", "TEXT"),
+    ("orders", "monitoring_url", "TEXT"),
+    ("orders", "monitoring_user", "TEXT"),
+    ("orders", "monitoring_pass", "TEXT"),
+    ("orders", "country_code", "TEXT"),
+    # invoices: link to order
+    ("invoices", "order_id", "INTEGER"),
+    # plans: EUR base prices
+    ("plans", "price_monthly_eur", "REAL"),
+    ("plans", "price_hourly_eur", "REAL"),
+]
+
 def _now() -> int:
     return int(time.time())
 
@@ -162,57 +224,1004 @@ def _as_int_or_none(x: Any) -> Optional[int]:
         pass
     return None
 
+# ---------------------------------------------------------------------------
+# Schema migrations
+# ---------------------------------------------------------------------------
+async def _exec_script(db: aiosqlite.Connection, script: str) -> None:
+    """Run a multi-statement script without executescript() (which would COMMIT)."""
+    buf = ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            stmt = buf.strip()
+            buf = ""
+            if stmt:
+                await db.execute(stmt)
+    if buf.strip():
+        await db.execute(buf)
+
+async def _add_columns(db: aiosqlite.Connection, columns: List[Tuple[str, str, str]]) -> None:
+    existing: Dict[str, set] = {}
+    for table, col, decl in columns:
+        if table not in existing:
+            cur = await db.execute(f"PRAGMA table_info({table})")
+            existing[table] = {r[1] for r in await cur.fetchall()}
+        if col not in existing[table]:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl}")
+            existing[table].add(col)
+
+async def _m1_baseline(db: aiosqlite.Connection) -> None:
+    # Tables may already exist (deployments from before user_version was used)
+    await _exec_script(db, BASELINE_SCHEMA)
+    await _add_columns(db, LEGACY_COLUMNS)
+
+async def _m2_indexes(db: aiosqlite.Connection) -> None:
+    for stmt in INDEXES:
+        await db.execute(stmt)
+
+async def _m3_order_plan_id(db: aiosqlite.Connection) -> None:
+    await _add_columns(db, [("orders", "plan_id", "INTEGER")])
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_orders_plan ON orders(plan_id)")
+
+async def _m4_revisions(db: aiosqlite.Connection) -> None:
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS revisions (name TEXT PRIMARY KEY, rev INTEGER NOT NULL DEFAULT 0)"
+    )
+    for name in REVISION_NAMES:
+        await db.execute("INSERT OR IGNORE INTO revisions(name, rev) VALUES(?, 0)", (name,))
+
+async def _bump_rev(db: aiosqlite.Connection, name: str) -> int:
+    """Increment revisions[name] inside the caller's transaction; returns the new value."""
+    cur = await db.execute("UPDATE revisions SET rev=rev+1 WHERE name=? RETURNING rev", (name,))
+    rows = await cur.fetchall()
+    return int(rows[0][0]) if rows else 0
+
+WALLET_LEDGER_SCHEMA = """
+-- append-only wallet history; users.balance_irt is the running total
+CREATE TABLE IF NOT EXISTS wallet_ledger (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id INTEGER NOT NULL,
+  delta_irt INTEGER NOT NULL,
+  balance_after INTEGER NOT NULL,
+  reason TEXT NOT NULL,          -- 'opening'|'topup'|'refund'|'admin'|'purchase'|'renew'|'traffic'|'hourly'|'settle'
+  order_id INTEGER,
+  invoice_id INTEGER,
+  created_at INTEGER NOT NULL
+);
+
+-- balance checkpoints, one every WALLET_SNAPSHOT_EVERY ledger rows per user
+CREATE TABLE IF NOT EXISTS wallet_snapshots (
+  user_id INTEGER NOT NULL,
+  ledger_id INTEGER NOT NULL,
+  balance_irt INTEGER NOT NULL,
+  created_at INTEGER NOT NULL,
+  PRIMARY KEY (user_id, ledger_id)
+);
+"""
+
+async def _m5_wallet_ledger(db: aiosqlite.Connection) -> None:
+    await _exec_script(db, WALLET_LEDGER_SCHEMA)
+    # (user_id, rowid) for history pages / snapshot tails, (user_id, created_at) for balance-at-time
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_wallet_ledger_user ON wallet_ledger(user_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_wallet_ledger_time ON wallet_ledger(user_id, created_at)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_wallet_snapshots_time ON wallet_snapshots(user_id, created_at)")
+    # existing balances become each user's opening entry + first snapshot
+    now = _now()
+    await db.execute(
+        """INSERT INTO wallet_ledger(user_id, delta_irt, balance_after, reason, created_at)
+           SELECT user_id, balance_irt, balance_irt, 'opening', ? FROM users
+           WHERE balance_irt != 0 AND user_id NOT IN (SELECT DISTINCT user_id FROM wallet_ledger)""",
+        (now,),
+    )
+    await db.execute(
+        """INSERT OR IGNORE INTO wallet_snapshots(user_id, ledger_id, balance_irt, created_at)
+           SELECT user_id, id, balance_after, created_at FROM wallet_ledger WHERE reason='opening'"""
+    )
+
+async def _ledger_append(
+    db: aiosqlite.Connection,
+    user_id: int,
+    delta: int,
+    balance_after: int,
+    reason: str,
+    order_id: Optional[int] = None,
+    invoice_id: Optional[int] = None,
+) -> int:
+    """Record a balance change made in the caller's transaction; snapshots every N rows."""
+    now = _now()
+    cur = await db.execute(
+        """INSERT INTO wallet_ledger(user_id, delta_irt, balance_after, reason, order_id, invoice_id, created_at)
+           VALUES(?,?,?,?,?,?,?)""",
+        (int(user_id), int(delta), int(balance_after), str(reason), _as_int_or_none(order_id), _as_int_or_none(invoice_id), now),
+    )
+    ledger_id = int(cur.lastrowid)
+    await _snapshot_due(db, "?", (int(user_id),))
+    return ledger_id
+
+async def _snapshot_due(db: aiosqlite.Connection, users_sql: str, params: Tuple[Any, ...] = ()) -> None:
+    """Checkpoint the latest ledger row of each user in users_sql (a value list
+    or subquery of user_ids) that has WALLET_SNAPSHOT_EVERY rows since its last snapshot."""
+    # bare columns next to MAX() come from the max row (SQLite guarantees this)
+    await db.execute(
+        f"""INSERT OR IGNORE INTO wallet_snapshots(user_id, ledger_id, balance_irt, created_at)
+            SELECT w.user_id, MAX(w.id), w.balance_after, w.created_at FROM wallet_ledger w
+            WHERE w.user_id IN ({users_sql}) AND w.id > COALESCE(
+                (SELECT MAX(s.ledger_id) FROM wallet_snapshots s WHERE s.user_id = w.user_id), 0)
+            GROUP BY w.user_id
+            HAVING COUNT(*) >= ?""",
+        tuple(params) + (WALLET_SNAPSHOT_EVERY,),
+    )
+
+async def _outbox_append(db: aiosqlite.Connection, notices: Sequence[Dict[str, Any]]) -> int:
+    """Queue notifications inside the caller's transaction; returns how many were new.
+
+    Each notice: {"chat_id", "payload": Bot method kwargs, optional "method",
+    "priority" and "key"}. A key that is already in the outbox is skipped.
+    """
+    if not notices:
+        return 0
+    now = _now()
+    n = 0
+    for m in notices:
+        cur = await db.execute(
+            """INSERT OR IGNORE INTO outbox(dedupe_key, chat_id, method, payload_json, priority, created_at)
+               VALUES(?,?,?,?,?,?)""",
+            (
+                m.get("key"),
+                int(m["chat_id"]),
+                str(m.get("method") or "send_message"),
+                json.dumps(m.get("payload") or {}, ensure_ascii=False),
+                str(m.get("priority") or "user"),
+                now,
+            ),
+        )
+        n += max(0, int(cur.rowcount))
+    return n
+
+async def _debit_wallet(
+    db: aiosqlite.Connection, user_id: int, amount: int, desc: str, order_id: Optional[int], reason: str
+) -> Optional[Tuple[int, int]]:
+    """Debit plus paid 'wallet' invoice inside the caller's transaction; None if the balance is too low."""
+    cur = await db.execute(
+        "UPDATE users SET balance_irt = balance_irt - ? WHERE user_id=? AND balance_irt >= ? RETURNING balance_irt",
+        (int(amount), int(user_id), int(amount)),
+    )
+    rows = await cur.fetchall()
+    if not rows:
+        return None
+    cur = await db.execute(
+        "INSERT INTO invoices(user_id,amount_irt,method,desc,status,created_at,order_id) VALUES(?,?,?,?,?,?,?)",
+        (int(user_id), int(amount), "wallet", str(desc), "paid", _now(), _as_int_or_none(order_id)),
+    )
+    bal, inv_id = int(rows[0][0]), int(cur.lastrowid)
+    await _ledger_append(db, user_id, -int(amount), bal, reason, order_id, inv_id)
+    return bal, inv_id
+
+async def _insert_order(db: aiosqlite.Connection, o: Dict[str, Any]) -> int:
+    """INSERT an order row from create_order()-style fields inside the caller's transaction."""
+    now = _now()
+    user_id = int(o["user_id"])
+
+    provider = str(o.get("provider") or "")
+    country_code = str(o.get("country_code") or o.get("country") or "").upper().strip() or None
+    plan_id = _as_int_or_none(o.get("plan_id")) or None
+    hcloud_server_id = _as_int_or_none(o.get("hcloud_server_id"))
+    ip4 = o.get("ip4")
+    name = o.get("name") or o.get("server_name")
+    server_type = o.get("server_type")
+    image_name = o.get("image_name") or o.get("os_name") or o.get("os")
+    location_name = o.get("location_name") or o.get("location")
+    billing_mode = str(o.get("billing_mode") or "monthly")
+    price_monthly_irt = int(o.get("price_monthly_irt") or 0)
+    price_hourly_irt = int(o.get("price_hourly_irt") or 0)
+    traffic_limit_gb = int(o.get("traffic_limit_gb") or 0)
+    status = str(o.get("status") or "active")
+    expires_at = int(o.get("expires_at") or now)
+    last_billed_hour = int(o.get("last_billed_hour") or 0)
+
+    cur = await db.execute(
+        """INSERT INTO orders(
+            user_id,provider,country_code,plan_id,hcloud_server_id,ip4,name,server_type,image_name,location_name,
+            billing_mode,price_monthly_irt,price_hourly_irt,traffic_limit_gb,status,purchased_at,expires_at,last_billed_hour
+        ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+        (
+            user_id,
+            provider,
+            country_code,
+            plan_id,
+            hcloud_server_id,
+            ip4,
+            name,
+            server_type,
+            image_name,
+            location_name,
+            billing_mode,
+            price_monthly_irt,
+            price_hourly_irt,
+            traffic_limit_gb,
+            status,
+            now,
+            expires_at,
+            last_billed_hour,
+        ),
+    )
+    return int(cur.lastrowid)
+
+async def _insert_provisioning_job(
+    db: aiosqlite.Connection,
+    *,
+    user_id: int,
+    invoice_id: Optional[int],
+    source: str,
+    amount_irt: int,
+    payload: Dict[str, Any],
+    chat_id: Optional[int] = None,
+    message_id: Optional[int] = None,
+) -> int:
+    """Queue a build inside the caller's transaction (with the payment it belongs to); returns the job id."""
+    now = _now()
+    cur = await db.execute(
+        """INSERT INTO provisioning_jobs(user_id, invoice_id, source, amount_irt, payload_json, state,
+                                         chat_id, message_id, created_at, updated_at)
+           VALUES(?,?,?,?,?,'queued',?,?,?,?)""",
+        (
+            int(user_id),
+            _as_int_or_none(invoice_id),
+            str(source),
+            int(amount_irt),
+            json.dumps(payload, ensure_ascii=False),
+            _as_int_or_none(chat_id),
+            _as_int_or_none(message_id),
+            now,
+            now,
+        ),
+    )
+    return int(cur.lastrowid)
+
+async def _m6_traffic_settled(db: aiosqlite.Connection) -> None:
+    await _add_columns(db, [
+        ("orders", "traffic_settled_gb", "REAL NOT NULL DEFAULT 0"),
+        ("orders", "traffic_settled_until", "INTEGER NOT NULL DEFAULT 0"),
+    ])
+    # old totals included the running hour of the last poll; start after it
+    await db.execute(
+        """UPDATE orders SET traffic_settled_gb = traffic_used_gb,
+                             traffic_settled_until = ((traffic_last_ts + 3599) / 3600) * 3600
+           WHERE traffic_last_ts > 0 AND traffic_settled_until = 0"""
+    )
+
+TRAFFIC_SAMPLES_SCHEMA = """
+-- outbound bytes per order and hour, fed by the traffic poller; rows older
+-- than the hourly retention are compacted into traffic_daily
+CREATE TABLE IF NOT EXISTS traffic_samples (
+  order_id INTEGER NOT NULL,
+  hour_ts INTEGER NOT NULL,
+  bytes_out REAL NOT NULL DEFAULT 0,
+  PRIMARY KEY (order_id, hour_ts)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS traffic_daily (
+  order_id INTEGER NOT NULL,
+  day_ts INTEGER NOT NULL,
+  bytes_out REAL NOT NULL DEFAULT 0,
+  PRIMARY KEY (order_id, day_ts)
+) WITHOUT ROWID;
+"""
+
+async def _m7_traffic_samples(db: aiosqlite.Connection) -> None:
+    await _exec_script(db, TRAFFIC_SAMPLES_SCHEMA)
+    # "top usage since" across orders, and compaction by age
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_traffic_samples_hour ON traffic_samples(hour_ts)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_traffic_daily_day ON traffic_daily(day_ts)")
+
+PROVISIONING_JOBS_SCHEMA = """
+-- server builds driven by the background provisioning workers
+CREATE TABLE IF NOT EXISTS provisioning_jobs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id INTEGER NOT NULL,
+  invoice_id INTEGER,
+  source TEXT NOT NULL,          -- 'wallet' | 'card' (who refunds/rejects on failure)
+  amount_irt INTEGER NOT NULL DEFAULT 0,
+  payload_json TEXT NOT NULL,    -- plan_id, os, server_name, location, provider, country, billing
+  state TEXT NOT NULL,           -- 'queued'|'creating'|'waiting'|'delivering'|'done'|'failed'
+  attempts INTEGER NOT NULL DEFAULT 0,
+  hcloud_server_id INTEGER,
+  ip4 TEXT,
+  root_password TEXT,
+  order_id INTEGER,
+  chat_id INTEGER,               -- progress message shown to the user
+  message_id INTEGER,
+  error TEXT,
+  claimed_by TEXT,               -- worker (process) currently driving the job
+  created_at INTEGER NOT NULL,
+  updated_at INTEGER NOT NULL    -- doubles as the claim heartbeat
+);
+"""
+
+async def _m8_provisioning_jobs(db: aiosqlite.Connection) -> None:
+    await _exec_script(db, PROVISIONING_JOBS_SCHEMA)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_provisioning_jobs_state ON provisioning_jobs(state)")
+
+WARM_SERVERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS warm_servers (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  server_type TEXT NOT NULL,
+  location TEXT NOT NULL,
+  os_label TEXT NOT NULL,        -- REQUESTED_OS label the purchase asks for
+  image_id INTEGER,
+  hcloud_server_id INTEGER NOT NULL,
+  ip4 TEXT,
+  state TEXT NOT NULL,           -- 'building' | 'ready' | 'reaping' (claimed rows are deleted)
+  created_at INTEGER NOT NULL,
+  updated_at INTEGER NOT NULL
+);
+"""
+
+async def _m9_warm_servers(db: aiosqlite.Connection) -> None:
+    await _exec_script(db, WARM_SERVERS_SCHEMA)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_warm_servers_key ON warm_servers(server_type, location, os_label, state)"
+    )
+
+BROADCASTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcasts (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  text TEXT NOT NULL,
+  state TEXT NOT NULL,           -- 'running' | 'paused' | 'cancelled' | 'done'
+  cursor_user_id INTEGER NOT NULL DEFAULT 0,  -- recipients are users.user_id > cursor, in order
+  total INTEGER NOT NULL DEFAULT 0,
+  sent INTEGER NOT NULL DEFAULT 0,
+  failed INTEGER NOT NULL DEFAULT 0,
+  blocked INTEGER NOT NULL DEFAULT 0,         -- user blocked the bot
+  created_by INTEGER,
+  chat_id INTEGER,               -- live progress message
+  message_id INTEGER,
+  claimed_by TEXT,
+  created_at INTEGER NOT NULL,
+  updated_at INTEGER NOT NULL,
+  finished_at INTEGER
+);
+"""
+
+async def _m10_broadcasts(db: aiosqlite.Connection) -> None:
+    await _exec_script(db, BROADCASTS_SCHEMA)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_state ON broadcasts(state)")
+
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  dedupe_key TEXT UNIQUE,        -- idempotency key; NULL = always insert
+  chat_id INTEGER NOT NULL,
+  method TEXT NOT NULL DEFAULT 'send_message',
+  payload_json TEXT NOT NULL,    -- keyword arguments of the Bot method
+  priority TEXT NOT NULL DEFAULT 'user',
+  state TEXT NOT NULL DEFAULT 'pending',      -- 'pending' | 'sent' | 'dead'
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt_at INTEGER NOT NULL DEFAULT 0,
+  claimed_by TEXT,
+  claimed_until INTEGER NOT NULL DEFAULT 0,
+  last_error TEXT,
+  created_at INTEGER NOT NULL,
+  sent_at INTEGER
+);
+"""
+
+async def _m11_outbox(db: aiosqlite.Connection) -> None:
+    await _exec_script(db, OUTBOX_SCHEMA)
+    # due rows for the drain worker; also serves the purge of old sent/dead rows
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(state, next_attempt_at)")
+
+# (user_version, description, step). Append only; never renumber.
+MIGRATIONS: List[Tuple[int, str, Callable[[aiosqlite.Connection], Awaitable[None]]]] = [
+    (1, "baseline schema + legacy columns", _m1_baseline),
+    (2, "secondary indexes", _m2_indexes),
+    (3, "orders.plan_id", _m3_order_plan_id),
+    (4, "revisions", _m4_revisions),
+    (5, "wallet ledger + snapshots", _m5_wallet_ledger),
+    (6, "orders.traffic_settled_*", _m6_traffic_settled),
+    (7, "traffic samples + daily rollups", _m7_traffic_samples),
+    (8, "provisioning jobs", _m8_provisioning_jobs),
+    (9, "warm server pool", _m9_warm_servers),
+    (10, "broadcasts", _m10_broadcasts),
+    (11, "notification outbox", _m11_outbox),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+# ---------------------------------------------------------------------------
+# Connection pool
+# ---------------------------------------------------------------------------
+WriteOp = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+
+class PoolClosedError(RuntimeError):
+    """A write was submitted while the pool was closing."""
+
+
+class ConnectionPool:
+    """Long-lived aiosqlite connections for one database file.
+
+    One dedicated writer connection (serialized with a lock) plus N reader
+    connections handed out through a queue. WAL mode lets readers run while
+    the writer is busy. Connections are opened lazily on first use and are
+    re-opened after close() (e.g. after a DB file restore).
+
+    Mutations go through submit(): a single writer task takes ops from a queue
+    and runs them in batches inside one BEGIN IMMEDIATE ... COMMIT (one fsync
+    per batch). Each op runs in its own SAVEPOINT, so a failing op only rolls
+    back itself. Callers are resolved after the batch has been committed.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        readers: int = 4,
+        busy_timeout_ms: int = 5000,
+        batch_max: int = 64,
+        batch_window_ms: float = 2.0,
+    ):
+        self.path = path
+        self.readers = max(1, int(readers or 1))
+        self.busy_timeout_ms = int(busy_timeout_ms)
+        self.batch_max = max(1, int(batch_max or 1))
+        self.batch_window_ms = max(0.0, float(batch_window_ms or 0))
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_lock = asyncio.Lock()
+        self._reader_conns: List[aiosqlite.Connection] = []
+        self._reader_q: Optional[asyncio.Queue] = None
+        self._open_lock = asyncio.Lock()
+        self._opened = False
+        self._write_q: Optional[asyncio.Queue] = None
+        self._write_task: Optional[asyncio.Task] = None
+        # set by close() before the stop sentinel; submit() rejects new writes until it returns
+        self._closing = False
+        # stats
+        self._st: Dict[str, Dict[str, float]] = {
+            kind: {"acquires": 0, "waits": 0, "in_use": 0, "max_in_use": 0, "wait_total_ms": 0.0, "wait_max_ms": 0.0}
+            for kind in ("reader", "writer")
+        }
+        self._wst: Dict[str, float] = {"ops": 0, "failed": 0, "batches": 0, "max_batch": 0, "commit_total_ms": 0.0, "commit_max_ms": 0.0}
+
+    async def _connect(self, *, readonly: bool) -> aiosqlite.Connection:
+        # writer runs in autocommit mode: transactions are managed explicitly
+        conn = await aiosqlite.connect(self.path, isolation_level="" if readonly else None)
+        await conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        if readonly:
+            await conn.execute("PRAGMA query_only=1")
+        else:
+            await conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    async def open(self) -> None:
+        async with self._open_lock:
+            if self._opened:
+                return
+            self._writer = await self._connect(readonly=False)
+            q: asyncio.Queue = asyncio.Queue()
+            conns = []
+            for _ in range(self.readers):
+                c = await self._connect(readonly=True)
+                conns.append(c)
+                q.put_nowait(c)
+            self._reader_conns = conns
+            self._reader_q = q
+            self._write_q = asyncio.Queue()
+            self._write_task = asyncio.create_task(self._writer_loop(self._write_q))
+            self._opened = True
+
+    async def close(self) -> None:
+        """Close all connections. Waits for the writer and every reader to be returned."""
+        async with self._open_lock:
+            if not self._opened:
+                return
+            # no new writes from here; the writer flushes everything queued so far, then stops
+            self._closing = True
+            try:
+                if self._write_q is not None and self._write_task is not None:
+                    self._write_q.put_nowait(None)
+                    try:
+                        await self._write_task
+                    except Exception:
+                        pass
+                    self._fail_pending(self._write_q)
+                self._write_q = None
+                self._write_task = None
+                await self._close_conns()
+            finally:
+                self._closing = False
+
+    async def _close_conns(self) -> None:
+        async with self._writer_lock:
+            q = self._reader_q
+            if q is not None:
+                for _ in range(len(self._reader_conns)):
+                    c = await q.get()
+                    try:
+                        await c.close()
+                    except Exception:
+                        pass
+            if self._writer is not None:
+                try:
+                    await self._writer.close()
+                except Exception:
+                    pass
+            self._writer = None
+            self._reader_conns = []
+            self._reader_q = None
+            self._opened = False
+
+    @staticmethod
+    def _fail_pending(q: asyncio.Queue) -> None:
+        """Fail ops still queued after the writer stopped (it crashed, or they raced the sentinel)."""
+        while True:
+            try:
+                item = q.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if item is not None and not item[1].done():
+                item[1].set_exception(PoolClosedError("database pool closed"))
+
+    def _note_acquire(self, kind: str, waited_ms: float, waited: bool) -> None:
+        st = self._st[kind]
+        st["acquires"] += 1
+        if waited:
+            st["waits"] += 1
+        st["wait_total_ms"] += waited_ms
+        if waited_ms > st["wait_max_ms"]:
+            st["wait_max_ms"] = waited_ms
+        st["in_use"] += 1
+        if st["in_use"] > st["max_in_use"]:
+            st["max_in_use"] = st["in_use"]
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        if not self._opened:
+            await self.open()
+        q = self._reader_q
+        t0 = time.perf_counter()
+        waited = q.empty()
+        conn = await q.get()
+        self._note_acquire("reader", (time.perf_counter() - t0) * 1000.0, waited)
+        try:
+            yield conn
+        finally:
+            self._st["reader"]["in_use"] -= 1
+            q.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        if not self._opened:
+            await self.open()
+        t0 = time.perf_counter()
+        waited = self._writer_lock.locked()
+        async with self._writer_lock:
+            self._note_acquire("writer", (time.perf_counter() - t0) * 1000.0, waited)
+            conn = self._writer
+            try:
+                yield conn
+                if conn.in_transaction:
+                    await conn.commit()
+            except BaseException:
+                try:
+                    await conn.rollback()
+                except Exception:
+                    pass
+                raise
+            finally:
+                self._st["writer"]["in_use"] -= 1
+
+    # -------------------------
+    # write queue (group commit)
+    # -------------------------
+    async def submit(self, fn: WriteOp) -> Any:
+        """Queue a write op and wait until its batch is committed.
+
+        fn receives the writer connection and must not commit/rollback itself.
+        Its return value (or exception) is handed back to the caller.
+        """
+        if self._closing:
+            raise PoolClosedError("database pool is closing")
+        if not self._opened:
+            await self.open()
+        q = self._write_q
+        if self._closing or q is None:
+            raise PoolClosedError("database pool is closing")
+        fut = asyncio.get_running_loop().create_future()
+        q.put_nowait((fn, fut))
+        return await fut
+
+    def _drain_into(self, batch: List[Any], q: asyncio.Queue) -> bool:
+        """Move already-queued ops into batch. Returns True if the stop sentinel was seen."""
+        while len(batch) < self.batch_max:
+            try:
+                item = q.get_nowait()
+            except asyncio.QueueEmpty:
+                return False
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    async def _writer_loop(self, q: asyncio.Queue) -> None:
+        stop = False
+        try:
+            while True:
+                if stop:
+                    # after the sentinel: commit whatever is left, then exit
+                    if q.empty():
+                        return
+                    item = q.get_nowait()
+                else:
+                    item = await q.get()
+                if item is None:
+                    stop = True
+                    continue
+                batch = [item]
+                stop = self._drain_into(batch, q) or stop
+                # Only wait for stragglers when a burst is already in progress;
+                # a lone write is committed immediately.
+                if not stop and len(batch) > 1 and len(batch) < self.batch_max and self.batch_window_ms > 0:
+                    await asyncio.sleep(self.batch_window_ms / 1000.0)
+                    stop = self._drain_into(batch, q)
+                await self._run_batch(batch)
+        finally:
+            # never leave a caller waiting on a writer that is gone
+            self._fail_pending(q)
+
+    async def _run_batch(self, batch: List[Any]) -> None:
+        done: List[Tuple[asyncio.Future, Any]] = []
+        failed: List[Tuple[asyncio.Future, BaseException]] = []
+        async with self._writer_lock:
+            conn = self._writer
+            try:
+                await conn.execute("BEGIN IMMEDIATE")
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                return
+
+            for fn, fut in batch:
+                if fut.done():
+                    # caller went away before the op ran
+                    continue
+                try:
+                    await conn.execute("SAVEPOINT op")
+                    res = await fn(conn)
+                    await conn.execute("RELEASE op")
+                    done.append((fut, res))
+                except Exception as e:
+                    try:
+                        await conn.execute("ROLLBACK TO op")
+                        await conn.execute("RELEASE op")
+                    except Exception:
+                        pass
+                    failed.append((fut, e))
+
+            t0 = time.perf_counter()
+            try:
+                await conn.execute("COMMIT")
+            except Exception as e:
+                try:
+                    await conn.execute("ROLLBACK")
+                except Exception:
+                    pass
+                failed.extend((fut, e) for fut, _ in done)
+                done = []
+            commit_ms = (time.perf_counter() - t0) * 1000.0
+
+        w = self._wst
+        w["batches"] += 1
+        w["ops"] += len(done) + len(failed)
+        w["failed"] += len(failed)
+        w["max_batch"] = max(w["max_batch"], len(batch))
+        w["commit_total_ms"] += commit_ms
+        w["commit_max_ms"] = max(w["commit_max_ms"], commit_ms)
+
+        for fut, res in done:
+            if not fut.done():
+                fut.set_result(res)
+        for fut, e in failed:
+            if not fut.done():
+                fut.set_exception(e)
+
+    def connections(self) -> List[aiosqlite.Connection]:
+        """All open connections (writer first). Used by diagnostics such as db_audit.py."""
+        if not self._opened:
+            return []
+        return [self._writer, *self._reader_conns]
+
+    def stats(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"readers": self.readers, "open": self._opened}
+        for kind, st in self._st.items():
+            n = int(st["acquires"])
+            out[kind] = {
+                "acquires": n,
+                "waits": int(st["waits"]),
+                "in_use": int(st["in_use"]),
+                "max_in_use": int(st["max_in_use"]),
+                "avg_wait_ms": round(st["wait_total_ms"] / n, 3) if n else 0.0,
+                "max_wait_ms": round(st["wait_max_ms"], 3),
+            }
+        w = self._wst
+        nb = int(w["batches"])
+        out["write_queue"] = {
+            "pending": self._write_q.qsize() if self._write_q is not None else 0,
+            "ops": int(w["ops"]),
+            "failed": int(w["failed"]),
+            "batches": nb,
+            "avg_batch": round(w["ops"] / nb, 2) if nb else 0.0,
+            "max_batch": int(w["max_batch"]),
+            "avg_commit_ms": round(w["commit_total_ms"] / nb, 3) if nb else 0.0,
+            "max_commit_ms": round(w["commit_max_ms"], 3),
+        }
+        return out
+
+
 class DB:
-    def __init__(self, path: str):
+    def __init__(
+        self,
+        path: str,
+        readers: Optional[int] = None,
+        write_batch_max: Optional[int] = None,
+        write_batch_window_ms: Optional[float] = None,
+    ):
         self.path = path
+        if readers is None:
+            readers = int(os.getenv("DB_POOL_READERS", "4") or 4)
+        if write_batch_max is None:
+            write_batch_max = int(os.getenv("DB_WRITE_BATCH_MAX", "64") or 64)
+        if write_batch_window_ms is None:
+            write_batch_window_ms = float(os.getenv("DB_WRITE_BATCH_WINDOW_MS", "2") or 2)
+        self.pool = ConnectionPool(
+            path,
+            readers=readers,
+            batch_max=write_batch_max,
+            batch_window_ms=write_batch_window_ms,
+        )
+        # settings cache: whole table in memory, write-through on set_setting
+        self._settings: Optional[Dict[str, str]] = None
+        self._settings_lock = asyncio.Lock()
+        self._settings_json: Dict[str, Tuple[str, Any]] = {}
+        self.settings_version = 0
+        # plan catalog cache (list_plans / list_plan_countries), dropped on plan changes
+        self._plans_cache: Dict[Tuple[Any, ...], List[Any]] = {}
+        # cross-process change watcher (PRAGMA data_version + revisions table)
+        self._revs: Dict[str, int] = {}
+        self._listeners: List[Callable[[str, Optional[set]], Awaitable[None]]] = []
+        self._watch_conn: Optional[aiosqlite.Connection] = None
+        self._watch_lock = asyncio.Lock()
+        self._watch_task: Optional[asyncio.Task] = None
+        self._data_version: Optional[int] = None
+        # local order changes (used by the job scheduler to reschedule)
+        self._order_listeners: List[Callable[[int], None]] = []
+        # local wallet balance changes (warn/cutoff thresholds may have been crossed)
+        self._balance_listeners: List[Callable[[int], None]] = []
+        # local outbox inserts (wake the drain worker instead of waiting for its poll)
+        self._outbox_listeners: List[Callable[[], None]] = []
+
+    async def open(self) -> None:
+        await self.pool.open()
+
+    async def close(self) -> None:
+        await self.pool.close()
+        # the file may be replaced while closed (DB restore); the watcher
+        # reconnects on its next tick and compares revisions again
+        async with self._watch_lock:
+            if self._watch_conn is not None:
+                try:
+                    await self._watch_conn.close()
+                except Exception:
+                    pass
+                self._watch_conn = None
+        self.invalidate_settings()
+        self._plans_cache = {}
 
-    async def init(self) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.executescript(SCHEMA)
-
-            # ----------------- best-effort migrations -----------------
-            # orders: hourly columns (older deployments)
-            for stmt in [
-                # users: phone registration
-                "ALTER TABLE users ADD COLUMN phone TEXT",
-                "ALTER TABLE users ADD COLUMN registered_at INTEGER NOT NULL DEFAULT 0",
-                "ALTER TABLE orders ADD COLUMN last_hourly_charge_at INTEGER NOT NULL DEFAULT 0",
-                "ALTER TABLE orders ADD COLUMN last_warn_at INTEGER NOT NULL DEFAULT 0",
-                "ALTER TABLE orders ADD COLUMN suspended_at INTEGER NOT NULL DEFAULT 0",
-                "ALTER TABLE orders ADD COLUMN delete_at INTEGER NOT NULL DEFAULT 0",
-                "ALTER TABLE orders ADD COLUMN login_user TEXT",
-                "ALTER TABLE orders ADD COLUMN login_pass TEXT",
-                "ALTER TABLE orders ADD COLUMN manual_details TEXT",
-                "ALTER TABLE orders ADD COLUMN monitoring_url TEXT",
-                "ALTER TABLE orders ADD COLUMN monitoring_user TEXT",
-                "ALTER TABLE orders ADD COLUMN monitoring_pass TEXT",
-                "ALTER TABLE orders ADD COLUMN country_code TEXT",
-                # invoices: link to order
-                "ALTER TABLE invoices ADD COLUMN order_id INTEGER",
-                # plans: EUR base prices
-                "ALTER TABLE plans ADD COLUMN price_monthly_eur REAL",
-                "ALTER TABLE plans ADD COLUMN price_hourly_eur REAL",
-            ]:
+    def pool_stats(self) -> Dict[str, Any]:
+        return self.pool.stats()
+
+    async def _write(self, sql: str, params: Tuple[Any, ...] = ()) -> Tuple[int, int]:
+        """Run one statement through the write queue. Returns (lastrowid, rowcount)."""
+        async def _op(db: aiosqlite.Connection) -> Tuple[int, int]:
+            cur = await db.execute(sql, params)
+            return int(cur.lastrowid or 0), int(cur.rowcount)
+
+        return await self.pool.submit(_op)
+
+    async def _write_tx(self, fn: WriteOp) -> Any:
+        """Run several statements atomically through the write queue."""
+        return await self.pool.submit(fn)
+
+    async def _write_rev(self, rev: str, sql: str, params: Tuple[Any, ...] = ()) -> Tuple[int, int]:
+        """_write() that also bumps revisions[rev] in the same transaction."""
+        async def _op(db: aiosqlite.Connection) -> Tuple[Tuple[int, int], int]:
+            cur = await db.execute(sql, params)
+            res = (int(cur.lastrowid or 0), int(cur.rowcount))
+            return res, await _bump_rev(db, rev)
+
+        res, new_rev = await self.pool.submit(_op)
+        self._note_local_rev(rev, new_rev)
+        return res
+
+    # -------------------------
+    # cross-process change tracking
+    # -------------------------
+    def add_change_listener(self, cb: Callable[[str, Optional[set]], Awaitable[None]]) -> None:
+        """Register cb(name, keys) called after another process changed `name`.
+
+        For 'settings' keys is the set of changed setting keys; otherwise None.
+        """
+        self._listeners.append(cb)
+
+    def add_order_listener(self, cb: Callable[[int], None]) -> None:
+        """Register cb(order_id), called after this process changed an order's
+        status, expiry, billing timestamps or traffic limit."""
+        self._order_listeners.append(cb)
+
+    def _order_changed(self, order_id: int) -> None:
+        for cb in list(self._order_listeners):
+            try:
+                cb(int(order_id))
+            except Exception:
+                pass
+
+    def add_balance_listener(self, cb: Callable[[int], None]) -> None:
+        """Register cb(user_id), called after this process changed a wallet balance
+        outside the hourly billing pass."""
+        self._balance_listeners.append(cb)
+
+    def _balance_changed(self, user_id: int) -> None:
+        for cb in list(self._balance_listeners):
+            try:
+                cb(int(user_id))
+            except Exception:
+                pass
+
+    def add_outbox_listener(self, cb: Callable[[], None]) -> None:
+        """Register cb(), called after this process committed new outbox rows."""
+        self._outbox_listeners.append(cb)
+
+    def _outbox_written(self, n: int = 1) -> None:
+        if n <= 0:
+            return
+        for cb in list(self._outbox_listeners):
+            try:
+                cb()
+            except Exception:
+                pass
+
+    def _note_local_rev(self, name: str, rev: int) -> None:
+        if name == "plans":
+            self._plans_cache = {}
+        # Only advance if nobody else wrote in between; otherwise the watcher
+        # sees a mismatch and reloads.
+        if name in self._revs and self._revs[name] == rev - 1:
+            self._revs[name] = rev
+
+    def start_change_watcher(self, interval: float = 1.0) -> None:
+        if self._watch_task is None or self._watch_task.done():
+            self._watch_task = asyncio.create_task(self._watch_loop(float(interval)))
+
+    async def stop_change_watcher(self) -> None:
+        t = self._watch_task
+        self._watch_task = None
+        if t is not None:
+            t.cancel()
+            try:
+                await t
+            except BaseException:
+                pass
+        async with self._watch_lock:
+            if self._watch_conn is not None:
                 try:
-                    await db.execute(stmt)
+                    await self._watch_conn.close()
                 except Exception:
                     pass
+                self._watch_conn = None
 
-            # Ensure card_purchases table exists (some older db.py variants were missing it)
+    async def _watch_loop(self, interval: float) -> None:
+        while True:
             try:
-                await db.execute("SELECT 1 FROM card_purchases LIMIT 1")
+                await self.check_changes()
+            except asyncio.CancelledError:
+                raise
             except Exception:
-                await db.executescript("""
-                CREATE TABLE IF NOT EXISTS card_purchases (
-                  invoice_id INTEGER PRIMARY KEY,
-                  user_id INTEGER NOT NULL,
-                  payload_json TEXT NOT NULL,
-                  receipt_file_id TEXT,
-                  status TEXT NOT NULL DEFAULT 'waiting_receipt',
-                  created_at INTEGER NOT NULL
-                );
-                """)
-            await db.commit()
+                # reconnect on the next tick
+                async with self._watch_lock:
+                    if self._watch_conn is not None:
+                        try:
+                            await self._watch_conn.close()
+                        except Exception:
+                            pass
+                        self._watch_conn = None
+            await asyncio.sleep(interval)
+
+    async def check_changes(self) -> List[str]:
+        """Poll PRAGMA data_version; on change compare revisions and reload what changed.
+
+        Returns the names of the caches that were reloaded.
+        """
+        async with self._watch_lock:
+            if self._watch_conn is None:
+                conn = await aiosqlite.connect(self.path)
+                await conn.execute("PRAGMA query_only=1")
+                await conn.execute(f"PRAGMA busy_timeout={self.pool.busy_timeout_ms}")
+                self._watch_conn = conn
+                self._data_version = None
+            conn = self._watch_conn
+            cur = await conn.execute("PRAGMA data_version")
+            dv = int((await cur.fetchone())[0])
+            if dv == self._data_version:
+                return []
+            self._data_version = dv
+            cur = await conn.execute("SELECT name, rev FROM revisions")
+            revs = {str(r[0]): int(r[1]) for r in await cur.fetchall()}
+
+        changed: List[str] = []
+        for name, rev in revs.items():
+            known = self._revs.get(name)
+            self._revs[name] = rev
+            if known is not None and known != rev:
+                changed.append(name)
+
+        for name in changed:
+            keys: Optional[set] = None
+            if name == "settings":
+                keys = await self._reload_settings()
+                if not keys:
+                    continue
+            elif name == "plans":
+                self._plans_cache = {}
+            for cb in list(self._listeners):
+                try:
+                    await cb(name, keys)
+                except Exception:
+                    pass
+        return changed
+
+    async def _reload_settings(self) -> set:
+        """Re-read settings written by another process; returns the changed keys."""
+        async with self._settings_lock:
+            async with self.pool.reader() as db:
+                cur = await db.execute("SELECT k, v FROM settings")
+                rows = await cur.fetchall()
+            new = {str(r[0]): r[1] for r in rows}
+            old = self._settings or {}
+            changed = {k for k in set(old) | set(new) if old.get(k) != new.get(k)}
+            self._settings = new
+            for k in changed:
+                self._settings_json.pop(k, None)
+            self.settings_version += 1
+        return changed
+
+    async def init(self) -> None:
+        """Bring the schema up to SCHEMA_VERSION.
+
+        Only steps above the file's PRAGMA user_version run, all inside one
+        transaction together with the version bump. A database that is already
+        current costs a single PRAGMA read.
+        """
+        async with self.pool.writer() as db:
+            cur = await db.execute("PRAGMA user_version")
+            version = int((await cur.fetchone())[0] or 0)
+            if version >= SCHEMA_VERSION:
+                return
+
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                # another process may have migrated while we waited for the lock
+                cur = await db.execute("PRAGMA user_version")
+                version = int((await cur.fetchone())[0] or 0)
+                for step_version, _desc, step in MIGRATIONS:
+                    if step_version > version:
+                        await step(db)
+                        version = step_version
+                await db.execute(f"PRAGMA user_version={int(version)}")
+                await db.execute("COMMIT")
+            except BaseException:
+                await db.execute("ROLLBACK")
+                raise
 
     # -------------------------
     # backups
@@ -275,6 +1284,40 @@ class DB:
 
         return path
 
+    async def restore_from(self, src_path: str) -> None:
+        """Replace the live database's content with the backup file src_path.
+
+        Runs the SQLite backup API on the writer connection: no write batch
+        runs meanwhile, open readers (and the other process) see the restored
+        pages, and no stale WAL frames can leak in the way they can when the
+        file is copied over a live WAL database. Raises ValueError if src_path
+        is not a usable bot database. Call init() afterwards to migrate it.
+        """
+        def _check() -> None:
+            con = sqlite3.connect(str(src_path))
+            try:
+                ok = con.execute("PRAGMA quick_check").fetchone()[0]
+                has_users = con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='users'").fetchone()
+            finally:
+                con.close()
+            if ok != "ok":
+                raise ValueError(f"integrity check failed: {ok}")
+            if not has_users:
+                raise ValueError("not a bot database (no users table)")
+
+        try:
+            await asyncio.to_thread(_check)
+        except sqlite3.DatabaseError as e:
+            raise ValueError(f"not an SQLite database: {e}") from e
+        async with self.pool.writer() as conn:
+            src = await aiosqlite.connect(str(src_path))
+            try:
+                await src.backup(conn)
+            finally:
+                await src.close()
+        self.invalidate_settings()
+        self._plans_cache = {}
+
     def get_latest_backup(self, backup_dir: str, *, prefix: str = "vpsbot_backup") -> Optional[str]:
         """Return latest backup path (or None if not found)."""
         try:
@@ -286,35 +1329,73 @@ class DB:
     # -------------------------
     # settings
     # -------------------------
+    async def _load_settings(self) -> Dict[str, str]:
+        async with self._settings_lock:
+            while self._settings is None:
+                seen = self.settings_version
+                async with self.pool.reader() as db:
+                    cur = await db.execute("SELECT k, v FROM settings")
+                    rows = await cur.fetchall()
+                # a set_setting() that landed during the read makes this snapshot stale
+                if seen == self.settings_version:
+                    self._settings = {str(r[0]): r[1] for r in rows}
+                    self.settings_version += 1
+            return self._settings
+
+    def invalidate_settings(self) -> None:
+        """Drop the settings cache; the next read reloads the whole table."""
+        self._settings = None
+        self._settings_json = {}
+        self.settings_version += 1
+
     async def get_setting(self, k: str, default: Optional[str] = None) -> Optional[str]:
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute("SELECT v FROM settings WHERE k=?", (k,))
-            row = await cur.fetchone()
-            return row[0] if row else default
+        settings = self._settings
+        if settings is None:
+            settings = await self._load_settings()
+        v = settings.get(k)
+        return v if v is not None else default
+
+    async def get_setting_json(self, k: str, default: Any = None) -> Any:
+        """Parsed JSON value of a setting, parsed once per stored value.
+
+        The returned object is shared between callers: treat it as read-only.
+        """
+        raw = await self.get_setting(k, None)
+        if not raw:
+            return default
+        hit = self._settings_json.get(k)
+        if hit is not None and hit[0] == raw:
+            return hit[1]
+        try:
+            val = json.loads(raw)
+        except Exception:
+            return default
+        self._settings_json[k] = (raw, val)
+        return val
 
     async def set_setting(self, k: str, v: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "INSERT INTO settings(k,v) VALUES(?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
-                (k, v),
-            )
-            await db.commit()
+        await self._write_rev(
+            "settings",
+            "INSERT INTO settings(k,v) VALUES(?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
+            (k, v),
+        )
+        if self._settings is not None:
+            self._settings[k] = v
+        self.settings_version += 1
 
     # -------------------------
     # users
     # -------------------------
     async def upsert_user(self, user_id: int, username: Optional[str]) -> None:
         now = _now()
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "INSERT INTO users(user_id, username, created_at) VALUES(?,?,?) "
-                "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username",
-                (user_id, username, now),
-            )
-            await db.commit()
+        await self._write(
+            "INSERT INTO users(user_id, username, created_at) VALUES(?,?,?) "
+            "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username",
+            (user_id, username, now),
+        )
 
     async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 "SELECT user_id, username, phone, registered_at, balance_irt, is_blocked, created_at FROM users WHERE user_id=?",
                 (user_id,),
@@ -333,17 +1414,148 @@ class DB:
         }
 
     async def set_block(self, user_id: int, is_blocked: bool) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE users SET is_blocked=? WHERE user_id=?", (1 if is_blocked else 0, user_id))
-            await db.commit()
+        await self._write("UPDATE users SET is_blocked=? WHERE user_id=?", (1 if is_blocked else 0, user_id))
+
+    async def add_balance(
+        self,
+        user_id: int,
+        delta_irt: int,
+        reason: str = "admin",
+        order_id: Optional[int] = None,
+        invoice_id: Optional[int] = None,
+        notices: Sequence[Dict[str, Any]] = (),
+    ) -> Optional[int]:
+        """Apply a signed balance change and record it in wallet_ledger; returns the new balance.
+
+        notices are queued in the outbox only if the change was applied.
+        """
+        delta = int(delta_irt)
 
-    async def add_balance(self, user_id: int, delta_irt: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE users SET balance_irt = balance_irt + ? WHERE user_id=?", (delta_irt, user_id))
-            await db.commit()
+        async def _op(db: aiosqlite.Connection) -> Tuple[Optional[int], int]:
+            cur = await db.execute(
+                "UPDATE users SET balance_irt = balance_irt + ? WHERE user_id=? RETURNING balance_irt",
+                (delta, int(user_id)),
+            )
+            rows = await cur.fetchall()
+            if not rows:
+                return None, 0
+            bal = int(rows[0][0])
+            await _ledger_append(db, user_id, delta, bal, reason, order_id, invoice_id)
+            return bal, await _outbox_append(db, notices)
+
+        bal, queued = await self._write_tx(_op)
+        self._outbox_written(queued)
+        if bal is not None and delta:
+            self._balance_changed(user_id)
+        return bal
+
+    async def debit_wallet(
+        self, user_id: int, amount_irt: int, desc: str, order_id: Optional[int] = None, reason: str = "purchase"
+    ) -> Optional[Tuple[int, int]]:
+        """Take amount_irt from the wallet only if the balance covers it.
+
+        The debit and its paid 'wallet' invoice are written in one transaction.
+        Returns (new_balance, invoice_id), or None if the balance is too low.
+        """
+        amount = int(amount_irt)
+        if amount <= 0:
+            raise ValueError("debit amount must be positive")
+
+        async def _op(db: aiosqlite.Connection) -> Optional[Tuple[int, int]]:
+            return await _debit_wallet(db, user_id, amount, desc, order_id, reason)
+
+        res = await self._write_tx(_op)
+        if res is not None:
+            self._balance_changed(user_id)
+        return res
+
+    async def debit_wallet_for_provisioning(
+        self, user_id: int, amount_irt: int, desc: str, payload: Dict[str, Any]
+    ) -> Optional[Tuple[int, int, int]]:
+        """debit_wallet() and a queued 'wallet' provisioning job in one transaction,
+        so the money is never taken without a build to deliver or refund it.
+        Returns (new_balance, invoice_id, job_id), or None if the balance is too low.
+        """
+        amount = int(amount_irt)
+        if amount <= 0:
+            raise ValueError("debit amount must be positive")
+
+        async def _op(db: aiosqlite.Connection) -> Optional[Tuple[int, int, int]]:
+            debit = await _debit_wallet(db, user_id, amount, desc, None, "purchase")
+            if debit is None:
+                return None
+            job_id = await _insert_provisioning_job(
+                db, user_id=user_id, invoice_id=debit[1], source="wallet", amount_irt=amount, payload=payload
+            )
+            return debit[0], debit[1], job_id
+
+        res = await self._write_tx(_op)
+        if res is not None:
+            self._balance_changed(user_id)
+        return res
+
+    async def wallet_history(
+        self, user_id: int, limit: int = 20, before_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """Newest-first ledger rows of a user; pass the last row's id as before_id for the next page."""
+        sql = "SELECT id, delta_irt, balance_after, reason, order_id, invoice_id, created_at FROM wallet_ledger WHERE user_id=?"
+        params: List[Any] = [int(user_id)]
+        if before_id is not None:
+            sql += " AND id < ?"
+            params.append(int(before_id))
+        sql += " ORDER BY id DESC LIMIT ?"
+        params.append(int(limit))
+        async with self.pool.reader() as db:
+            cur = await db.execute(sql, tuple(params))
+            rows = await cur.fetchall()
+        return [
+            {
+                "id": r[0],
+                "delta_irt": int(r[1]),
+                "balance_after": int(r[2]),
+                "reason": r[3],
+                "order_id": r[4],
+                "invoice_id": r[5],
+                "created_at": int(r[6]),
+            }
+            for r in rows
+        ]
+
+    async def wallet_balance_at(self, user_id: int, ts: int) -> int:
+        """Balance right after the last ledger entry at or before ts (0 before the first)."""
+        async with self.pool.reader() as db:
+            cur = await db.execute(
+                """SELECT balance_after FROM wallet_ledger WHERE user_id=? AND created_at<=?
+                   ORDER BY created_at DESC, id DESC LIMIT 1""",
+                (int(user_id), int(ts)),
+            )
+            row = await cur.fetchone()
+        return int(row[0]) if row else 0
+
+    async def wallet_reconcile(self, user_id: int) -> Tuple[int, int]:
+        """Return (ledger balance, users.balance_irt) for a user.
+
+        The ledger balance is rebuilt from the latest snapshot plus the rows
+        after it, so it reads at most WALLET_SNAPSHOT_EVERY rows.
+        """
+        async with self.pool.reader() as db:
+            cur = await db.execute(
+                "SELECT ledger_id, balance_irt FROM wallet_snapshots WHERE user_id=? ORDER BY ledger_id DESC LIMIT 1",
+                (int(user_id),),
+            )
+            snap = await cur.fetchone()
+            base_id, base = (int(snap[0]), int(snap[1])) if snap else (0, 0)
+            cur = await db.execute(
+                "SELECT COALESCE(SUM(delta_irt), 0) FROM wallet_ledger WHERE user_id=? AND id > ?",
+                (int(user_id), base_id),
+            )
+            tail = int((await cur.fetchone())[0])
+            cur = await db.execute("SELECT balance_irt FROM users WHERE user_id=?", (int(user_id),))
+            row = await cur.fetchone()
+        return base + tail, int(row[0]) if row else 0
 
     async def list_all_users(self, limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 "SELECT user_id, username, phone, registered_at, balance_irt, is_blocked FROM users ORDER BY created_at DESC LIMIT ? OFFSET ?",
                 (limit, offset),
@@ -359,12 +1571,10 @@ class DB:
         phone = (phone or "").strip()
         if not phone:
             return
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "UPDATE users SET phone=?, registered_at=? WHERE user_id=?",
-                (phone, _now(), user_id),
-            )
-            await db.commit()
+        await self._write(
+            "UPDATE users SET phone=?, registered_at=? WHERE user_id=?",
+            (phone, _now(), user_id),
+        )
 
     async def delete_user_full(self, user_id: int) -> None:
         """Hard-delete a user and all their related records.
@@ -373,9 +1583,8 @@ class DB:
         any external resources (e.g., cloud servers).
         """
         uid = int(user_id)
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("BEGIN")
 
+        async def _op(db: aiosqlite.Connection) -> None:
             # ticket_messages depend on tickets
             await db.execute(
                 "DELETE FROM ticket_messages WHERE ticket_id IN (SELECT id FROM tickets WHERE user_id=?)",
@@ -387,6 +1596,12 @@ class DB:
             await db.execute("DELETE FROM traffic_purchases WHERE user_id=?", (uid,))
             await db.execute("DELETE FROM card_purchases WHERE user_id=?", (uid,))
             await db.execute("DELETE FROM invoices WHERE user_id=?", (uid,))
+            await db.execute("DELETE FROM wallet_snapshots WHERE user_id=?", (uid,))
+            await db.execute("DELETE FROM wallet_ledger WHERE user_id=?", (uid,))
+            for table in ("traffic_samples", "traffic_daily"):
+                await db.execute(
+                    f"DELETE FROM {table} WHERE order_id IN (SELECT id FROM orders WHERE user_id=?)", (uid,)
+                )
 
             # orders
             await db.execute("DELETE FROM orders WHERE user_id=?", (uid,))
@@ -394,10 +1609,10 @@ class DB:
             # finally user
             await db.execute("DELETE FROM users WHERE user_id=?", (uid,))
 
-            await db.commit()
+        await self._write_tx(_op)
 
     async def get_user_phone(self, user_id: int) -> Optional[str]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute("SELECT phone FROM users WHERE user_id=?", (user_id,))
             row = await cur.fetchone()
         return row[0] if row and row[0] else None
@@ -407,35 +1622,38 @@ class DB:
     # -------------------------
     async def create_plan(self, p: Dict[str, Any]) -> int:
         now = _now()
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(
-                """INSERT INTO plans(provider,country_code,location_name,server_type,title,vcpu,ram_gb,disk_gb,
-                   price_monthly_eur,price_hourly_eur,price_monthly_irt,hourly_enabled,price_hourly_irt,traffic_limit_gb,is_active,created_at)
-                   VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                (
-                    p["provider"],
-                    p["country_code"],
-                    p["location_name"],
-                    p["server_type"],
-                    p["title"],
-                    p.get("vcpu"),
-                    p.get("ram_gb"),
-                    p.get("disk_gb"),
-                    float(p.get('price_monthly_eur')) if p.get('price_monthly_eur') is not None else None,
-                    float(p.get('price_hourly_eur')) if p.get('price_hourly_eur') is not None else None,
-                    int(p['price_monthly_irt']),
-                    1 if p.get("hourly_enabled") else 0,
-                    int(p.get("price_hourly_irt", 0) or 0),
-                    int(p.get("traffic_limit_gb", 0) or 0),
-                    1 if p.get("is_active", True) else 0,
-                    now,
-                ),
-            )
-            await db.commit()
-            return int(cur.lastrowid)
+        rowid, _ = await self._write_rev(
+            "plans",
+            """INSERT INTO plans(provider,country_code,location_name,server_type,title,vcpu,ram_gb,disk_gb,
+               price_monthly_eur,price_hourly_eur,price_monthly_irt,hourly_enabled,price_hourly_irt,traffic_limit_gb,is_active,created_at)
+               VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+            (
+                p["provider"],
+                p["country_code"],
+                p["location_name"],
+                p["server_type"],
+                p["title"],
+                p.get("vcpu"),
+                p.get("ram_gb"),
+                p.get("disk_gb"),
+                float(p.get('price_monthly_eur')) if p.get('price_monthly_eur') is not None else None,
+                float(p.get('price_hourly_eur')) if p.get('price_hourly_eur') is not None else None,
+                int(p['price_monthly_irt']),
+                1 if p.get("hourly_enabled") else 0,
+                int(p.get("price_hourly_irt", 0) or 0),
+                int(p.get("traffic_limit_gb", 0) or 0),
+                1 if p.get("is_active", True) else 0,
+                now,
+            ),
+        )
+        return int(rowid)
 
     async def list_plans(self, provider: str, country_code: str, location_name: str) -> List[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        key = ("list_plans", provider, country_code, location_name)
+        hit = self._plans_cache.get(key)
+        if hit is not None:
+            return [dict(p) for p in hit]
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 """SELECT id, provider, country_code, location_name, server_type, title, vcpu, ram_gb, disk_gb,
                           price_monthly_eur, price_hourly_eur,
@@ -446,7 +1664,7 @@ class DB:
                 (provider, country_code, location_name),
             )
             rows = await cur.fetchall()
-        return [
+        out = [
             {
                 "id": r[0],
                 "provider": r[1],
@@ -467,6 +1685,8 @@ class DB:
             }
             for r in rows
         ]
+        self._plans_cache[key] = out
+        return [dict(p) for p in out]
 
     
     async def list_plans_by_provider(self, provider: str, only_active: Optional[bool] = True, limit: int = 200) -> List[Dict[str, Any]]:
@@ -478,7 +1698,7 @@ class DB:
         elif only_active is False:
             where += " AND is_active=0"
 
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 f"""SELECT id, provider, country_code, location_name, server_type, title, vcpu, ram_gb, disk_gb,
                           price_monthly_eur, price_hourly_eur,
@@ -515,7 +1735,7 @@ class DB:
         ]
 
     async def get_plan(self, plan_id: int) -> Optional[Dict[str, Any]]:
-            async with aiosqlite.connect(self.path) as db:
+            async with self.pool.reader() as db:
                 cur = await db.execute(
                     """SELECT id, provider, country_code, location_name, server_type, title, vcpu, ram_gb, disk_gb,
                               price_monthly_eur, price_hourly_eur,
@@ -548,7 +1768,11 @@ class DB:
     async def list_plan_countries(self, provider: str) -> List[str]:
         """Return distinct country codes that have active plans for a provider."""
         provider = str(provider or "").strip().lower()
-        async with aiosqlite.connect(self.path) as db:
+        key = ("list_plan_countries", provider)
+        hit = self._plans_cache.get(key)
+        if hit is not None:
+            return list(hit)
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 """SELECT DISTINCT country_code FROM plans
                    WHERE lower(provider)=? AND is_active=1
@@ -556,7 +1780,9 @@ class DB:
                 (provider,),
             )
             rows = await cur.fetchall()
-        return [str(r[0]).upper() for r in rows if r and r[0]]
+        out = [str(r[0]).upper() for r in rows if r and r[0]]
+        self._plans_cache[key] = out
+        return list(out)
 
     async def update_plan_fields(self, plan_id: int, **fields: Any) -> None:
         """Update a plan with a whitelisted set of fields.
@@ -583,9 +1809,7 @@ class DB:
         if not set_parts:
             return
         params.append(int(plan_id))
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(f"UPDATE plans SET {', '.join(set_parts)} WHERE id=?", tuple(params))
-            await db.commit()
+        await self._write_rev("plans", f"UPDATE plans SET {', '.join(set_parts)} WHERE id=?", tuple(params))
 
     # -------------------------
     # orders
@@ -604,58 +1828,22 @@ class DB:
         if kwargs:
             o = {**o, **kwargs}
 
-        now = _now()
-        user_id = int(o["user_id"])
-
-        provider = str(o.get("provider") or "")
-        country_code = str(o.get("country_code") or o.get("country") or "").upper().strip() or None
-        hcloud_server_id = _as_int_or_none(o.get("hcloud_server_id"))
-        ip4 = o.get("ip4")
-        name = o.get("name") or o.get("server_name")
-        server_type = o.get("server_type")
-        image_name = o.get("image_name") or o.get("os_name") or o.get("os")
-        location_name = o.get("location_name") or o.get("location")
-        billing_mode = str(o.get("billing_mode") or "monthly")
-        price_monthly_irt = int(o.get("price_monthly_irt") or 0)
-        price_hourly_irt = int(o.get("price_hourly_irt") or 0)
-        traffic_limit_gb = int(o.get("traffic_limit_gb") or 0)
-        status = str(o.get("status") or "active")
-        expires_at = int(o.get("expires_at") or now)
-        last_billed_hour = int(o.get("last_billed_hour") or 0)
-
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(
-                """INSERT INTO orders(
-                    user_id,provider,country_code,hcloud_server_id,ip4,name,server_type,image_name,location_name,
-                    billing_mode,price_monthly_irt,price_hourly_irt,traffic_limit_gb,status,purchased_at,expires_at,last_billed_hour
-                ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                (
-                    user_id,
-                    provider,
-                    country_code,
-                    hcloud_server_id,
-                    ip4,
-                    name,
-                    server_type,
-                    image_name,
-                    location_name,
-                    billing_mode,
-                    price_monthly_irt,
-                    price_hourly_irt,
-                    traffic_limit_gb,
-                    status,
-                    now,
-                    expires_at,
-                    last_billed_hour,
-                ),
-            )
-            await db.commit()
-            return int(cur.lastrowid)
+        async def _op(db: aiosqlite.Connection) -> int:
+            return await _insert_order(db, o)
 
-    async def set_order_status(self, order_id: int, status: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
+        rowid = await self._write_tx(_op)
+        self._order_changed(rowid)
+        return int(rowid)
+
+    async def set_order_status(self, order_id: int, status: str, notices: Sequence[Dict[str, Any]] = ()) -> None:
+        """notices are queued in the outbox in the same transaction (see _outbox_append)."""
+        async def _op(db: aiosqlite.Connection) -> int:
             await db.execute("UPDATE orders SET status=? WHERE id=?", (status, order_id))
-            await db.commit()
+            return await _outbox_append(db, notices)
+
+        queued = await self._write_tx(_op)
+        self._order_changed(order_id)
+        self._outbox_written(queued)
 
 
     async def set_order_credentials(
@@ -706,17 +1894,23 @@ class DB:
             return
         values.append(order_id)
         q = f"UPDATE orders SET {', '.join(fields)} WHERE id=?"
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(q, tuple(values))
-            await db.commit()
+        await self._write(q, tuple(values))
+        if status is not None:
+            self._order_changed(order_id)
 
-    async def update_order_status_and_expiry(self, order_id: int, status: str, expires_at: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
+    async def update_order_status_and_expiry(
+        self, order_id: int, status: str, expires_at: int, notices: Sequence[Dict[str, Any]] = ()
+    ) -> None:
+        async def _op(db: aiosqlite.Connection) -> int:
             await db.execute("UPDATE orders SET status=?, expires_at=? WHERE id=?", (status, int(expires_at), order_id))
-            await db.commit()
+            return await _outbox_append(db, notices)
+
+        queued = await self._write_tx(_op)
+        self._order_changed(order_id)
+        self._outbox_written(queued)
 
     async def list_user_orders(self, user_id: int) -> List[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 """SELECT id, ip4, name, server_type, image_name, location_name, billing_mode, status, purchased_at, expires_at,
                           traffic_limit_gb, traffic_used_gb, hcloud_server_id, price_monthly_irt, price_hourly_irt,
@@ -755,29 +1949,25 @@ class DB:
 
     async def delete_order(self, order_id: int) -> None:
         """Soft-delete an order (admin use)."""
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE orders SET status='deleted' WHERE id=?", (int(order_id),))
-            await db.commit()
+        await self._write("UPDATE orders SET status='deleted' WHERE id=?", (int(order_id),))
 
     async def delete_user_orders(self, user_id: int) -> None:
         """Soft-delete all orders of a user (admin use)."""
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE orders SET status='deleted' WHERE user_id=?", (int(user_id),))
-            await db.commit()
+        await self._write("UPDATE orders SET status='deleted' WHERE user_id=?", (int(user_id),))
 
     async def get_order(self, order_id: int, user_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
         q = """SELECT id, user_id, provider, country_code, hcloud_server_id, ip4, name, server_type, image_name, location_name, login_user, login_pass, manual_details,
                       monitoring_url, monitoring_user, monitoring_pass,
                       billing_mode, price_monthly_irt, price_hourly_irt, traffic_limit_gb, traffic_used_gb, traffic_last_ts,
                       status, purchased_at, expires_at, last_billed_hour,
-                      last_hourly_charge_at, last_warn_at, suspended_at, delete_at
+                      last_hourly_charge_at, last_warn_at, suspended_at, delete_at, traffic_settled_until
                FROM orders WHERE id=?"""
         params: Tuple[Any, ...] = (order_id,)
         if user_id is not None:
             q += " AND user_id=?"
             params = (order_id, user_id)
 
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(q, params)
             r = await cur.fetchone()
         if not r:
@@ -814,13 +2004,14 @@ class DB:
             "last_warn_at": int(r[27] or 0),
             "suspended_at": int(r[28] or 0),
             "delete_at": int(r[29] or 0),
+            "traffic_settled_until": int(r[30] or 0),
         }
 
     # -------------------------
     # Admin plan management
     # -------------------------
     async def list_all_plan_countries(self) -> List[str]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute("SELECT DISTINCT country_code FROM plans ORDER BY country_code")
             rows = await cur.fetchall()
         return [r[0] for r in rows if r and r[0]]
@@ -833,7 +2024,7 @@ class DB:
         if g in ("cx","cpx","cax"):
             where += " AND lower(server_type) LIKE ?"
             params.append(f"{g}%")
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 f"""SELECT id, provider, country_code, location_name, server_type, title, vcpu, ram_gb, disk_gb,
                           price_monthly_eur, price_hourly_eur,
@@ -872,7 +2063,7 @@ class DB:
         limit = int(limit) if limit else 50
         if limit <= 0:
             limit = 50
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 """SELECT id, user_id, provider, country_code, hcloud_server_id, ip4, name, server_type, image_name, location_name, login_user, login_pass, manual_details,
                           billing_mode, price_monthly_irt, price_hourly_irt, traffic_limit_gb, traffic_used_gb, traffic_last_ts,
@@ -913,39 +2104,33 @@ class DB:
         return out
 
     async def toggle_plan_active(self, plan_id: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE plans SET is_active=CASE WHEN is_active=1 THEN 0 ELSE 1 END WHERE id=?", (plan_id,))
-            await db.commit()
+        await self._write_rev("plans", "UPDATE plans SET is_active=CASE WHEN is_active=1 THEN 0 ELSE 1 END WHERE id=?", (plan_id,))
 
     async def delete_plan(self, plan_id: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("DELETE FROM plans WHERE id=?", (plan_id,))
-            await db.commit()
+        await self._write_rev("plans", "DELETE FROM plans WHERE id=?", (plan_id,))
 
     async def update_plan_prices(self, plan_id: int, *, monthly_eur: Optional[float], hourly_eur: Optional[float],
                                 monthly_irt: int, hourly_irt: int, hourly_enabled: bool) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "UPDATE plans SET price_monthly_eur=?, price_hourly_eur=?, price_monthly_irt=?, price_hourly_irt=?, hourly_enabled=? WHERE id=?",
-                (monthly_eur, hourly_eur, int(monthly_irt), int(hourly_irt), 1 if hourly_enabled else 0, int(plan_id)),
-            )
-            await db.commit()
+        await self._write_rev(
+            "plans",
+            "UPDATE plans SET price_monthly_eur=?, price_hourly_eur=?, price_monthly_irt=?, price_hourly_irt=?, hourly_enabled=? WHERE id=?",
+            (monthly_eur, hourly_eur, int(monthly_irt), int(hourly_irt), 1 if hourly_enabled else 0, int(plan_id)),
+        )
 
 
     async def update_plan_traffic_limit(self, plan_id: int, *, traffic_limit_gb: int) -> None:
         """Update traffic limit (GB). 0 means unlimited."""
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "UPDATE plans SET traffic_limit_gb=? WHERE id=?",
-                (int(traffic_limit_gb), int(plan_id)),
-            )
-            await db.commit()
+        await self._write_rev(
+            "plans",
+            "UPDATE plans SET traffic_limit_gb=? WHERE id=?",
+            (int(traffic_limit_gb), int(plan_id)),
+        )
 
     async def get_plan_sales_counts(self, plan_ids: List[int]) -> Dict[int, int]:
         if not plan_ids:
             return {}
         placeholders = ",".join("?" for _ in plan_ids)
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 f"""SELECT plan_id, COUNT(*) FROM orders
                     WHERE plan_id IN ({placeholders}) AND status != 'deleted'
@@ -957,7 +2142,7 @@ class DB:
 
 
     async def list_active_orders(self) -> List[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 """SELECT id, user_id, ip4, name, server_type, location_name, status, hcloud_server_id,
                           billing_mode, expires_at, traffic_limit_gb, traffic_used_gb, price_monthly_irt, price_hourly_irt
@@ -985,7 +2170,7 @@ class DB:
         ]
 
     async def list_hourly_orders(self, limit: int = 500) -> List[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 """SELECT id, user_id, ip4, name, server_type, image_name, location_name, billing_mode, status,
                           purchased_at, expires_at, hcloud_server_id,
@@ -1028,19 +2213,135 @@ class DB:
         return out
 
     async def update_order_traffic(self, order_id: int, used_gb: float, ts: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE orders SET traffic_used_gb=?, traffic_last_ts=? WHERE id=?", (float(used_gb), int(ts), order_id))
-            await db.commit()
+        await self._write("UPDATE orders SET traffic_used_gb=?, traffic_last_ts=? WHERE id=?", (float(used_gb), int(ts), order_id))
+
+    async def add_order_traffic(
+        self,
+        order_id: int,
+        since: int,
+        settled_until: int,
+        settled_gb: float,
+        partial_gb: float,
+        ts: int,
+        samples: Sequence[Tuple[int, float]] = (),
+    ) -> Optional[float]:
+        """Add completed hours [since, settled_until) to the settled total and set
+        traffic_used_gb = settled + partial (hours after settled_until). samples
+        are the (hour_ts, bytes_out) points of the window (unsettled hours are
+        overwritten on the next call). Returns the new traffic_used_gb, or None
+        if another run already moved past `since`."""
+        async def _op(db: aiosqlite.Connection) -> Optional[float]:
+            cur = await db.execute(
+                """UPDATE orders SET traffic_settled_gb = traffic_settled_gb + ?,
+                                     traffic_settled_until = ?,
+                                     traffic_used_gb = traffic_settled_gb + ? + ?,
+                                     traffic_last_ts = ?
+                   WHERE id=? AND traffic_settled_until IN (0, ?)
+                   RETURNING traffic_used_gb""",
+                (float(settled_gb), int(settled_until), float(settled_gb), float(partial_gb), int(ts),
+                 int(order_id), int(since)),
+            )
+            rows = await cur.fetchall()
+            if not rows:
+                return None
+            if samples:
+                await db.executemany(
+                    """INSERT INTO traffic_samples(order_id, hour_ts, bytes_out) VALUES(?,?,?)
+                       ON CONFLICT(order_id, hour_ts) DO UPDATE SET bytes_out=excluded.bytes_out""",
+                    [(int(order_id), int(h), float(b)) for h, b in samples],
+                )
+            return float(rows[0][0])
+
+        return await self._write_tx(_op)
+
+    # -------------------------
+    # Traffic history (traffic_samples hourly + traffic_daily rollups)
+    # -------------------------
+    async def order_traffic_daily(self, order_id: int, since: int) -> List[Tuple[int, float]]:
+        """(day_ts, bytes_out) per UTC day from `since`, hourly and compacted rows merged."""
+        day0 = int(since) - int(since) % 86400
+        days: Dict[int, float] = {}
+        async with self.pool.reader() as db:
+            cur = await db.execute(
+                "SELECT day_ts, bytes_out FROM traffic_daily WHERE order_id=? AND day_ts>=?", (int(order_id), day0)
+            )
+            for d, v in await cur.fetchall():
+                days[int(d)] = days.get(int(d), 0.0) + float(v or 0.0)
+            cur = await db.execute(
+                "SELECT hour_ts, bytes_out FROM traffic_samples WHERE order_id=? AND hour_ts>=?", (int(order_id), day0)
+            )
+            for h, v in await cur.fetchall():
+                d = int(h) - int(h) % 86400
+                days[d] = days.get(d, 0.0) + float(v or 0.0)
+        return sorted(days.items())
+
+    async def order_traffic_since(self, order_id: int, since: int) -> float:
+        """Outbound bytes from the hourly samples since `since` (use for windows inside the hourly retention)."""
+        async with self.pool.reader() as db:
+            cur = await db.execute(
+                "SELECT COALESCE(SUM(bytes_out), 0) FROM traffic_samples WHERE order_id=? AND hour_ts>=?",
+                (int(order_id), int(since)),
+            )
+            r = await cur.fetchone()
+        return float(r[0] or 0.0)
 
+    async def top_traffic_orders(self, since: int, limit: int = 10) -> List[Dict[str, Any]]:
+        """Orders with the most outbound traffic since `since` (day granularity for compacted days)."""
+        day0 = int(since) - int(since) % 86400
+        async with self.pool.reader() as db:
+            cur = await db.execute(
+                """SELECT t.order_id, SUM(t.b) AS total, o.user_id, o.ip4, o.status, o.traffic_limit_gb FROM (
+                       SELECT order_id, bytes_out AS b FROM traffic_daily WHERE day_ts>=?
+                       UNION ALL
+                       SELECT order_id, bytes_out FROM traffic_samples WHERE hour_ts>=?
+                   ) t LEFT JOIN orders o ON o.id = t.order_id
+                   GROUP BY t.order_id ORDER BY total DESC LIMIT ?""",
+                (day0, int(since), int(limit)),
+            )
+            rows = await cur.fetchall()
+        return [
+            {
+                "order_id": int(r[0]),
+                "bytes_out": float(r[1] or 0.0),
+                "user_id": r[2],
+                "ip4": r[3],
+                "status": r[4],
+                "traffic_limit_gb": int(r[5] or 0),
+            }
+            for r in rows
+        ]
+
+    async def compact_traffic_samples(self, before_ts: int) -> int:
+        """Roll hourly samples of whole days before `before_ts` into traffic_daily and drop them.
+        Returns the number of hourly rows removed."""
+        cutoff = int(before_ts) - int(before_ts) % 86400
+
+        async def _op(db: aiosqlite.Connection) -> int:
+            await db.execute(
+                """INSERT INTO traffic_daily(order_id, day_ts, bytes_out)
+                   SELECT order_id, hour_ts - hour_ts % 86400, SUM(bytes_out) FROM traffic_samples
+                   WHERE hour_ts < ? GROUP BY order_id, hour_ts - hour_ts % 86400
+                   ON CONFLICT(order_id, day_ts) DO UPDATE SET bytes_out = bytes_out + excluded.bytes_out""",
+                (cutoff,),
+            )
+            cur = await db.execute("DELETE FROM traffic_samples WHERE hour_ts < ?", (cutoff,))
+            return int(cur.rowcount)
 
-    async def add_order_traffic_limit(self, order_id: int, add_gb: int) -> None:
+        return await self._write_tx(_op)
+
+
+    async def add_order_traffic_limit(self, order_id: int, add_gb: int, notices: Sequence[Dict[str, Any]] = ()) -> None:
         """Increase an order's traffic_limit_gb by add_gb (GB)."""
-        async with aiosqlite.connect(self.path) as db:
+        async def _op(db: aiosqlite.Connection) -> int:
             await db.execute(
                 "UPDATE orders SET traffic_limit_gb = traffic_limit_gb + ? WHERE id=?",
                 (int(add_gb), int(order_id)),
             )
-            await db.commit()
+            return await _outbox_append(db, notices)
+
+        queued = await self._write_tx(_op)
+        self._order_changed(order_id)
+        self._outbox_written(queued)
 
     async def create_traffic_package(
         self,
@@ -1052,14 +2353,12 @@ class DB:
         is_active: bool = True,
     ) -> int:
         cc = (country_code or "").upper().strip()
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(
-                """INSERT INTO traffic_packages (country_code, title, volume_gb, price_irt, is_active, created_at)
-                   VALUES (?,?,?,?,?,?)""",
-                (cc, (title or "").strip(), int(volume_gb), int(price_irt), 1 if is_active else 0, _now()),
-            )
-            await db.commit()
-            return int(cur.lastrowid)
+        rowid, _ = await self._write(
+            """INSERT INTO traffic_packages (country_code, title, volume_gb, price_irt, is_active, created_at)
+               VALUES (?,?,?,?,?,?)""",
+            (cc, (title or "").strip(), int(volume_gb), int(price_irt), 1 if is_active else 0, _now()),
+        )
+        return int(rowid)
 
     async def list_traffic_packages(self, country_code: str, *, active_only: bool = True, limit: int = 200) -> List[Dict[str, Any]]:
         cc = (country_code or "").upper().strip()
@@ -1072,7 +2371,7 @@ class DB:
                  ORDER BY price_irt ASC, volume_gb ASC, id ASC
                  LIMIT ?"""
         params.append(int(limit))
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(q, tuple(params))
             rows = await cur.fetchall()
         out: List[Dict[str, Any]] = []
@@ -1091,7 +2390,7 @@ class DB:
         return out
 
     async def get_traffic_package(self, package_id: int) -> Optional[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 """SELECT id, country_code, title, volume_gb, price_irt, is_active, created_at
                    FROM traffic_packages WHERE id=?""",
@@ -1111,19 +2410,15 @@ class DB:
         }
 
     async def toggle_traffic_package_active(self, package_id: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                """UPDATE traffic_packages
-                   SET is_active = CASE WHEN is_active=1 THEN 0 ELSE 1 END
-                   WHERE id=?""",
-                (int(package_id),),
-            )
-            await db.commit()
+        await self._write(
+            """UPDATE traffic_packages
+               SET is_active = CASE WHEN is_active=1 THEN 0 ELSE 1 END
+               WHERE id=?""",
+            (int(package_id),),
+        )
 
     async def delete_traffic_package(self, package_id: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("DELETE FROM traffic_packages WHERE id=?", (int(package_id),))
-            await db.commit()
+        await self._write("DELETE FROM traffic_packages WHERE id=?", (int(package_id),))
 
     async def create_traffic_purchase(
         self,
@@ -1136,97 +2431,286 @@ class DB:
         invoice_id: Optional[int],
         status: str,
     ) -> int:
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(
-                """INSERT INTO traffic_purchases (user_id, order_id, package_id, volume_gb, price_irt, invoice_id, status, created_at)
-                   VALUES (?,?,?,?,?,?,?,?)""",
-                (
-                    int(user_id),
-                    int(order_id),
-                    _as_int_or_none(package_id),
-                    int(volume_gb),
-                    int(price_irt),
-                    _as_int_or_none(invoice_id),
-                    (status or "").strip(),
-                    _now(),
-                ),
-            )
-            await db.commit()
-            return int(cur.lastrowid)
+        rowid, _ = await self._write(
+            """INSERT INTO traffic_purchases (user_id, order_id, package_id, volume_gb, price_irt, invoice_id, status, created_at)
+               VALUES (?,?,?,?,?,?,?,?)""",
+            (
+                int(user_id),
+                int(order_id),
+                _as_int_or_none(package_id),
+                int(volume_gb),
+                int(price_irt),
+                _as_int_or_none(invoice_id),
+                (status or "").strip(),
+                _now(),
+            ),
+        )
+        return int(rowid)
     async def set_last_billed_hour(self, order_id: int, hour_ts: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE orders SET last_billed_hour=? WHERE id=?", (int(hour_ts), order_id))
-            await db.commit()
+        await self._write("UPDATE orders SET last_billed_hour=? WHERE id=?", (int(hour_ts), order_id))
 
     async def update_order_hourly_tick(self, order_id: int, last_hourly_charge_at: int, last_warn_at: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
+        await self._write(
+            "UPDATE orders SET last_hourly_charge_at=?, last_warn_at=? WHERE id=?",
+            (int(last_hourly_charge_at), int(last_warn_at), order_id),
+        )
+
+    async def set_order_suspended_balance(self, order_id: int, suspended_at: int, delete_at: int) -> None:
+        await self._write(
+            "UPDATE orders SET status='suspended_balance', suspended_at=?, delete_at=? WHERE id=?",
+            (int(suspended_at), int(delete_at), order_id),
+        )
+
+    async def clear_order_suspension(self, order_id: int, notices: Sequence[Dict[str, Any]] = ()) -> None:
+        async def _op(db: aiosqlite.Connection) -> int:
             await db.execute(
-                "UPDATE orders SET last_hourly_charge_at=?, last_warn_at=? WHERE id=?",
-                (int(last_hourly_charge_at), int(last_warn_at), order_id),
+                "UPDATE orders SET status='active', suspended_at=0, delete_at=0 WHERE id=?",
+                (order_id,),
             )
-            await db.commit()
+            return await _outbox_append(db, notices)
+
+        queued = await self._write_tx(_op)
+        self._order_changed(order_id)
+        self._outbox_written(queued)
+
+    async def list_order_schedule(
+        self, order_ids: Optional[List[int]] = None, user_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """Timing fields of active orders (all, just order_ids, or one user's) for the job scheduler."""
+        sql = """SELECT id, user_id, billing_mode, hcloud_server_id, expires_at, price_hourly_irt,
+                        last_hourly_charge_at, last_warn_at, traffic_limit_gb, traffic_last_ts, purchased_at
+                 FROM orders WHERE status='active'"""
+        params: Tuple[Any, ...] = ()
+        if order_ids is not None:
+            if not order_ids:
+                return []
+            sql += f" AND id IN ({','.join('?' for _ in order_ids)})"
+            params = tuple(int(i) for i in order_ids)
+        if user_id is not None:
+            sql += " AND user_id=?"
+            params += (int(user_id),)
+        async with self.pool.reader() as db:
+            cur = await db.execute(sql, params)
+            rows = await cur.fetchall()
+        return [
+            {
+                "id": r[0],
+                "user_id": r[1],
+                "billing_mode": r[2],
+                "hcloud_server_id": r[3],
+                "expires_at": int(r[4] or 0),
+                "price_hourly_irt": int(r[5] or 0),
+                "last_hourly_charge_at": int(r[6] or 0),
+                "last_warn_at": int(r[7] or 0),
+                "traffic_limit_gb": int(r[8] or 0),
+                "traffic_last_ts": int(r[9] or 0),
+                "purchased_at": int(r[10] or 0),
+            }
+            for r in rows
+        ]
 
-    async def set_order_suspended_balance(self, order_id: int, suspended_at: int, delete_at: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
+    async def run_hourly_billing(
+        self,
+        now: int,
+        warn_balance: int,
+        cutoff_balance: int,
+        notices_for: Optional[Callable[[Dict[str, Any]], Sequence[Dict[str, Any]]]] = None,
+    ) -> List[Dict[str, Any]]:
+        """Bill every active hourly order in one write transaction.
+
+        For each order the whole hours since last_hourly_charge_at are charged
+        at price_hourly_irt. A user's orders are charged in id order while
+        their running total fits the balance; the rest are suspended. Users at
+        or below cutoff_balance are suspended without a charge; users at or
+        below warn_balance get last_warn_at stamped (at most once an hour).
+
+        Returns one dict per affected order with "action" in
+        'charged' | 'suspended' | 'cutoff' | None and a "warn" flag, so the
+        caller can power off servers outside the transaction. notices_for(event)
+        gives the event's notifications; they are queued in the outbox in the
+        same transaction.
+        """
+        now = int(now)
+        eligible = (
+            "billing_mode='hourly' AND status='active' AND COALESCE(price_hourly_irt,0) > 0 "
+            "AND COALESCE(hcloud_server_id,0) != 0"
+        )
+
+        async def _op(db: aiosqlite.Connection) -> Tuple[List[Dict[str, Any]], int]:
+            # older rows never got a charge timestamp
             await db.execute(
-                "UPDATE orders SET status='suspended_balance', suspended_at=?, delete_at=? WHERE id=?",
-                (int(suspended_at), int(delete_at), order_id),
+                f"""UPDATE orders SET last_hourly_charge_at =
+                        CASE WHEN COALESCE(purchased_at,0) > 0 THEN purchased_at ELSE ? END
+                    WHERE {eligible} AND COALESCE(last_hourly_charge_at,0) <= 0""",
+                (now,),
+            )
+            await db.execute(
+                """CREATE TEMP TABLE IF NOT EXISTS hourly_bill (
+                     order_id INTEGER PRIMARY KEY, user_id INTEGER, balance INTEGER, hours INTEGER,
+                     cost INTEGER, cum INTEGER, warn INTEGER, cutoff INTEGER, invoice_id INTEGER)"""
+            )
+            await db.execute("CREATE INDEX IF NOT EXISTS temp.idx_hourly_bill_user ON hourly_bill(user_id)")
+            await db.execute("DELETE FROM hourly_bill")
+            # cum = running total of due charges per user, in order id order
+            await db.execute(
+                """WITH due AS (
+                        SELECT o.id AS order_id, o.user_id AS user_id, COALESCE(u.balance_irt,0) AS balance,
+                               MAX(0, (? - o.last_hourly_charge_at) / 3600) AS hours, o.price_hourly_irt AS rate,
+                               COALESCE(u.balance_irt,0) <= ? AND ? - COALESCE(o.last_warn_at,0) >= 3600 AS warn,
+                               COALESCE(u.balance_irt,0) <= ? AS cutoff
+                        FROM orders o LEFT JOIN users u ON u.user_id = o.user_id
+                        WHERE o.billing_mode='hourly' AND o.status='active' AND COALESCE(o.price_hourly_irt,0) > 0
+                          AND COALESCE(o.hcloud_server_id,0) != 0
+                    )
+                    INSERT INTO hourly_bill(order_id, user_id, balance, hours, cost, cum, warn, cutoff)
+                    SELECT order_id, user_id, balance, hours, hours * rate,
+                           CASE WHEN cutoff = 0 AND hours > 0 THEN
+                               SUM(CASE WHEN cutoff = 0 AND hours > 0 THEN hours * rate ELSE 0 END)
+                                   OVER (PARTITION BY user_id ORDER BY order_id)
+                           END,
+                           warn, cutoff
+                    FROM due""",
+                (now, int(warn_balance), now, int(cutoff_balance)),
+            )
+            await db.execute(
+                "UPDATE orders SET last_warn_at=? WHERE id IN (SELECT order_id FROM hourly_bill WHERE warn=1)",
+                (now,),
+            )
+            await db.execute(
+                """UPDATE orders SET status='suspended_balance', suspended_at=?, delete_at=0
+                   WHERE id IN (SELECT order_id FROM hourly_bill WHERE cutoff=1 OR cum > balance)""",
+                (now,),
             )
-            await db.commit()
 
-    async def clear_order_suspension(self, order_id: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
+            # charges
             await db.execute(
-                "UPDATE orders SET status='active', suspended_at=0, delete_at=0 WHERE id=?",
-                (order_id,),
+                """UPDATE users SET balance_irt = balance_irt - (
+                       SELECT SUM(cost) FROM hourly_bill b WHERE b.user_id = users.user_id AND b.cum <= b.balance)
+                   WHERE user_id IN (SELECT user_id FROM hourly_bill WHERE cum <= balance)"""
+            )
+            cur = await db.execute(
+                """INSERT INTO invoices(user_id, amount_irt, method, desc, status, created_at, order_id)
+                   SELECT user_id, cost, 'wallet', 'Hourly charge order#' || order_id || ' (' || hours || 'h)', 'paid', ?, order_id
+                   FROM hourly_bill WHERE cum <= balance ORDER BY order_id
+                   RETURNING id, order_id""",
+                (now,),
+            )
+            inv_rows = await cur.fetchall()
+            await db.executemany(
+                "UPDATE hourly_bill SET invoice_id=? WHERE order_id=?",
+                [(int(r[0]), int(r[1])) for r in inv_rows],
+            )
+            await db.execute(
+                """INSERT INTO wallet_ledger(user_id, delta_irt, balance_after, reason, order_id, invoice_id, created_at)
+                   SELECT user_id, -cost, balance - cum, 'hourly', order_id, invoice_id, ?
+                   FROM hourly_bill WHERE cum <= balance ORDER BY user_id, order_id""",
+                (now,),
             )
-            await db.commit()
+            await db.execute(
+                """UPDATE orders SET last_hourly_charge_at = orders.last_hourly_charge_at + b.hours * 3600,
+                          last_billed_hour = (orders.last_hourly_charge_at + b.hours * 3600) / 3600
+                   FROM hourly_bill b WHERE orders.id = b.order_id AND b.cum <= b.balance"""
+            )
+            await _snapshot_due(db, "SELECT user_id FROM hourly_bill WHERE cum <= balance")
+
+            cur = await db.execute(
+                """SELECT b.order_id, b.user_id, b.balance, b.hours, b.cost, b.cum, b.warn, b.cutoff,
+                          o.hcloud_server_id, o.ip4
+                   FROM hourly_bill b JOIN orders o ON o.id = b.order_id
+                   WHERE b.warn = 1 OR b.cutoff = 1 OR b.cum IS NOT NULL
+                   ORDER BY b.order_id"""
+            )
+            rows = await cur.fetchall()
+            await db.execute("DELETE FROM hourly_bill")
+
+            out: List[Dict[str, Any]] = []
+            for r in rows:
+                balance, cum = int(r[2]), r[5]
+                if r[7]:
+                    action: Optional[str] = "cutoff"
+                elif cum is None:
+                    action = None
+                elif int(cum) <= balance:
+                    action = "charged"
+                else:
+                    action = "suspended"
+                out.append({
+                    "order_id": int(r[0]),
+                    "user_id": int(r[1]),
+                    "balance_irt": balance,
+                    "balance_after": balance - int(cum) if action == "charged" else balance,
+                    "hours": int(r[3]),
+                    "cost_irt": int(r[4]) if action == "charged" else 0,
+                    "warn": bool(r[6]),
+                    "action": action,
+                    "hcloud_server_id": r[8],
+                    "ip4": r[9],
+                })
+            queued = 0
+            if notices_for is not None:
+                for ev in out:
+                    queued += await _outbox_append(db, notices_for(ev))
+            return out, queued
+
+        events, queued = await self._write_tx(_op)
+        self._outbox_written(queued)
+        return events
 
     # -------------------------
     # invoices
     # -------------------------
     async def create_invoice(self, user_id: int, amount_irt: int, method: str, desc: str, status: str) -> int:
         now = _now()
-        async with aiosqlite.connect(self.path) as db:
+        rowid, _ = await self._write(
+            "INSERT INTO invoices(user_id,amount_irt,method,desc,status,created_at) VALUES(?,?,?,?,?,?)",
+            (int(user_id), int(amount_irt), str(method), str(desc), str(status), now),
+        )
+        return int(rowid)
+
+    async def get_invoice(self, invoice_id: int) -> Optional[Dict[str, Any]]:
+        async with self.pool.reader() as db:
             cur = await db.execute(
-                "INSERT INTO invoices(user_id,amount_irt,method,desc,status,created_at) VALUES(?,?,?,?,?,?)",
-                (int(user_id), int(amount_irt), str(method), str(desc), str(status), now),
+                "SELECT id,user_id,amount_irt,method,desc,status,created_at,order_id FROM invoices WHERE id=?",
+                (int(invoice_id),),
             )
-            await db.commit()
-            return int(cur.lastrowid)
+            r = await cur.fetchone()
+        if not r:
+            return None
+        return {
+            "id": r[0],
+            "user_id": r[1],
+            "amount_irt": int(r[2] or 0),
+            "method": r[3],
+            "desc": r[4],
+            "status": r[5],
+            "created_at": int(r[6] or 0),
+            "order_id": r[7],
+        }
 
     async def set_invoice_status(self, invoice_id: int, status: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE invoices SET status=? WHERE id=?", (str(status), int(invoice_id)))
-            await db.commit()
+        await self._write("UPDATE invoices SET status=? WHERE id=?", (str(status), int(invoice_id)))
 
     async def attach_invoice_to_order(self, invoice_id: int, order_id: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE invoices SET order_id=? WHERE id=?", (int(order_id), int(invoice_id)))
-            await db.commit()
+        await self._write("UPDATE invoices SET order_id=? WHERE id=?", (int(order_id), int(invoice_id)))
 
     # -------------------------
     # card purchases
     # -------------------------
     async def create_card_purchase(self, invoice_id: int, user_id: int, payload_json: str) -> None:
         now = _now()
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "INSERT OR REPLACE INTO card_purchases(invoice_id,user_id,payload_json,receipt_file_id,status,created_at) VALUES(?,?,?,?,?,?)",
-                (int(invoice_id), int(user_id), str(payload_json), None, "waiting_receipt", now),
-            )
-            await db.commit()
+        await self._write(
+            "INSERT OR REPLACE INTO card_purchases(invoice_id,user_id,payload_json,receipt_file_id,status,created_at) VALUES(?,?,?,?,?,?)",
+            (int(invoice_id), int(user_id), str(payload_json), None, "waiting_receipt", now),
+        )
 
     async def set_card_purchase_receipt(self, invoice_id: int, receipt_file_id: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "UPDATE card_purchases SET receipt_file_id=?, status='sent_to_admin' WHERE invoice_id=?",
-                (str(receipt_file_id), int(invoice_id)),
-            )
-            await db.commit()
+        await self._write(
+            "UPDATE card_purchases SET receipt_file_id=?, status='sent_to_admin' WHERE invoice_id=?",
+            (str(receipt_file_id), int(invoice_id)),
+        )
 
     async def get_card_purchase(self, invoice_id: int) -> Optional[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 "SELECT invoice_id,user_id,payload_json,receipt_file_id,status,created_at FROM card_purchases WHERE invoice_id=?",
                 (int(invoice_id),),
@@ -1244,12 +2728,66 @@ class DB:
         }
 
     async def set_card_purchase_status(self, invoice_id: int, status: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE card_purchases SET status=? WHERE invoice_id=?", (str(status), int(invoice_id)))
-            await db.commit()
+        await self._write("UPDATE card_purchases SET status=? WHERE invoice_id=?", (str(status), int(invoice_id)))
+
+    async def resolve_card_purchase(
+        self,
+        invoice_id: int,
+        status: str,
+        *,
+        credit_irt: int = 0,
+        order_id: Optional[int] = None,
+        notices: Sequence[Dict[str, Any]] = (),
+    ) -> bool:
+        """Move a still-open card purchase to status in one transaction.
+
+        'approved' also marks the invoice paid (and links it to order_id) and
+        'rejected' marks it rejected; credit_irt > 0 is added to the buyer's
+        wallet as a 'topup'.
+        Returns False (and changes nothing) if the purchase was already
+        approved, rejected or handed to provisioning, so a second click
+        neither credits twice nor queues a second message.
+        """
+        inv_status = {"approved": "paid", "rejected": "rejected"}.get(status)
+        credit = int(credit_irt or 0)
+
+        async def _op(db: aiosqlite.Connection) -> Tuple[int, int]:
+            cur = await db.execute(
+                """UPDATE card_purchases SET status=?
+                   WHERE invoice_id=? AND status NOT IN ('approved','rejected','provisioning')
+                   RETURNING user_id""",
+                (str(status), int(invoice_id)),
+            )
+            rows = await cur.fetchall()
+            if not rows:
+                return -1, 0
+            user_id = int(rows[0][0])
+            if inv_status:
+                await db.execute(
+                    "UPDATE invoices SET status=?, order_id=COALESCE(?, order_id) WHERE id=?",
+                    (inv_status, _as_int_or_none(order_id), int(invoice_id)),
+                )
+            if credit > 0:
+                cur = await db.execute(
+                    "UPDATE users SET balance_irt = balance_irt + ? WHERE user_id=? RETURNING balance_irt",
+                    (credit, user_id),
+                )
+                bal_rows = await cur.fetchall()
+                if not bal_rows:
+                    raise ValueError(f"user {user_id} not found")
+                await _ledger_append(db, user_id, credit, int(bal_rows[0][0]), "topup", None, int(invoice_id))
+            return await _outbox_append(db, notices), user_id
+
+        queued, user_id = await self._write_tx(_op)
+        if queued < 0:
+            return False
+        self._outbox_written(queued)
+        if credit > 0:
+            self._balance_changed(user_id)
+        return True
 
     async def list_pending_card_purchases(self, limit: int = 30) -> List[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 """SELECT invoice_id,user_id,payload_json,receipt_file_id,status,created_at
                    FROM card_purchases
@@ -1271,12 +2809,550 @@ class DB:
             for r in rows
         ]
 
+    # -------------------------
+    # provisioning jobs
+    # -------------------------
+    async def create_provisioning_job(
+        self,
+        *,
+        user_id: int,
+        invoice_id: Optional[int],
+        source: str,
+        amount_irt: int,
+        payload: Dict[str, Any],
+        chat_id: Optional[int] = None,
+        message_id: Optional[int] = None,
+    ) -> int:
+        async def _op(db: aiosqlite.Connection) -> int:
+            return await _insert_provisioning_job(
+                db, user_id=user_id, invoice_id=invoice_id, source=source, amount_irt=amount_irt,
+                payload=payload, chat_id=chat_id, message_id=message_id,
+            )
+
+        return await self._write_tx(_op)
+
+    async def start_card_provisioning(self, invoice_id: int, amount_irt: int, payload: Dict[str, Any]) -> Optional[int]:
+        """Move a still-open card purchase to 'provisioning' and queue its 'card' build
+        in one transaction. Returns the job id, or None if the purchase was
+        already approved, rejected or handed to provisioning."""
+        async def _op(db: aiosqlite.Connection) -> Optional[int]:
+            cur = await db.execute(
+                """UPDATE card_purchases SET status='provisioning'
+                   WHERE invoice_id=? AND status NOT IN ('approved','rejected','provisioning')
+                   RETURNING user_id""",
+                (int(invoice_id),),
+            )
+            rows = await cur.fetchall()
+            if not rows:
+                return None
+            return await _insert_provisioning_job(
+                db, user_id=int(rows[0][0]), invoice_id=invoice_id, source="card",
+                amount_irt=amount_irt, payload=payload,
+            )
+
+        return await self._write_tx(_op)
+
+    async def get_provisioning_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        async with self.pool.reader() as db:
+            cur = await db.execute(
+                """SELECT id, user_id, invoice_id, source, amount_irt, payload_json, state, attempts,
+                          hcloud_server_id, ip4, root_password, order_id, chat_id, message_id, error,
+                          created_at, updated_at
+                   FROM provisioning_jobs WHERE id=?""",
+                (int(job_id),),
+            )
+            r = await cur.fetchone()
+        if not r:
+            return None
+        try:
+            payload = json.loads(r[5] or "{}")
+        except Exception:
+            payload = {}
+        return {
+            "id": int(r[0]),
+            "user_id": int(r[1]),
+            "invoice_id": r[2],
+            "source": r[3],
+            "amount_irt": int(r[4] or 0),
+            "payload": payload,
+            "state": r[6],
+            "attempts": int(r[7] or 0),
+            "hcloud_server_id": r[8],
+            "ip4": r[9],
+            "root_password": r[10],
+            "order_id": r[11],
+            "chat_id": r[12],
+            "message_id": r[13],
+            "error": r[14],
+            "created_at": int(r[15] or 0),
+            "updated_at": int(r[16] or 0),
+        }
+
+    _PROVISIONING_FIELDS = {
+        "state", "attempts", "hcloud_server_id", "ip4", "root_password", "order_id", "error", "chat_id", "message_id",
+    }
+
+    async def update_provisioning_job(self, job_id: int, **fields: Any) -> None:
+        """Set any of state/attempts/hcloud_server_id/ip4/root_password/order_id/error/chat_id/message_id."""
+        cols = [k for k in fields if k in self._PROVISIONING_FIELDS]
+        if not cols:
+            return
+        sets = ", ".join(f"{k}=?" for k in cols)
+        await self._write(
+            f"UPDATE provisioning_jobs SET {sets}, updated_at=? WHERE id=?",
+            tuple(fields[k] for k in cols) + (_now(), int(job_id)),
+        )
+
+    async def claim_provisioning_job(self, job_id: int, owner: str, lease_sec: int) -> bool:
+        """Take a job for `owner` unless another worker touched it within lease_sec.
+        Both the bot and the bridge process run workers; this keeps one build per job."""
+        now = _now()
+        _, n = await self._write(
+            """UPDATE provisioning_jobs SET claimed_by=?, updated_at=?
+               WHERE id=? AND state IN ('queued','creating','waiting','delivering')
+                 AND (claimed_by IS NULL OR claimed_by=? OR updated_at < ?)""",
+            (str(owner), now, int(job_id), str(owner), now - int(lease_sec)),
+        )
+        return n > 0
+
+    async def deliver_provisioning_job(
+        self, job_id: int, order: Dict[str, Any], hourly_from: Optional[int] = None
+    ) -> int:
+        """Create the job's order (create_order() fields), record it on the job, link
+        the invoice and settle a card purchase, in one transaction.
+
+        A job that already has an order gets that order's id back and nothing is
+        written, so a resumed job never creates a second order for its server.
+        hourly_from starts the hourly billing clock at that unix time.
+        """
+        async def _op(db: aiosqlite.Connection) -> Tuple[int, bool]:
+            cur = await db.execute(
+                "SELECT order_id, invoice_id, source FROM provisioning_jobs WHERE id=?", (int(job_id),)
+            )
+            row = await cur.fetchone()
+            if not row:
+                raise ValueError(f"provisioning job {job_id} not found")
+            if row[0]:
+                return int(row[0]), False
+            fields = dict(order)
+            if hourly_from is not None:
+                fields["last_billed_hour"] = int(hourly_from) // 3600
+            oid = await _insert_order(db, fields)
+            if hourly_from is not None:
+                await db.execute(
+                    "UPDATE orders SET last_hourly_charge_at=?, last_warn_at=0 WHERE id=?", (int(hourly_from), oid)
+                )
+            await db.execute(
+                "UPDATE provisioning_jobs SET order_id=?, updated_at=? WHERE id=?", (oid, _now(), int(job_id))
+            )
+            inv_id = _as_int_or_none(row[1])
+            if inv_id:
+                if row[2] == "card":
+                    await db.execute("UPDATE invoices SET order_id=?, status='paid' WHERE id=?", (oid, inv_id))
+                    await db.execute("UPDATE card_purchases SET status='approved' WHERE invoice_id=?", (inv_id,))
+                else:
+                    await db.execute("UPDATE invoices SET order_id=? WHERE id=?", (oid, inv_id))
+            return oid, True
+
+        oid, created = await self._write_tx(_op)
+        if created:
+            self._order_changed(oid)
+        return oid
+
+    async def fail_provisioning_job(
+        self,
+        job_id: int,
+        error: str,
+        *,
+        refund_irt: int = 0,
+        reject_card: bool = False,
+        notices: Sequence[Dict[str, Any]] = (),
+    ) -> bool:
+        """Mark an unfinished job failed and undo its payment in one transaction.
+
+        refund_irt goes back to the buyer's wallet as a 'refund'; reject_card
+        rejects the card purchase and its invoice. Returns False (and changes
+        nothing) if the job already finished, so a failure is never refunded twice.
+        """
+        refund = int(refund_irt or 0)
+
+        async def _op(db: aiosqlite.Connection) -> Tuple[int, int]:
+            cur = await db.execute(
+                """UPDATE provisioning_jobs SET state='failed', error=?, updated_at=?
+                   WHERE id=? AND state IN ('queued','creating','waiting','delivering')
+                   RETURNING user_id, invoice_id""",
+                (str(error)[:500], _now(), int(job_id)),
+            )
+            rows = await cur.fetchall()
+            if not rows:
+                return -1, 0
+            user_id, inv_id = int(rows[0][0]), _as_int_or_none(rows[0][1])
+            if refund > 0:
+                cur = await db.execute(
+                    "UPDATE users SET balance_irt = balance_irt + ? WHERE user_id=? RETURNING balance_irt",
+                    (refund, user_id),
+                )
+                bal_rows = await cur.fetchall()
+                if not bal_rows:
+                    raise ValueError(f"user {user_id} not found")
+                await _ledger_append(db, user_id, refund, int(bal_rows[0][0]), "refund", None, inv_id)
+            if reject_card and inv_id:
+                await db.execute("UPDATE card_purchases SET status='rejected' WHERE invoice_id=?", (inv_id,))
+                await db.execute("UPDATE invoices SET status='rejected' WHERE id=?", (inv_id,))
+            return await _outbox_append(db, notices), user_id
+
+        queued, user_id = await self._write_tx(_op)
+        if queued < 0:
+            return False
+        self._outbox_written(queued)
+        if refund > 0:
+            self._balance_changed(user_id)
+        return True
+
+    async def list_unfinished_provisioning_jobs(self, idle_sec: Optional[int] = None) -> List[int]:
+        """Ids of jobs a restart has to pick up again, oldest first.
+
+        With idle_sec, only jobs nobody touched for that long (their worker died
+        or never got them), for the periodic sweep.
+        """
+        sql = "SELECT id FROM provisioning_jobs WHERE state IN ('queued','creating','waiting','delivering')"
+        params: Tuple[Any, ...] = ()
+        if idle_sec is not None:
+            sql += " AND updated_at < ?"
+            params = (_now() - int(idle_sec),)
+        async with self.pool.reader() as db:
+            cur = await db.execute(sql + " ORDER BY id", params)
+            rows = await cur.fetchall()
+        return [int(r[0]) for r in rows]
+
+    async def provisioning_stats(self) -> Dict[str, int]:
+        async with self.pool.reader() as db:
+            cur = await db.execute("SELECT state, COUNT(*) FROM provisioning_jobs GROUP BY state")
+            rows = await cur.fetchall()
+        return {str(r[0]): int(r[1]) for r in rows}
+
+    # -------------------------
+    # warm server pool
+    # -------------------------
+    async def add_warm_server(
+        self,
+        *,
+        server_type: str,
+        location: str,
+        os_label: str,
+        image_id: Optional[int],
+        hcloud_server_id: int,
+        ip4: Optional[str],
+    ) -> int:
+        now = _now()
+        rowid, _ = await self._write(
+            """INSERT INTO warm_servers(server_type, location, os_label, image_id, hcloud_server_id, ip4, state,
+                                        created_at, updated_at)
+               VALUES(?,?,?,?,?,?,'building',?,?)""",
+            (str(server_type), str(location), str(os_label), _as_int_or_none(image_id), int(hcloud_server_id),
+             ip4, now, now),
+        )
+        return int(rowid)
+
+    async def set_warm_server_ready(self, warm_id: int, ip4: Optional[str]) -> None:
+        await self._write(
+            "UPDATE warm_servers SET state='ready', ip4=COALESCE(?, ip4), updated_at=? WHERE id=? AND state='building'",
+            (ip4, _now(), int(warm_id)),
+        )
+
+    async def claim_warm_server_for_job(
+        self, job_id: int, server_type: str, location: str, os_label: str
+    ) -> Optional[Dict[str, Any]]:
+        """Take the oldest ready server for the key out of the pool and record it on
+        a still-queued provisioning job, in one transaction: a crash can neither
+        lose the server nor hand it to two jobs. None if the pool is empty or the
+        job already moved on."""
+
+        async def _op(db: aiosqlite.Connection) -> Optional[Tuple[Any, ...]]:
+            cur = await db.execute(
+                "SELECT 1 FROM provisioning_jobs WHERE id=? AND state='queued'", (int(job_id),)
+            )
+            if not await cur.fetchone():
+                return None
+            cur = await db.execute(
+                """DELETE FROM warm_servers WHERE id = (
+                       SELECT id FROM warm_servers
+                       WHERE server_type=? AND location=? AND os_label=? AND state='ready'
+                       ORDER BY id LIMIT 1)
+                   RETURNING id, hcloud_server_id, ip4, image_id, created_at""",
+                (str(server_type), str(location), str(os_label)),
+            )
+            rows = await cur.fetchall()
+            if not rows:
+                return None
+            await db.execute(
+                "UPDATE provisioning_jobs SET state='creating', hcloud_server_id=?, updated_at=? WHERE id=?",
+                (int(rows[0][1]), _now(), int(job_id)),
+            )
+            return tuple(rows[0])
+
+        r = await self._write_tx(_op)
+        if not r:
+            return None
+        return {
+            "id": int(r[0]),
+            "hcloud_server_id": int(r[1]),
+            "ip4": r[2],
+            "image_id": r[3],
+            "created_at": int(r[4] or 0),
+        }
+
+    async def list_warm_servers(self) -> List[Dict[str, Any]]:
+        """The whole pool (small by construction: capped by WARM_POOL_MAX)."""
+        async with self.pool.reader() as db:
+            cur = await db.execute(
+                """SELECT id, server_type, location, os_label, image_id, hcloud_server_id, ip4, state, created_at
+                   FROM warm_servers ORDER BY id"""
+            )
+            rows = await cur.fetchall()
+        return [
+            {
+                "id": int(r[0]),
+                "server_type": r[1],
+                "location": r[2],
+                "os_label": r[3],
+                "image_id": r[4],
+                "hcloud_server_id": int(r[5]),
+                "ip4": r[6],
+                "state": r[7],
+                "created_at": int(r[8] or 0),
+            }
+            for r in rows
+        ]
+
+    async def mark_warm_server_reaping(self, warm_id: int, state: str) -> bool:
+        """Move a row out of reach of claim_warm_server before its server is deleted; False if it changed meanwhile."""
+        _, n = await self._write(
+            "UPDATE warm_servers SET state='reaping', updated_at=? WHERE id=? AND state=?",
+            (_now(), int(warm_id), str(state)),
+        )
+        return n > 0
+
+    async def delete_warm_server(self, warm_id: int) -> None:
+        await self._write("DELETE FROM warm_servers WHERE id=?", (int(warm_id),))
+
+    # -------------------------
+    # broadcasts
+    # -------------------------
+    _BROADCAST_COLS = (
+        "id, text, state, cursor_user_id, total, sent, failed, blocked, created_by, chat_id, message_id,"
+        " created_at, updated_at, finished_at"
+    )
+
+    @staticmethod
+    def _broadcast_row(r: Sequence[Any]) -> Dict[str, Any]:
+        return {
+            "id": int(r[0]),
+            "text": r[1],
+            "state": r[2],
+            "cursor_user_id": int(r[3] or 0),
+            "total": int(r[4] or 0),
+            "sent": int(r[5] or 0),
+            "failed": int(r[6] or 0),
+            "blocked": int(r[7] or 0),
+            "created_by": r[8],
+            "chat_id": r[9],
+            "message_id": r[10],
+            "created_at": int(r[11] or 0),
+            "updated_at": int(r[12] or 0),
+            "finished_at": r[13],
+        }
+
+    async def create_broadcast(self, text: str, created_by: Optional[int] = None) -> int:
+        """New running broadcast to every non-blocked user; total is counted once here."""
+        now = _now()
+
+        async def _op(db: aiosqlite.Connection) -> int:
+            cur = await db.execute("SELECT COUNT(*) FROM users WHERE is_blocked=0")
+            total = int((await cur.fetchone())[0] or 0)
+            cur = await db.execute(
+                """INSERT INTO broadcasts(text, state, total, created_by, created_at, updated_at)
+                   VALUES(?, 'running', ?, ?, ?, ?)""",
+                (str(text), total, _as_int_or_none(created_by), now, now),
+            )
+            return int(cur.lastrowid)
+
+        return await self._write_tx(_op)
+
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        async with self.pool.reader() as db:
+            cur = await db.execute(f"SELECT {self._BROADCAST_COLS} FROM broadcasts WHERE id=?", (int(broadcast_id),))
+            r = await cur.fetchone()
+        return self._broadcast_row(r) if r else None
+
+    async def list_broadcasts(self, limit: int = 10) -> List[Dict[str, Any]]:
+        async with self.pool.reader() as db:
+            cur = await db.execute(
+                f"SELECT {self._BROADCAST_COLS} FROM broadcasts ORDER BY id DESC LIMIT ?", (int(limit),)
+            )
+            rows = await cur.fetchall()
+        return [self._broadcast_row(r) for r in rows]
+
+    async def list_running_broadcasts(self) -> List[int]:
+        async with self.pool.reader() as db:
+            cur = await db.execute("SELECT id FROM broadcasts WHERE state='running' ORDER BY id")
+            rows = await cur.fetchall()
+        return [int(r[0]) for r in rows]
+
+    async def set_broadcast_state(self, broadcast_id: int, state: str, from_states: Sequence[str]) -> bool:
+        """Move to state only from one of from_states; False if the broadcast was elsewhere."""
+        if not from_states:
+            return False
+        now = _now()
+        marks = ",".join("?" for _ in from_states)
+        finished = now if state in ("cancelled", "done") else None
+        _, n = await self._write(
+            f"""UPDATE broadcasts SET state=?, updated_at=?, finished_at=COALESCE(?, finished_at)
+                WHERE id=? AND state IN ({marks})""",
+            (str(state), now, finished, int(broadcast_id)) + tuple(str(x) for x in from_states),
+        )
+        return n > 0
+
+    async def set_broadcast_message(self, broadcast_id: int, chat_id: int, message_id: int) -> None:
+        await self._write(
+            "UPDATE broadcasts SET chat_id=?, message_id=? WHERE id=?",
+            (int(chat_id), int(message_id), int(broadcast_id)),
+        )
+
+    async def claim_broadcast(self, broadcast_id: int, owner: str, lease_sec: int) -> bool:
+        """Same lease as claim_provisioning_job: one sender per broadcast across both processes."""
+        now = _now()
+        _, n = await self._write(
+            """UPDATE broadcasts SET claimed_by=?, updated_at=?
+               WHERE id=? AND state='running' AND (claimed_by IS NULL OR claimed_by=? OR updated_at < ?)""",
+            (str(owner), now, int(broadcast_id), str(owner), now - int(lease_sec)),
+        )
+        return n > 0
+
+    async def release_broadcast(self, broadcast_id: int, owner: str) -> None:
+        await self._write(
+            "UPDATE broadcasts SET claimed_by=NULL WHERE id=? AND claimed_by=?", (int(broadcast_id), str(owner))
+        )
+
+    async def broadcast_recipients(self, after_user_id: int, limit: int) -> List[int]:
+        """Next page of recipients by user_id (keyset: no OFFSET, new users join at the end)."""
+        async with self.pool.reader() as db:
+            cur = await db.execute(
+                "SELECT user_id FROM users WHERE user_id > ? AND is_blocked=0 ORDER BY user_id LIMIT ?",
+                (int(after_user_id), int(limit)),
+            )
+            rows = await cur.fetchall()
+        return [int(r[0]) for r in rows]
+
+    async def advance_broadcast(self, broadcast_id: int, cursor_user_id: int, sent: int, failed: int, blocked: int) -> None:
+        """Record a finished page: move the cursor and add its counts (also the claim heartbeat)."""
+        await self._write(
+            """UPDATE broadcasts SET cursor_user_id=?, sent=sent+?, failed=failed+?, blocked=blocked+?, updated_at=?
+               WHERE id=? AND cursor_user_id < ?""",
+            (int(cursor_user_id), int(sent), int(failed), int(blocked), _now(), int(broadcast_id), int(cursor_user_id)),
+        )
+
+    # -------------------------
+    # notification outbox
+    # -------------------------
+    async def enqueue_outbox(self, notices: Sequence[Dict[str, Any]]) -> int:
+        """Queue notifications on their own (no state change to pair them with)."""
+        async def _op(db: aiosqlite.Connection) -> int:
+            return await _outbox_append(db, notices)
+
+        queued = await self._write_tx(_op)
+        self._outbox_written(queued)
+        return queued
+
+    async def claim_outbox(self, owner: str, lease_sec: int, limit: int = 50) -> List[Dict[str, Any]]:
+        """Lease up to limit due pending rows (oldest first) and count the attempt."""
+        now = _now()
+
+        async def _op(db: aiosqlite.Connection) -> List[Tuple[Any, ...]]:
+            cur = await db.execute(
+                """UPDATE outbox SET claimed_by=?, claimed_until=?, attempts=attempts+1
+                   WHERE id IN (
+                       SELECT id FROM outbox
+                       WHERE state='pending' AND next_attempt_at <= ? AND claimed_until < ?
+                       ORDER BY next_attempt_at, id LIMIT ?)
+                   RETURNING id, chat_id, method, payload_json, priority, attempts, dedupe_key""",
+                (str(owner), now + int(lease_sec), now, now, int(limit)),
+            )
+            return list(await cur.fetchall())
+
+        rows = await self._write_tx(_op)
+        out = []
+        for r in sorted(rows, key=lambda r: int(r[0])):
+            try:
+                payload = json.loads(r[3] or "{}")
+            except Exception:
+                payload = {}
+            out.append({
+                "id": int(r[0]),
+                "chat_id": int(r[1]),
+                "method": r[2],
+                "payload": payload,
+                "priority": r[4],
+                "attempts": int(r[5] or 0),
+                "key": r[6],
+            })
+        return out
+
+    async def renew_outbox_claims(self, outbox_ids: List[int], owner: str, lease_sec: int) -> int:
+        """Extend owner's lease on rows it is still sending, so no drain claims them again."""
+        if not outbox_ids:
+            return 0
+        _, n = await self._write(
+            f"""UPDATE outbox SET claimed_until=?
+                WHERE id IN ({','.join('?' for _ in outbox_ids)}) AND claimed_by=? AND state='pending'""",
+            (_now() + int(lease_sec),) + tuple(int(i) for i in outbox_ids) + (str(owner),),
+        )
+        return n
+
+    async def mark_outbox_sent(self, outbox_id: int, owner: str) -> None:
+        await self._write(
+            """UPDATE outbox SET state='sent', sent_at=?, claimed_by=NULL, claimed_until=0, last_error=NULL
+               WHERE id=? AND claimed_by=?""",
+            (_now(), int(outbox_id), str(owner)),
+        )
+
+    async def mark_outbox_failed(self, outbox_id: int, owner: str, error: str, retry_at: Optional[int]) -> None:
+        """Release the claim; retry at retry_at, or mark the row dead if it is None."""
+        await self._write(
+            """UPDATE outbox SET state=?, next_attempt_at=?, claimed_by=NULL, claimed_until=0, last_error=?
+               WHERE id=? AND claimed_by=?""",
+            (
+                "pending" if retry_at is not None else "dead",
+                int(retry_at or 0),
+                str(error)[:500],
+                int(outbox_id),
+                str(owner),
+            ),
+        )
+
+    async def purge_outbox(self, before_ts: int) -> int:
+        """Delete sent/dead rows created before before_ts (their dedupe keys expire with them)."""
+        _, n = await self._write(
+            "DELETE FROM outbox WHERE state IN ('sent','dead') AND created_at < ?", (int(before_ts),)
+        )
+        return n
+
+    async def outbox_stats(self) -> Dict[str, int]:
+        async with self.pool.reader() as db:
+            cur = await db.execute("SELECT state, COUNT(*) FROM outbox GROUP BY state")
+            rows = await cur.fetchall()
+        out = {"pending": 0, "sent": 0, "dead": 0}
+        for st, n in rows:
+            out[str(st)] = int(n or 0)
+        return out
+
     # -------------------------
     # tickets
     # -------------------------
     async def create_ticket(self, user_id: int, subject: str, text: str) -> int:
         now = _now()
-        async with aiosqlite.connect(self.path) as db:
+
+        async def _op(db: aiosqlite.Connection) -> int:
             cur = await db.execute(
                 "INSERT INTO tickets(user_id,status,subject,created_at) VALUES(?,?,?,?)",
                 (int(user_id), "open", str(subject), now),
@@ -1286,11 +3362,12 @@ class DB:
                 "INSERT INTO ticket_messages(ticket_id,sender,sender_id,text,created_at) VALUES(?,?,?,?,?)",
                 (tid, "user", int(user_id), str(text), now),
             )
-            await db.commit()
             return tid
 
+        return await self._write_tx(_op)
+
     async def get_ticket(self, ticket_id: int) -> Optional[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute("SELECT id,user_id,status,subject,created_at FROM tickets WHERE id=?", (int(ticket_id),))
             r = await cur.fetchone()
         if not r:
@@ -1298,12 +3375,10 @@ class DB:
         return {"id": r[0], "user_id": r[1], "status": r[2], "subject": r[3], "created_at": r[4]}
 
     async def close_ticket(self, ticket_id: int) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE tickets SET status='closed' WHERE id=?", (int(ticket_id),))
-            await db.commit()
+        await self._write("UPDATE tickets SET status='closed' WHERE id=?", (int(ticket_id),))
 
     async def list_user_tickets(self, user_id: int, limit: int = 20) -> List[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 "SELECT id,user_id,status,subject,created_at FROM tickets WHERE user_id=? ORDER BY id DESC LIMIT ?",
                 (int(user_id), int(limit)),
@@ -1312,7 +3387,7 @@ class DB:
         return [{"id": r[0], "user_id": r[1], "status": r[2], "subject": r[3], "created_at": r[4]} for r in rows]
 
     async def list_open_tickets(self, limit: int = 30) -> List[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 "SELECT id,user_id,status,subject,created_at FROM tickets WHERE status='open' ORDER BY id DESC LIMIT ?",
                 (int(limit),),
@@ -1322,15 +3397,13 @@ class DB:
 
     async def add_ticket_message(self, ticket_id: int, sender: str, sender_id: int, text: str) -> None:
         now = _now()
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "INSERT INTO ticket_messages(ticket_id,sender,sender_id,text,created_at) VALUES(?,?,?,?,?)",
-                (int(ticket_id), str(sender), int(sender_id), str(text), now),
-            )
-            await db.commit()
+        await self._write(
+            "INSERT INTO ticket_messages(ticket_id,sender,sender_id,text,created_at) VALUES(?,?,?,?,?)",
+            (int(ticket_id), str(sender), int(sender_id), str(text), now),
+        )
 
     async def list_ticket_messages(self, ticket_id: int, limit: int = 30) -> List[Dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             cur = await db.execute(
                 """SELECT id,ticket_id,sender,sender_id,text,created_at
                    FROM ticket_messages
@@ -1346,7 +3419,7 @@ class DB:
     # misc
     # -------------------------
     async def stats(self) -> Dict[str, int]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self.pool.reader() as db:
             c1 = await db.execute("SELECT COUNT(*) FROM users")
             users = int((await c1.fetchone())[0] or 0)
             c2 = await db.execute("SELECT COUNT(*) FROM orders")
@@ -0,0 +1,246 @@
+"""Query plan audit for db.py.
+
+Runs every DB method against a scratch database, captures the SQL each one
+executes and prints its EXPLAIN QUERY PLAN. Exits non-zero if a query from a
+hot method falls back to a full table SCAN (a SCAN that walks an index is ok).
+
+Usage:
+    python db_audit.py            # audit, exit 1 on hot-path SCAN
+    python db_audit.py -v         # also print every plan
+"""
+import argparse
+import asyncio
+import inspect
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from typing import Any, Dict, List, Tuple
+
+from db import DB
+
+# (method, args, kwargs, hot)
+# Hot methods run on user-facing paths or from job_loop and must be indexed.
+CALLS: List[Tuple[str, tuple, Dict[str, Any], bool]] = [
+    ("set_setting", ("k", "v"), {}, False),
+    # served from the in-memory cache; the one-off full load is a scan by design
+    ("get_setting", ("k",), {}, False),
+    ("get_setting_json", ("k", None), {}, False),
+    ("upsert_user", (1, "u1"), {}, True),
+    ("get_user", (1,), {}, True),
+    ("search_user", (1,), {}, True),
+    ("set_block", (1, False), {}, False),
+    ("add_balance", (1, 1000), {}, True),
+    ("debit_wallet", (1, 10, "d"), {"order_id": 1}, True),
+    ("wallet_history", (1,), {"before_id": 100}, True),
+    ("wallet_balance_at", (1, 2_000_000_000), {}, True),
+    ("wallet_reconcile", (1,), {}, True),
+    ("list_all_users", (), {"limit": 10, "offset": 0}, True),
+    ("set_user_phone", (1, "+100"), {}, False),
+    ("get_user_phone", (1,), {}, True),
+    ("create_plan", ({"provider": "hetzner", "country_code": "DE", "location_name": "fsn1",
+                      "server_type": "cx22", "title": "t", "price_monthly_irt": 1},), {}, False),
+    ("list_plans", ("hetzner", "DE", "fsn1"), {}, True),
+    ("list_plans_by_provider", ("manual",), {}, True),
+    ("get_plan", (1,), {}, True),
+    ("list_plan_countries", ("hetzner",), {}, True),
+    ("update_plan_fields", (1,), {"title": "t2"}, False),
+    ("list_all_plan_countries", (), {}, False),
+    ("list_plans_admin", ("DE",), {}, False),
+    ("toggle_plan_active", (1,), {}, False),
+    ("update_plan_prices", (1,), {"monthly_eur": 1.0, "hourly_eur": 0.01, "monthly_irt": 1,
+                                  "hourly_irt": 1, "hourly_enabled": True}, False),
+    ("update_plan_traffic_limit", (1,), {"traffic_limit_gb": 20}, False),
+    ("get_plan_sales_counts", ([1],), {}, False),
+    ("create_order", (), {"user_id": 1, "provider": "hetzner", "billing_mode": "hourly",
+                          "price_hourly_irt": 10, "traffic_limit_gb": 20}, True),
+    ("set_order_status", (1, "active"), {}, True),
+    ("set_order_credentials", (1,), {"ip4": "1.2.3.4"}, False),
+    ("update_order_status_and_expiry", (1, "active", 0), {}, True),
+    ("list_user_orders", (1,), {}, True),
+    ("get_order", (1,), {}, True),
+    ("list_orders_by_status", ("active",), {}, True),
+    ("list_active_orders", (), {}, True),
+    ("list_hourly_orders", (), {}, True),
+    ("list_order_schedule", (), {}, True),
+    ("list_order_schedule", ([1, 2],), {}, True),
+    ("list_order_schedule", (), {"user_id": 1}, True),
+    ("update_order_traffic", (1, 0.5, 0), {}, True),
+    ("add_order_traffic", (1, 0, 3600, 0.5, 0.1, 3700), {"samples": [(0, 1.0), (3600, 2.0)]}, True),
+    ("order_traffic_daily", (1, 0), {}, True),
+    ("order_traffic_since", (1, 0), {}, True),
+    ("top_traffic_orders", (0,), {}, False),
+    ("compact_traffic_samples", (86400 * 30,), {}, False),
+    ("add_order_traffic_limit", (1, 10), {}, False),
+    ("set_last_billed_hour", (1, 0), {}, True),
+    ("update_order_hourly_tick", (1, 0, 0), {}, True),
+    ("set_order_suspended_balance", (1, 0, 0), {}, True),
+    ("clear_order_suspension", (1,), {}, True),
+    # one pass per tick; reads the orders index, the rest walks its own temp table
+    ("run_hourly_billing", (2_000_000_000, 20_000, 5_000), {}, False),
+    ("create_traffic_package", (), {"country_code": "DE", "title": "t", "volume_gb": 10, "price_irt": 1}, False),
+    ("list_traffic_packages", ("DE",), {}, True),
+    ("get_traffic_package", (1,), {}, True),
+    ("toggle_traffic_package_active", (1,), {}, False),
+    ("create_traffic_purchase", (), {"user_id": 1, "order_id": 1, "package_id": 1, "volume_gb": 10,
+                                     "price_irt": 1, "invoice_id": None, "status": "paid"}, True),
+    ("create_invoice", (1, 100, "wallet", "d", "paid"), {}, True),
+    ("get_invoice", (1,), {}, True),
+    ("set_invoice_status", (1, "paid"), {}, True),
+    ("attach_invoice_to_order", (1, 1), {}, True),
+    ("create_card_purchase", (1, 1, "{}"), {}, True),
+    ("set_card_purchase_receipt", (1, "file"), {}, True),
+    ("get_card_purchase", (1,), {}, True),
+    ("set_card_purchase_status", (1, "approved"), {}, True),
+    ("resolve_card_purchase", (1, "approved"), {"credit_irt": 100,
+                                                 "notices": [{"chat_id": 1, "payload": {"text": "t"}}]}, True),
+    ("list_pending_card_purchases", (), {}, True),
+    ("start_card_provisioning", (1, 100, {"plan_id": 1}), {}, True),
+    ("debit_wallet_for_provisioning", (1, 1, "d", {"plan_id": 1}), {}, True),
+    ("create_provisioning_job", (), {"user_id": 1, "invoice_id": 1, "source": "wallet", "amount_irt": 1,
+                                     "payload": {"plan_id": 1}}, True),
+    ("get_provisioning_job", (1,), {}, True),
+    ("update_provisioning_job", (1,), {"state": "waiting", "ip4": "1.2.3.4"}, True),
+    ("claim_provisioning_job", (1, "w1", 600), {}, True),
+    ("deliver_provisioning_job", (1, {"user_id": 1, "server_type": "cx22"}), {"hourly_from": 3600}, True),
+    ("fail_provisioning_job", (1, "err"), {"refund_irt": 1, "reject_card": True}, True),
+    ("list_unfinished_provisioning_jobs", (), {}, False),
+    ("list_unfinished_provisioning_jobs", (), {"idle_sec": 600}, False),
+    ("provisioning_stats", (), {}, False),
+    ("add_warm_server", (), {"server_type": "cx22", "location": "fsn1", "os_label": "Debian-12",
+                              "image_id": 1, "hcloud_server_id": 10, "ip4": "1.2.3.4"}, False),
+    ("set_warm_server_ready", (1, "1.2.3.4"), {}, False),
+    ("claim_warm_server_for_job", (1, "cx22", "fsn1", "Debian-12"), {}, True),
+    ("list_warm_servers", (), {}, False),
+    ("mark_warm_server_reaping", (1, "ready"), {}, False),
+    ("delete_warm_server", (1,), {}, False),
+    ("create_broadcast", ("hello", 1), {}, False),
+    ("get_broadcast", (1,), {}, True),
+    ("list_broadcasts", (), {}, False),
+    ("list_running_broadcasts", (), {}, False),
+    ("set_broadcast_state", (1, "paused", ("running",)), {}, True),
+    ("set_broadcast_message", (1, 1, 1), {}, False),
+    ("claim_broadcast", (1, "w1", 120), {}, True),
+    ("release_broadcast", (1, "w1"), {}, False),
+    ("broadcast_recipients", (0, 100), {}, True),
+    ("advance_broadcast", (1, 100, 10, 1, 1), {}, True),
+    ("enqueue_outbox", ([{"chat_id": 1, "payload": {"text": "t"}, "key": "k1"}],), {}, True),
+    ("claim_outbox", ("w1", 120), {}, True),
+    ("renew_outbox_claims", ([1, 2], "w1", 120), {}, True),
+    ("mark_outbox_sent", (1, "w1"), {}, True),
+    ("mark_outbox_failed", (1, "w1", "err", 0), {}, True),
+    ("purge_outbox", (0,), {}, False),
+    ("outbox_stats", (), {}, False),
+    ("create_ticket", (1, "s", "t"), {}, True),
+    ("get_ticket", (1,), {}, True),
+    ("add_ticket_message", (1, "admin", 2, "t"), {}, True),
+    ("list_user_tickets", (1,), {}, True),
+    ("list_open_tickets", (), {}, True),
+    ("list_ticket_messages", (1,), {}, True),
+    ("close_ticket", (1,), {}, True),
+    ("stats", (), {}, False),
+    ("delete_traffic_package", (1,), {}, False),
+    ("delete_order", (1,), {}, False),
+    ("delete_user_orders", (1,), {}, False),
+    ("delete_plan", (1,), {}, False),
+    ("delete_user_full", (1,), {}, True),
+]
+
+# not query methods (lifecycle, backups, internals)
+SKIP = {"init", "open", "close", "create_backup", "get_latest_backup", "restore_from", "pool_stats",
+        "stop_change_watcher", "check_changes"}
+
+IGNORED_PREFIXES = ("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "CREATE", "ALTER", "VACUUM")
+
+
+def explain(path: str, sql: str) -> List[str]:
+    c = sqlite3.connect(path)
+    try:
+        rows = c.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+    finally:
+        c.close()
+    return [str(r[3]) for r in rows]
+
+
+def is_full_scan(detail: str) -> bool:
+    d = detail.strip().upper()
+    return d.startswith("SCAN ") and " USING " not in d
+
+
+async def _audit_calls(db: DB, path: str, captured: List[str], failures: List[str], verbose: bool) -> None:
+    for name, args, kwargs, hot in CALLS:
+        captured.clear()
+        try:
+            await getattr(db, name)(*args, **kwargs)
+        except Exception as e:
+            print(f"!! {name}: call failed: {e}")
+            failures.append(f"{name}: call failed")
+            continue
+        seen = set()
+        for sql in captured:
+            sql = " ".join(sql.split())
+            if not sql or sql.upper().startswith(IGNORED_PREFIXES) or sql in seen:
+                continue
+            seen.add(sql)
+            try:
+                plan = explain(path, sql)
+            except sqlite3.OperationalError as e:
+                # TEMP tables only exist on the connection that created them
+                if verbose:
+                    print(f"[skip] {name}: {e}\n    {sql[:160]}")
+                continue
+            scans = [d for d in plan if is_full_scan(d)]
+            bad = hot and bool(scans)
+            if bad:
+                failures.append(f"{name}: {'; '.join(scans)}")
+            if verbose or scans:
+                tag = "FAIL" if bad else ("scan" if scans else "ok")
+                print(f"[{tag}] {name}{' (hot)' if hot else ''}\n    {sql[:160]}")
+                for d in plan:
+                    print(f"      {d}")
+
+
+async def run(verbose: bool) -> int:
+    tmp = tempfile.mkdtemp(prefix="vpsbot_audit_")
+    path = os.path.join(tmp, "audit.sqlite3")
+    db = DB(path, readers=1)
+    await db.init()
+
+    captured: List[str] = []
+    for conn in db.pool.connections():
+        await conn.set_trace_callback(captured.append)
+
+    listed = {name for name, _, _, _ in CALLS}
+    missing = sorted(
+        name for name, fn in inspect.getmembers(DB, inspect.iscoroutinefunction)
+        if not name.startswith("_") and name not in SKIP and name not in listed
+    )
+
+    failures: List[str] = []
+    try:
+        await _audit_calls(db, path, captured, failures, verbose)
+    finally:
+        await db.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if missing:
+        print("\nDB methods not covered by the audit: " + ", ".join(missing))
+    if failures:
+        print(f"\n{len(failures)} hot query(ies) without an index:")
+        for f in failures:
+            print(f"  - {f}")
+        return 1
+    print(f"\nOK: {len(CALLS)} methods audited, no full scans on hot paths.")
+    return 0
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="EXPLAIN QUERY PLAN audit for db.py")
+    ap.add_argument("-v", "--verbose", action="store_true", help="print every query plan")
+    a = ap.parse_args()
+    sys.exit(asyncio.run(run(a.verbose)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,487 @@
+"""Async Hetzner Cloud API client.
+
+One shared aiohttp session (keep-alive) per client, a timeout on every call
+and small dataclasses for the fields the bot uses. API errors are raised as
+HetznerError.
+"""
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, FrozenSet, List, Mapping, Optional, Tuple, Union
+
+import aiohttp
+
+API_URL = "https://api.hetzner.cloud/v1"
+
+
+class HetznerError(RuntimeError):
+    def __init__(self, status: int, code: str, message: str):
+        super().__init__(f"Hetzner API {status} {code}: {message}")
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class HetznerRateLimited(HetznerError):
+    """Local governor deferred a low-priority call (no request was sent)."""
+
+    def __init__(self, priority: str, wait_sec: float):
+        super().__init__(429, "rate_limit_deferred", f"{priority} call deferred, ~{int(wait_sec)}s to headroom")
+        self.priority = priority
+        self.wait_sec = wait_sec
+
+
+# -------------------------
+# rate limit governor
+# -------------------------
+# Highest priority first. A class may spend a token only while more than
+# RESERVE[class] of the budget is left, so low-priority work stops first and
+# the tail of the budget is kept for provisioning.
+PRIORITIES = ("provisioning", "power", "metrics", "catalog")
+RESERVE = {"provisioning": 0.0, "power": 0.05, "metrics": 0.25, "catalog": 0.35}
+# how long a call may wait for headroom before it is deferred (raises HetznerRateLimited)
+MAX_WAIT_SEC = {"provisioning": 120.0, "power": 60.0, "metrics": 0.0, "catalog": 0.0}
+
+
+class RateGovernor:
+    """Client-side token bucket kept in sync with Hetzner's RateLimit-* headers.
+
+    Hetzner gives each project `limit` requests that refill at about one per
+    second (`RateLimit-Reset` is when the bucket is full again).
+    """
+
+    def __init__(self, limit: int = 3600, window_sec: float = 3600.0):
+        self.limit = max(1, int(limit))
+        self.window_sec = float(window_sec)
+        self.tokens = float(self.limit)
+        self._ts = time.monotonic()
+        self.throttled = 0  # 429s from the API
+        # class -> counters; plus (ts, class) of recent requests for the hourly usage view
+        self._counts: Dict[str, Dict[str, float]] = {
+            p: {"requests": 0, "deferred": 0, "waits": 0, "wait_ms": 0.0} for p in PRIORITIES
+        }
+        self._recent: Deque[Tuple[float, str]] = deque()
+
+    @property
+    def rate(self) -> float:
+        return self.limit / self.window_sec
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(float(self.limit), self.tokens + (now - self._ts) * self.rate)
+        self._ts = now
+
+    async def acquire(self, priority: str) -> None:
+        """Take one token for priority, waiting or deferring when headroom is low."""
+        if priority not in RESERVE:
+            priority = "catalog"
+        c = self._counts[priority]
+        floor = RESERVE[priority] * self.limit
+        waited = 0.0
+        while True:
+            self._refill()
+            if self.tokens - 1.0 >= floor:
+                self.tokens -= 1.0
+                c["requests"] += 1
+                if waited:
+                    c["waits"] += 1
+                    c["wait_ms"] += waited * 1000.0
+                self._recent.append((time.time(), priority))
+                return
+            need = (floor + 1.0 - self.tokens) / self.rate
+            if waited + need > MAX_WAIT_SEC[priority]:
+                c["deferred"] += 1
+                raise HetznerRateLimited(priority, need)
+            step = min(need, 5.0)
+            await asyncio.sleep(step)
+            waited += step
+
+    def observe(self, status: int, headers: Mapping[str, str]) -> None:
+        """Sync the bucket with the API's view after every response."""
+        try:
+            if headers.get("RateLimit-Limit"):
+                self.limit = max(1, int(headers["RateLimit-Limit"]))
+            if headers.get("RateLimit-Remaining") is not None:
+                self._refill()
+                self.tokens = float(int(headers["RateLimit-Remaining"]))
+        except (TypeError, ValueError):
+            pass
+        if status == 429:
+            self.throttled += 1
+            self.tokens = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        self._refill()
+        cutoff = time.time() - self.window_sec
+        while self._recent and self._recent[0][0] < cutoff:
+            self._recent.popleft()
+        last_hour = {p: 0 for p in PRIORITIES}
+        for _, p in self._recent:
+            last_hour[p] += 1
+        return {
+            "limit": self.limit,
+            "remaining": int(self.tokens),
+            "throttled": self.throttled,
+            "classes": {
+                p: {
+                    "last_hour": last_hour[p],
+                    "requests": int(c["requests"]),
+                    "deferred": int(c["deferred"]),
+                    "avg_wait_ms": (round(c["wait_ms"] / c["waits"], 1) if c["waits"] else 0.0),
+                }
+                for p, c in self._counts.items()
+            },
+        }
+
+
+@dataclass
+class HImage:
+    id: int
+    name: str
+    description: str
+    os_flavor: str = ""
+    os_version: str = ""
+    architecture: str = "x86"
+
+    @classmethod
+    def from_api(cls, d: Dict[str, Any]) -> "HImage":
+        return cls(
+            id=int(d["id"]),
+            name=d.get("name") or "",
+            description=d.get("description") or "",
+            os_flavor=d.get("os_flavor") or "",
+            os_version=d.get("os_version") or "",
+            architecture=d.get("architecture") or "x86",
+        )
+
+
+@dataclass
+class HServerType:
+    name: str
+    cores: Optional[int]
+    memory: Optional[float]
+    disk: Optional[int]
+    architecture: str = "x86"
+    deprecated: bool = False
+    available: bool = True
+    # location name -> {"hourly": net EUR, "monthly": net EUR}
+    prices: Dict[str, Dict[str, float]] = field(default_factory=dict)
+    id: Optional[int] = None
+
+    @classmethod
+    def from_api(cls, d: Dict[str, Any]) -> "HServerType":
+        prices: Dict[str, Dict[str, float]] = {}
+        for p in d.get("prices") or []:
+            try:
+                prices[str(p["location"])] = {
+                    "hourly": float(p["price_hourly"]["net"]),
+                    "monthly": float(p["price_monthly"]["net"]),
+                }
+            except (KeyError, TypeError, ValueError):
+                continue
+        return cls(
+            name=str(d.get("name") or ""),
+            cores=d.get("cores"),
+            memory=d.get("memory"),
+            disk=d.get("disk"),
+            architecture=d.get("architecture") or "x86",
+            deprecated=bool(d.get("deprecation") or d.get("deprecated")),
+            available=bool(d.get("available", True)),
+            prices=prices,
+            id=(int(d["id"]) if d.get("id") is not None else None),
+        )
+
+
+@dataclass
+class HDatacenter:
+    name: str
+    location: str
+    # server type ids
+    supported: FrozenSet[int]
+    available: FrozenSet[int]
+    available_for_migration: FrozenSet[int]
+
+    @classmethod
+    def from_api(cls, d: Dict[str, Any]) -> "HDatacenter":
+        st = d.get("server_types") or {}
+        return cls(
+            name=d.get("name") or "",
+            location=(d.get("location") or {}).get("name") or "",
+            supported=frozenset(int(x) for x in st.get("supported") or []),
+            available=frozenset(int(x) for x in st.get("available") or []),
+            available_for_migration=frozenset(int(x) for x in st.get("available_for_migration") or []),
+        )
+
+
+@dataclass
+class HServer:
+    id: int
+    name: str
+    status: str
+    ipv4: str
+    image_id: Optional[int]
+    server_type: str
+    location: str
+    created_ts: int = 0
+
+    @classmethod
+    def from_api(cls, d: Dict[str, Any]) -> "HServer":
+        ipv4 = ((d.get("public_net") or {}).get("ipv4") or {}).get("ip") or ""
+        image = d.get("image") or {}
+        loc = ((d.get("datacenter") or {}).get("location") or {}).get("name") or ""
+        return cls(
+            id=int(d["id"]),
+            name=d.get("name") or "",
+            status=d.get("status") or "",
+            ipv4=ipv4,
+            image_id=int(image["id"]) if image.get("id") else None,
+            server_type=(d.get("server_type") or {}).get("name") or "",
+            location=loc,
+            created_ts=_parse_ts(d.get("created")),
+        )
+
+
+@dataclass
+class HAction:
+    id: int
+    command: str
+    status: str  # 'running' | 'success' | 'error'
+    progress: int
+    error: Optional[str] = None
+
+    @classmethod
+    def from_api(cls, d: Dict[str, Any]) -> "HAction":
+        err = d.get("error") or None
+        return cls(
+            id=int(d["id"]),
+            command=d.get("command") or "",
+            status=d.get("status") or "",
+            progress=int(d.get("progress") or 0),
+            error=(f"{err.get('code')}: {err.get('message')}" if err else None),
+        )
+
+
+@dataclass
+class HCreateResult:
+    server: HServer
+    root_password: str
+    action: Optional[HAction]
+    next_actions: List[HAction] = field(default_factory=list)
+
+    @property
+    def action_ids(self) -> List[int]:
+        """create_server plus follow-ups (start_server, ...): the build is done when all finish."""
+        acts = ([self.action] if self.action else []) + self.next_actions
+        return [a.id for a in acts]
+
+
+def _parse_ts(s: Optional[str]) -> int:
+    try:
+        return int(datetime.fromisoformat(str(s).replace("Z", "+00:00")).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def _iso(dt: datetime) -> str:
+    return dt.replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+class HetznerClient:
+    def __init__(self, token: str, base_url: str = API_URL, timeout: float = 30.0, max_connections: int = 20,
+                 governor: Optional[RateGovernor] = None):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.timeout = float(timeout)
+        self.max_connections = int(max_connections)
+        self.governor = governor or RateGovernor()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_lock = asyncio.Lock()
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            async with self._session_lock:
+                if self._session is None or self._session.closed:
+                    self._session = aiohttp.ClientSession(
+                        headers={"Authorization": f"Bearer {self.token}", "Accept": "application/json"},
+                        connector=aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300),
+                    )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        *,
+        params: Optional[Union[Dict[str, Any], List[Tuple[str, Any]]]] = None,
+        json: Optional[Dict[str, Any]] = None,
+        timeout: Optional[float] = None,
+        priority: str = "catalog",
+    ) -> Dict[str, Any]:
+        """One API call; priority is one of PRIORITIES (see RateGovernor)."""
+        await self.governor.acquire(priority)
+        session = await self._get_session()
+        t = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        async with session.request(method, self.base_url + path, params=params, json=json, timeout=t) as r:
+            self.governor.observe(r.status, r.headers)
+            try:
+                data = await r.json(content_type=None) if r.status != 204 else {}
+            except (aiohttp.ContentTypeError, ValueError):
+                data = {}
+            if r.status >= 400:
+                err = (data or {}).get("error") or {}
+                raise HetznerError(r.status, str(err.get("code") or r.reason or ""), str(err.get("message") or ""))
+            return data or {}
+
+    async def _get_all(self, path: str, key: str, params: Optional[Dict[str, Any]] = None,
+                       timeout: Optional[float] = None, priority: str = "catalog") -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        page: Optional[int] = 1
+        while page:
+            q = dict(params or {})
+            q.update({"page": page, "per_page": 50})
+            data = await self.request("GET", path, params=q, timeout=timeout, priority=priority)
+            out.extend(data.get(key) or [])
+            page = ((data.get("meta") or {}).get("pagination") or {}).get("next_page")
+        return out
+
+    # -------------------------
+    # servers
+    # -------------------------
+    async def get_server(self, server_id: int, priority: str = "provisioning") -> Optional[HServer]:
+        try:
+            data = await self.request("GET", f"/servers/{int(server_id)}", timeout=15, priority=priority)
+        except HetznerError as e:
+            if e.status == 404:
+                return None
+            raise
+        return HServer.from_api(data["server"])
+
+    async def find_server_by_name(self, name: str, priority: str = "provisioning") -> Optional[HServer]:
+        data = await self.request("GET", "/servers", params={"name": name}, timeout=15, priority=priority)
+        rows = data.get("servers") or []
+        return HServer.from_api(rows[0]) if rows else None
+
+    async def create_server(self, name: str, server_type: str, image_id: int, location: str,
+                            labels: Optional[Dict[str, str]] = None) -> HCreateResult:
+        body: Dict[str, Any] = {"name": name, "server_type": server_type, "image": int(image_id), "location": location}
+        if labels:
+            body["labels"] = labels
+        data = await self.request("POST", "/servers", json=body, priority="provisioning")
+        act = data.get("action")
+        return HCreateResult(
+            server=HServer.from_api(data["server"]),
+            root_password=data.get("root_password") or "",
+            action=HAction.from_api(act) if act else None,
+            next_actions=[HAction.from_api(a) for a in (data.get("next_actions") or [])],
+        )
+
+    async def rename_server(self, server_id: int, name: str, labels: Optional[Dict[str, str]] = None) -> HServer:
+        """PUT /servers/{id}; labels (if given) replace the existing ones."""
+        body: Dict[str, Any] = {"name": name}
+        if labels is not None:
+            body["labels"] = labels
+        data = await self.request("PUT", f"/servers/{int(server_id)}", json=body, priority="provisioning")
+        return HServer.from_api(data["server"])
+
+    async def delete_server(self, server_id: int) -> bool:
+        """True if deleted or already gone."""
+        try:
+            await self.request("DELETE", f"/servers/{int(server_id)}", priority="power")
+        except HetznerError as e:
+            if e.status == 404:
+                return True
+            raise
+        return True
+
+    async def server_action(self, server_id: int, action: str, payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """POST /servers/{id}/actions/{action}; returns the raw response."""
+        return await self.request(
+            "POST", f"/servers/{int(server_id)}/actions/{action}", json=payload or {}, priority="power"
+        )
+
+    async def power_on(self, server_id: int) -> HAction:
+        return HAction.from_api((await self.server_action(server_id, "poweron"))["action"])
+
+    async def power_off(self, server_id: int) -> HAction:
+        return HAction.from_api((await self.server_action(server_id, "poweroff"))["action"])
+
+    async def rebuild(self, server_id: int, image_id: int) -> HAction:
+        return HAction.from_api((await self.server_action(server_id, "rebuild", {"image": int(image_id)}))["action"])
+
+    async def reset_password(self, server_id: int) -> str:
+        data = await self.server_action(server_id, "reset_password")
+        return data.get("root_password") or ""
+
+    async def get_network_series(self, server_id: int, start: datetime, end: datetime) -> Optional[List[Tuple[int, float]]]:
+        """Outbound network values over [start, end] as (ts, value) hourly points, None if unavailable."""
+        try:
+            data = await self.request(
+                "GET",
+                f"/servers/{int(server_id)}/metrics",
+                params={"type": "network", "start": _iso(start), "end": _iso(end), "step": 3600},
+                priority="metrics",
+            )
+        except HetznerError:
+            return None
+        metrics = data.get("metrics", {}).get("time_series", {})
+        out_series = None
+        for k in ("network.out", "network_out"):
+            if k in metrics:
+                out_series = metrics.get(k)
+                break
+        if not out_series and "network" in metrics and isinstance(metrics["network"], dict):
+            out_series = metrics["network"].get("out")
+        if not out_series:
+            return None
+        points: List[Tuple[int, float]] = []
+        for ts, v in (out_series.get("values") or []):
+            if v is None:
+                continue
+            points.append((int(float(ts)), float(v)))
+        return points
+
+    # -------------------------
+    # actions
+    # -------------------------
+    async def get_actions(self, action_ids: List[int], priority: str = "provisioning") -> List[HAction]:
+        """Current state of up to 50 actions in one request."""
+        if not action_ids:
+            return []
+        params = [("id", int(a)) for a in action_ids] + [("per_page", 50)]
+        data = await self.request("GET", "/actions", params=params, timeout=15, priority=priority)
+        return [HAction.from_api(d) for d in (data.get("actions") or [])]
+
+    async def get_server_actions(self, server_id: int, status: str = "running",
+                                 priority: str = "provisioning") -> List[HAction]:
+        data = await self.request(
+            "GET", f"/servers/{int(server_id)}/actions", params={"status": status, "per_page": 50},
+            timeout=15, priority=priority,
+        )
+        return [HAction.from_api(d) for d in (data.get("actions") or [])]
+
+    # -------------------------
+    # catalogs
+    # -------------------------
+    async def list_images(self, image_type: str = "system") -> List[HImage]:
+        rows = await self._get_all("/images", "images", {"type": image_type}, timeout=20)
+        return [HImage.from_api(d) for d in rows]
+
+    async def list_server_types(self) -> List[HServerType]:
+        rows = await self._get_all("/server_types", "server_types", timeout=20)
+        return [HServerType.from_api(d) for d in rows]
+
+    async def list_datacenters(self) -> List[HDatacenter]:
+        rows = await self._get_all("/datacenters", "datacenters", timeout=20)
+        return [HDatacenter.from_api(d) for d in rows]
+
+    async def get_server_type(self, name: str) -> Optional[HServerType]:
+        data = await self.request("GET", "/server_types", params={"name": name}, timeout=15)
+        rows = data.get("server_types") or []
+        return HServerType.from_api(rows[0]) if rows else None
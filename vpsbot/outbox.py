@@ -0,0 +1,160 @@
+"""Transactional notification outbox.
+
+Handlers that change state (suspension, receipt approval, deletion) write
+their notifications into the outbox table in the same transaction as the
+change, through the notices= argument of the DB method. This worker claims
+due rows, hands them to the send queue and marks them sent, so a message is
+never lost to a restart or a slow Telegram and handlers do not wait for it.
+
+Rows with a dedupe_key are inserted at most once, so running the same
+change twice (retried job, double click) queues one message. A row whose
+send raised Undeliverable (blocked bot, bad request) is marked dead; any
+other error is retried with exponential backoff up to max_attempts. The
+claim is a lease, renewed while the send is still running: rows held by a
+process that died are picked up again when it expires, so delivery is
+at-least-once.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# outbox row -> None once sent; raises Undeliverable or a retryable error
+DeliverFn = Callable[[Dict[str, Any]], Awaitable[None]]
+DeadFn = Callable[[Dict[str, Any], str], Awaitable[None]]
+
+
+class Undeliverable(Exception):
+    """The message can never be delivered; the row is marked dead."""
+
+
+class OutboxWorker:
+    def __init__(
+        self,
+        db: Any,
+        deliver: DeliverFn,
+        *,
+        owner: str,
+        interval: float = 2.0,
+        batch: int = 50,
+        lease_sec: int = 120,
+        max_attempts: int = 8,
+        max_backoff: float = 900.0,
+        keep_sec: int = 7 * 86400,
+        on_dead: Optional[DeadFn] = None,
+    ):
+        self.db = db
+        self._deliver = deliver
+        self.owner = owner
+        self.interval = max(0.2, float(interval))
+        self.batch = max(1, int(batch))
+        self.lease_sec = int(lease_sec)
+        self.max_attempts = max(1, int(max_attempts))
+        self.max_backoff = float(max_backoff)
+        self.keep_sec = int(keep_sec)
+        self._on_dead = on_dead
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: Dict[int, asyncio.Task] = {}
+        self._renew_at = 0.0
+        self._last_purge = 0.0
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+        self.last_error = ""
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    def kick(self) -> None:
+        """Drain now instead of at the next poll (rows were just committed)."""
+        self._wake.set()
+
+    async def stop(self, drain_sec: float = 5.0) -> None:
+        """Stop claiming, give claimed rows up to drain_sec to be sent, then cancel the rest."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        inflight = list(self._inflight.values())
+        if inflight:
+            await asyncio.wait(inflight, timeout=drain_sec)
+        for t in inflight:
+            t.cancel()
+        await asyncio.gather(*inflight, return_exceptions=True)
+        self._inflight.clear()
+
+    async def _loop(self) -> None:
+        while True:
+            self._wake.clear()
+            try:
+                n = await self.drain()
+                if time.monotonic() - self._last_purge >= 3600:
+                    self._last_purge = time.monotonic()
+                    await self.db.purge_outbox(int(time.time()) - self.keep_sec)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e)[:200]
+                n = 0
+            if n >= self.batch:
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain(self) -> int:
+        """Claim one batch of due rows and start sending them; returns the number claimed."""
+        # sends can wait in the send queue longer than the lease (rate limits,
+        # retry-after); keep our rows leased so no drain claims them again
+        if self._inflight and time.monotonic() >= self._renew_at:
+            await self.db.renew_outbox_claims(list(self._inflight), self.owner, self.lease_sec)
+            self._renew_at = time.monotonic() + self.lease_sec / 3
+        elif not self._inflight:
+            self._renew_at = time.monotonic() + self.lease_sec / 3
+        rows = await self.db.claim_outbox(self.owner, self.lease_sec, self.batch)
+        for row in rows:
+            if row["id"] in self._inflight:
+                continue
+            # claim order is id order; the send queue keeps it per chat
+            self._inflight[row["id"]] = asyncio.create_task(self._send(row))
+        return len(rows)
+
+    async def _send(self, row: Dict[str, Any]) -> None:
+        oid = row["id"]
+        try:
+            await self._deliver(row)
+        except asyncio.CancelledError:
+            # stays claimed; another drain sends it after the lease
+            raise
+        except Undeliverable as e:
+            await self._fail(row, str(e), dead=True)
+        except Exception as e:
+            await self._fail(row, str(e) or type(e).__name__, dead=row["attempts"] >= self.max_attempts)
+        else:
+            self.sent += 1
+            await self.db.mark_outbox_sent(oid, self.owner)
+        finally:
+            self._inflight.pop(oid, None)
+
+    async def _fail(self, row: Dict[str, Any], err: str, dead: bool) -> None:
+        self.last_error = err[:200]
+        if dead:
+            self.dead += 1
+            await self.db.mark_outbox_failed(row["id"], self.owner, err, None)
+            if self._on_dead is not None:
+                try:
+                    await self._on_dead(row, err)
+                except Exception:
+                    pass
+            return
+        self.retried += 1
+        delay = min(self.max_backoff, 5.0 * 2 ** (row["attempts"] - 1))
+        await self.db.mark_outbox_failed(row["id"], self.owner, err, int(time.time() + delay))
+
+    async def stats(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = dict(await self.db.outbox_stats())
+        out.update({"sent_here": self.sent, "retried": self.retried, "dead_here": self.dead,
+                    "inflight": len(self._inflight)})
+        return out
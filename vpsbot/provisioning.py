@@ -0,0 +1,68 @@
+"""Worker pool for server provisioning jobs.
+
+Jobs live in the provisioning_jobs table; this pool only moves job ids from
+a queue to `workers` concurrent handlers. The handler drives one job through
+its states and persists each step, so unfinished jobs can simply be
+submitted again after a restart.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Set
+
+JobHandler = Callable[[int], Awaitable[None]]
+
+
+class ProvisioningPool:
+    def __init__(self, handler: JobHandler, workers: int = 4):
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self._queue: "asyncio.Queue[int]" = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        self._pending: Set[int] = set()
+        self._running: Set[int] = set()
+        self.done = 0
+        self.errors = 0
+
+    def start(self, resume: Iterable[int] = ()) -> None:
+        """Start the workers and queue jobs left over from a previous run."""
+        for job_id in resume:
+            self.submit(job_id)
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, job_id: int) -> None:
+        job_id = int(job_id)
+        if job_id in self._pending or job_id in self._running:
+            return
+        self._pending.add(job_id)
+        self._queue.put_nowait(job_id)
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            self._pending.discard(job_id)
+            self._running.add(job_id)
+            try:
+                await self.handler(job_id)
+                self.done += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+            finally:
+                self._running.discard(job_id)
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": len(self._pending),
+            "running": len(self._running),
+            "done": self.done,
+            "errors": self.errors,
+        }
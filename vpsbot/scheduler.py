@@ -0,0 +1,99 @@
+"""Due-time scheduler for background order jobs.
+
+Keeps a min-heap of (due_ts, order_id, kind) and sleeps until the earliest
+item is due (or until something earlier is scheduled). Rescheduling an
+(order_id, kind) pair just pushes a new entry; stale heap entries are
+skipped when popped.
+"""
+import asyncio
+import heapq
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+DueItem = Tuple[int, str]
+BatchHandler = Callable[[List[DueItem]], Awaitable[None]]
+
+
+class Scheduler:
+    def __init__(self, max_batch: int = 500):
+        self.max_batch = max(1, int(max_batch))
+        self._heap: List[Tuple[float, int, str]] = []
+        self._due: Dict[DueItem, float] = {}
+        self._wake = asyncio.Event()
+        self._runs = 0
+        self._items = 0
+
+    def schedule(self, order_id: int, kind: str, due_ts: float) -> None:
+        """(Re)schedule kind for order_id at due_ts (unix seconds)."""
+        key = (int(order_id), str(kind))
+        due_ts = float(due_ts)
+        if self._due.get(key) == due_ts:
+            return
+        self._due[key] = due_ts
+        head = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (due_ts, key[0], key[1]))
+        if head is None or due_ts < head:
+            self._wake.set()
+
+    def cancel(self, order_id: int, kind: Optional[str] = None) -> None:
+        for key in [k for k in self._due if k[0] == int(order_id) and (kind is None or k[1] == kind)]:
+            del self._due[key]
+
+    def due_at(self, order_id: int, kind: str) -> Optional[float]:
+        return self._due.get((int(order_id), str(kind)))
+
+    def next_due(self) -> Optional[float]:
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> List[DueItem]:
+        out: List[DueItem] = []
+        while self._heap and len(out) < self.max_batch:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            _, oid, kind = heapq.heappop(self._heap)
+            del self._due[(oid, kind)]
+            out.append((oid, kind))
+        return out
+
+    def _drop_stale(self) -> None:
+        while self._heap:
+            ts, oid, kind = self._heap[0]
+            if self._due.get((oid, kind)) == ts:
+                return
+            heapq.heappop(self._heap)
+
+    def stats(self) -> Dict[str, Any]:
+        nd = self.next_due()
+        return {
+            "pending": len(self._due),
+            "heap": len(self._heap),
+            "next_in_sec": (max(0.0, nd - time.time()) if nd is not None else None),
+            "runs": self._runs,
+            "items": self._items,
+        }
+
+    async def run(self, handler: BatchHandler) -> None:
+        """Call handler(batch) with due items forever; handler reschedules what it needs."""
+        while True:
+            # clear before looking at the heap so a schedule() racing with us still wakes us
+            self._wake.clear()
+            now = time.time()
+            batch = self.pop_due(now)
+            if batch:
+                self._runs += 1
+                self._items += len(batch)
+                try:
+                    await handler(batch)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    pass
+                continue
+            nd = self.next_due()
+            timeout = None if nd is None else max(0.0, nd - now)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
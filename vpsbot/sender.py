@@ -0,0 +1,221 @@
+"""Outbound Telegram message queue.
+
+Notifications are queued here instead of calling bot.send_* inline:
+
+- a global token bucket (Telegram allows about 30 messages/s per bot),
+- per-chat spacing: 1/s for private chats, 20/min for groups and channels,
+- TelegramRetryAfter pauses all sending for the time Telegram asks for and
+  the message is sent again,
+- network/server errors are retried with exponential backoff; permanent
+  errors (bot blocked, bad request, chat not found) drop the message,
+- priority classes: user-facing before admin reports before bulk.
+
+Every submit returns a future with the sent Message (None if the message was
+dropped, or the final exception with raise_errors=True), so callers that
+need the result await it and the rest fire and forget. Messages of one
+priority to one chat are delivered in submit order: a chat has at most one
+send in flight, and a retried message goes back in front of the later ones.
+Messages still queued when the queue stops are dropped the same way.
+"""
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+import aiohttp
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+PRIORITIES = ("user", "admin", "bulk")
+
+
+@dataclass
+class _Item:
+    method: str  # Bot method: send_message, send_photo, send_document, ...
+    chat_id: int
+    kwargs: Dict[str, Any]
+    priority: int
+    future: asyncio.Future
+    attempts: int = 0
+    not_before: float = 0.0
+    raise_errors: bool = False
+
+
+class SendQueue:
+    def __init__(
+        self,
+        bot: Bot,
+        rate: float = 30.0,
+        private_interval: float = 1.0,
+        group_interval: float = 3.0,
+        max_retries: int = 5,
+        concurrency: int = 10,
+        max_backoff: float = 60.0,
+    ):
+        self.bot = bot
+        self.rate = max(1.0, float(rate))
+        self.private_interval = float(private_interval)
+        self.group_interval = float(group_interval)
+        self.max_retries = int(max_retries)
+        self.max_backoff = float(max_backoff)
+        self._queues: List[Deque[_Item]] = [deque() for _ in PRIORITIES]
+        self._chat_next: Dict[int, float] = {}
+        self._tokens = self.rate
+        self._tokens_ts = time.monotonic()
+        self._paused_until = 0.0
+        self._wake = asyncio.Event()
+        self._sem = asyncio.Semaphore(max(1, int(concurrency)))
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: Set[asyncio.Task] = set()
+        self._busy: Set[int] = set()  # chats with a send in flight
+        self.sent = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.dropped = 0
+        self.last_error = ""
+
+    # -------------------------
+    # submit
+    # -------------------------
+    def submit(self, method: str, chat_id: int, priority: str = "user", *, raise_errors: bool = False,
+               **kwargs: Any) -> "asyncio.Future[Any]":
+        fut = asyncio.get_running_loop().create_future()
+        prio = PRIORITIES.index(priority) if priority in PRIORITIES else len(PRIORITIES) - 1
+        self._queues[prio].append(_Item(method, int(chat_id), kwargs, prio, fut, raise_errors=raise_errors))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wake.set()
+        return fut
+
+    def send_message(self, chat_id: int, text: str, priority: str = "user", **kwargs: Any) -> "asyncio.Future[Any]":
+        return self.submit("send_message", chat_id, priority, text=text, **kwargs)
+
+    async def stop(self, drain_sec: float = 5.0) -> None:
+        """Give queued messages up to drain_sec to go out, then cancel the rest."""
+        deadline = time.monotonic() + drain_sec
+        while (any(self._queues) or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        tasks = ([self._task] if self._task else []) + list(self._inflight)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        # nobody will send these; callers awaiting them get the dropped result
+        for q in self._queues:
+            while q:
+                self._drop(q.popleft(), RuntimeError("send queue stopped"))
+        self._busy.clear()
+
+    # -------------------------
+    # dispatch
+    # -------------------------
+    def _interval(self, chat_id: int) -> float:
+        # positive ids are users; groups, supergroups and channels are negative
+        return self.private_interval if chat_id > 0 else self.group_interval
+
+    def _pick(self, now: float) -> Tuple[Optional[_Item], Optional[float]]:
+        """Oldest ready item of the highest priority, else the seconds until one becomes ready."""
+        wait: Optional[float] = None
+        for q in self._queues:
+            blocked: Set[int] = set()
+            for i, it in enumerate(q):
+                if it.chat_id in blocked or it.chat_id in self._busy:
+                    # the in-flight send wakes the loop when it finishes
+                    continue
+                ready_at = max(it.not_before, self._chat_next.get(it.chat_id, 0.0))
+                if ready_at <= now:
+                    del q[i]
+                    return it, None
+                # later items for this chat must not overtake it
+                blocked.add(it.chat_id)
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+        return None, wait
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.rate, self._tokens + (now - self._tokens_ts) * self.rate)
+            self._tokens_ts = now
+            if self._tokens < 1.0:
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+                continue
+
+            self._wake.clear()
+            it, wait = self._pick(now)
+            if it is None:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._tokens -= 1.0
+            self._chat_next[it.chat_id] = now + self._interval(it.chat_id)
+            if len(self._chat_next) > 10000:
+                self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+            await self._sem.acquire()
+            self._busy.add(it.chat_id)
+            t = asyncio.create_task(self._deliver(it))
+            self._inflight.add(t)
+            t.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, it: _Item) -> None:
+        try:
+            res = await getattr(self.bot, it.method)(it.chat_id, **it.kwargs)
+        except asyncio.CancelledError:
+            if not it.future.done():
+                it.future.cancel()
+            raise
+        except TelegramRetryAfter as e:
+            self.rate_limited += 1
+            delay = float(e.retry_after)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._requeue(it, delay, str(e))
+        except (TelegramNetworkError, TelegramServerError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            it.attempts += 1
+            if it.attempts > self.max_retries:
+                self._drop(it, e)
+            else:
+                self._requeue(it, min(self.max_backoff, 2.0 ** it.attempts), str(e))
+        except Exception as e:
+            self._drop(it, e)
+        else:
+            self.sent += 1
+            if not it.future.done():
+                it.future.set_result(res)
+        finally:
+            self._busy.discard(it.chat_id)
+            self._sem.release()
+            self._wake.set()
+
+    def _requeue(self, it: _Item, delay: float, err: str) -> None:
+        self.retried += 1
+        self.last_error = err[:200]
+        it.not_before = time.monotonic() + delay
+        # back to the front: later messages for the same chat wait behind it
+        self._queues[it.priority].appendleft(it)
+        self._wake.set()
+
+    def _drop(self, it: _Item, err: Exception) -> None:
+        self.dropped += 1
+        self.last_error = str(err)[:200]
+        if it.future.done():
+            return
+        if it.raise_errors:
+            it.future.set_exception(err)
+        else:
+            it.future.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": {name: len(q) for name, q in zip(PRIORITIES, self._queues)},
+            "sent": self.sent,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited,
+            "dropped": self.dropped,
+            "paused_sec": max(0, int(self._paused_until - time.monotonic())),
+        }
@@ -0,0 +1,48 @@
+"""Single-flight call coalescing.
+
+Concurrent callers asking for the same key share one in-flight call and its
+result (or exception). The call runs as its own task, so a caller that is
+cancelled does not cancel it for the others. Nothing is cached once the
+call finishes.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        # group -> [issued, coalesced]
+        self._counts: Dict[str, list] = {}
+
+    @staticmethod
+    def _group(key: Hashable) -> str:
+        return str(key[0]) if isinstance(key, tuple) and key else str(key)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """Run fn() once for all concurrent callers of key. Keys are (group, ...) tuples."""
+        counts = self._counts.setdefault(self._group(key), [0, 0])
+        fut = self._inflight.get(key)
+        if fut is None:
+            counts[0] += 1
+            fut = asyncio.ensure_future(fn())
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _f, k=key: self._forget(k, _f))
+        else:
+            counts[1] += 1
+        return await asyncio.shield(fut)
+
+    def _forget(self, key: Hashable, fut: asyncio.Future) -> None:
+        if self._inflight.get(key) is fut:
+            del self._inflight[key]
+        # mark the exception as retrieved when every waiter was cancelled
+        if not fut.cancelled():
+            fut.exception()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            g: {"issued": c[0], "coalesced": c[1], "inflight": sum(1 for k in self._inflight if self._group(k) == g)}
+            for g, c in sorted(self._counts.items())
+        }
@@ -0,0 +1,185 @@
+"""Warm standby servers for the best-selling (server type, location, OS) keys.
+
+The pool lives in the warm_servers table. A purchase takes a ready server
+with DB.claim_warm_server_for_job() and only renames it and resets its password;
+this replenisher builds servers back up to the configured counts, stays
+under a total cap and deletes servers nobody claimed within max_age_sec
+(Hetzner bills them whether anyone uses them or not).
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+PoolKey = Tuple[str, str, str]  # (server_type, location, os_label)
+
+# (server_type, location, os_label) -> (hcloud server id, ipv4, image id, build action ids)
+CreateFn = Callable[[str, str, str], Awaitable[Tuple[int, str, Optional[int], List[int]]]]
+# (hcloud server id, build action ids or None after a restart) -> ipv4 once usable, None if the build failed
+WaitFn = Callable[[int, Optional[List[int]]], Awaitable[Optional[str]]]
+DeleteFn = Callable[[int], Awaitable[Any]]
+AvailableFn = Callable[[str, str], Awaitable[bool]]
+
+
+def parse_warm_pool_spec(spec: str) -> Dict[PoolKey, int]:
+    """'cx22@fsn1@Ubuntu-24.04=2, cpx11@nbg1@Debian-12=1' -> {(type, location, os): count}."""
+    out: Dict[PoolKey, int] = {}
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part or "=" not in part:
+            continue
+        key, _, n = part.rpartition("=")
+        fields = [f.strip() for f in key.split("@")]
+        if len(fields) != 3 or not all(fields):
+            continue
+        try:
+            count = int(n)
+        except ValueError:
+            continue
+        if count > 0:
+            out[(fields[0].lower(), fields[1], fields[2])] = count
+    return out
+
+
+class WarmPool:
+    def __init__(
+        self,
+        db: Any,
+        specs: Dict[PoolKey, int],
+        *,
+        create: CreateFn,
+        wait: WaitFn,
+        delete: DeleteFn,
+        available: AvailableFn,
+        max_total: int = 10,
+        max_age_sec: int = 24 * 3600,
+        build_timeout_sec: int = 1800,
+    ):
+        self.db = db
+        self.specs = dict(specs)
+        self._create = create
+        self._wait = wait
+        self._delete = delete
+        self._available = available
+        self.max_total = max(0, int(max_total))
+        self.max_age_sec = int(max_age_sec)
+        self.build_timeout_sec = int(build_timeout_sec)
+        # warm ids whose build is followed by a task in this process
+        self._building: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.created = 0
+        self.reaped = 0
+        self.failed = 0
+        self.last_error = ""
+
+    def wants(self, key: PoolKey) -> bool:
+        return key in self.specs
+
+    async def tick(self) -> None:
+        """One pass: reap expired/stuck servers, follow orphaned builds, refill deficits."""
+        now = int(time.time())
+        keep: List[Dict[str, Any]] = []
+        for w in await self.db.list_warm_servers():
+            age = now - w["created_at"]
+            expired = (w["state"] == "ready" and age > self.max_age_sec) or (
+                w["state"] == "building" and age > self.build_timeout_sec and w["id"] not in self._building
+            )
+            dropped = (w["server_type"], w["location"], w["os_label"]) not in self.specs
+            if w["state"] == "reaping" or expired or dropped:
+                await self._discard(w, reaped=True)
+                continue
+            if w["state"] == "building" and w["id"] not in self._building:
+                # left over from a previous run
+                self._follow(w["id"], w["hcloud_server_id"], None)
+            keep.append(w)
+
+        counts: Dict[PoolKey, int] = {}
+        for w in keep:
+            k = (w["server_type"], w["location"], w["os_label"])
+            counts[k] = counts.get(k, 0) + 1
+        total = len(keep)
+
+        for key, want in self.specs.items():
+            server_type, location, os_label = key
+            missing = want - counts.get(key, 0)
+            while missing > 0 and total < self.max_total:
+                if not await self._available(location, server_type):
+                    break
+                try:
+                    sid, ip4, image_id, action_ids = await self._create(server_type, location, os_label)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.failed += 1
+                    self.last_error = str(e)[:200]
+                    break
+                warm_id = await self.db.add_warm_server(
+                    server_type=server_type, location=location, os_label=os_label,
+                    image_id=image_id, hcloud_server_id=sid, ip4=ip4,
+                )
+                self.created += 1
+                self._follow(warm_id, sid, action_ids)
+                missing -= 1
+                total += 1
+
+    def _follow(self, warm_id: int, server_id: int, action_ids: Optional[List[int]]) -> None:
+        self._building.add(warm_id)
+        t = asyncio.create_task(self._finish(warm_id, server_id, action_ids))
+        self._tasks.add(t)
+        t.add_done_callback(self._tasks.discard)
+
+    async def _finish(self, warm_id: int, server_id: int, action_ids: Optional[List[int]]) -> None:
+        try:
+            ip4 = await self._wait(server_id, action_ids)
+            if ip4:
+                await self.db.set_warm_server_ready(warm_id, ip4)
+            else:
+                self.failed += 1
+                await self._discard({"id": warm_id, "hcloud_server_id": server_id, "state": "building"})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # row stays 'building'; the next tick after build_timeout_sec reaps it
+            self.last_error = str(e)[:200]
+        finally:
+            self._building.discard(warm_id)
+
+    async def _discard(self, w: Dict[str, Any], reaped: bool = False) -> None:
+        warm_id = w["id"]
+        # a purchase may claim the row at any moment; only delete servers taken out of the pool first
+        if w["state"] != "reaping" and not await self.db.mark_warm_server_reaping(warm_id, w["state"]):
+            return
+        try:
+            await self._delete(w["hcloud_server_id"])
+        except Exception as e:
+            # the row stays 'reaping' so the server is not forgotten; retried next tick
+            self.last_error = str(e)[:200]
+            return
+        await self.db.delete_warm_server(warm_id)
+        if reaped:
+            self.reaped += 1
+
+    async def loop(self, interval: float) -> None:
+        while True:
+            try:
+                await self.tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e)[:200]
+            await asyncio.sleep(max(30.0, float(interval)))
+
+    async def stop(self) -> None:
+        for t in list(self._tasks):
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def stats(self) -> Dict[str, Any]:
+        rows = await self.db.list_warm_servers()
+        return {
+            "ready": sum(1 for w in rows if w["state"] == "ready"),
+            "building": sum(1 for w in rows if w["state"] == "building"),
+            "target": sum(self.specs.values()),
+            "created": self.created,
+            "reaped": self.reaped,
+            "failed": self.failed,
+        }